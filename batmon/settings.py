@@ -72,6 +72,8 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'batmon.wsgi.application'
+# Serves the live feed (monitoring:live_feed); run with an ASGI server such as uvicorn.
+ASGI_APPLICATION = 'batmon.asgi.application'
 
 
 # Database
@@ -139,3 +141,168 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'America/Sao_Paulo' # Use the user's timezone
 CELERY_BEAT_SCHEDULER = 'django_celery_beat.schedulers:DatabaseScheduler'
+
+# BatMon probe engine
+# Maximum number of in-flight probes per worker process for run_service_check_batch.
+BATMON_PROBE_CONCURRENCY = 500
+
+# BatMon DNS cache
+# Each worker process caches the addresses its checks resolve for the records' TTL (with dnspython installed)
+# or BATMON_DNS_CACHE_TTL seconds (system resolver), at most BATMON_DNS_CACHE_MAX_TTL seconds.
+# Names that do not exist are cached for BATMON_DNS_NEGATIVE_TTL seconds. 0 disables the respective caching.
+BATMON_DNS_CACHE_TTL = 60
+BATMON_DNS_CACHE_MAX_TTL = 300
+BATMON_DNS_NEGATIVE_TTL = 30
+
+# BatMon HTTP checker
+# Each worker process keeps pooled HTTP clients; HTTP checks reuse kept-alive connections
+# unless BATMON_HTTP_KEEPALIVE is False (every check then pays a fresh connect and TLS handshake).
+BATMON_HTTP_MAX_CONNECTIONS = 500
+BATMON_HTTP_MAX_CONNECTIONS_PER_HOST = 10
+BATMON_HTTP_KEEPALIVE = True
+# Seconds an idle kept-alive connection stays open.
+BATMON_HTTP_KEEPALIVE_EXPIRY = 30.0
+
+# BatMon scheduler
+# 'periodic_task': one django_celery_beat PeriodicTask per ServiceCheck.
+# 'batched': beat fires dispatch_due_checks every second, which publishes due checks
+# (by ServiceCheck.next_run_at) to run_service_check_batch in messages of BATMON_DISPATCH_BATCH_SIZE IDs.
+# After changing it, run `manage.py sync_check_schedules` to delete (or recreate) the per-check PeriodicTasks.
+BATMON_SCHEDULER_MODE = 'periodic_task'
+BATMON_DISPATCH_BATCH_SIZE = 100
+BATMON_DISPATCH_MAX_PER_TICK = 10000
+# Fraction of the interval used as random jitter around each check's next run.
+BATMON_DISPATCH_JITTER = 0.1
+# Adaptive scheduling, for checks with adaptive_schedule set (batched mode; each check may override
+# the recheck interval, maximum interval and flap threshold): the first BATMON_ADAPTIVE_RECHECKS failures
+# of a streak are re-probed after BATMON_ADAPTIVE_RECHECK_INTERVAL seconds; longer outages and maintenance
+# back off by BATMON_ADAPTIVE_BACKOFF_FACTOR per run, up to BATMON_ADAPTIVE_MAX_BACKOFF times the interval;
+# checks whose flap score reaches BATMON_ADAPTIVE_FLAP_THRESHOLD keep their plain interval.
+BATMON_ADAPTIVE_RECHECK_INTERVAL = 10
+BATMON_ADAPTIVE_RECHECKS = 2
+BATMON_ADAPTIVE_BACKOFF_FACTOR = 2.0
+BATMON_ADAPTIVE_MAX_BACKOFF = 10
+BATMON_ADAPTIVE_FLAP_THRESHOLD = 0.25
+
+# BatMon sharding (batched scheduler)
+# With BATMON_SHARDING, a worker started with BATMON_SHARD (here or in its environment) also consumes the queue
+# 'batmon.shard.<name>' and heartbeats the shard into Redis every BATMON_SHARD_HEARTBEAT_INTERVAL seconds.
+# Due checks go to the queue of the shard owning them on a consistent-hash ring of the shards heard from
+# within BATMON_SHARD_TIMEOUT seconds, BATMON_SHARD_VNODES points per shard; without live shards, to the default queue.
+BATMON_SHARDING = False
+BATMON_SHARD = None
+BATMON_SHARD_HEARTBEAT_INTERVAL = 10
+BATMON_SHARD_TIMEOUT = 30
+BATMON_SHARD_VNODES = 100
+
+# BatMon result sink
+# Check results are buffered per worker process and written with bulk_create once
+# the buffer holds this many results or its oldest entry is this many seconds old.
+BATMON_RESULT_BUFFER_SIZE = 500
+BATMON_RESULT_BUFFER_MAX_AGE = 2.0
+# While the database is unreachable, results are kept for the next flush up to this many; older ones are dropped.
+BATMON_RESULT_BUFFER_LIMIT = 50000
+
+# BatMon sample storage
+# 'rows': one CheckResult row per probe.
+# 'blocks': samples are packed into one SampleBlock per service and hour (timestamp deltas, float32
+# response times, success bitmap); CheckResult rows, with their messages, are only kept for failures
+# and state changes.
+BATMON_SAMPLE_STORAGE = 'rows'
+
+# Redis used for BatMon's own pub/sub (cache invalidation); defaults to the Celery broker.
+BATMON_REDIS_URL = CELERY_BROKER_URL
+# Seconds a process trusts its cached maintenance schedule without an invalidation message.
+BATMON_MAINTENANCE_CACHE_TTL = 60
+
+# BatMon status page cache
+# The pre-rendered public status pages live in Redis, so every web process serves the same copy.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'status': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': BATMON_REDIS_URL,
+        'KEY_PREFIX': 'batmon:status',
+    },
+}
+BATMON_STATUS_CACHE = 'status'
+# Seconds between background re-renders of a cached status page (on top of status and maintenance changes).
+BATMON_STATUS_CACHE_REFRESH = 60
+
+# BatMon alert dispatch
+# Triggered alerts are queued in Redis and sent every BATMON_ALERT_BATCH_WINDOW seconds, grouped by
+# destination over one SMTP connection / HTTP session (0 sends each alert immediately).
+# With BATMON_ALERT_DIGEST, alerts to the same e-mail address or Telegram chat are merged into one message.
+BATMON_ALERT_BATCH_WINDOW = 5.0
+BATMON_ALERT_BATCH_MAX = 1000
+# A drained batch that is not dispatched within this many seconds (its worker died) is queued again,
+# so alerts are delivered at least once; keep it above the time a batch takes to send.
+BATMON_ALERT_REDELIVERY_TIMEOUT = 300
+BATMON_ALERT_DIGEST = True
+BATMON_ALERT_FROM_EMAIL = "noreply@batmon.com"
+
+# BatMon charts
+# Pages fetch their chart series from /api/servicechecks/<id>/chart/, downsampled to at most
+# BATMON_CHART_MAX_POINTS points and cached per service and window for BATMON_CHART_CACHE_TTL seconds.
+BATMON_CHART_MAX_POINTS = 300
+BATMON_CHART_CACHE_TTL = 60
+
+# BatMon live feed
+# Flushed results and status changes are published on Redis; each ASGI process subscribes once and
+# streams them to open pages as Server-Sent Events. A keep-alive comment goes out every
+# BATMON_LIVE_FEED_KEEPALIVE seconds; a client more than BATMON_LIVE_FEED_QUEUE_SIZE batches behind reloads.
+BATMON_LIVE_FEED_KEEPALIVE = 15
+BATMON_LIVE_FEED_QUEUE_SIZE = 100
+
+# BatMon metrics
+# Counters and histograms are kept in memory by each process and added to totals in Redis every
+# BATMON_METRICS_PUSH_INTERVAL seconds; /metrics serves the totals in the Prometheus text format.
+BATMON_METRICS_PUSH_INTERVAL = 10
+
+# BatMon rollups
+# Minimum seconds of raw results re-aggregated into 1-minute buckets on every compact_rollups run; it
+# also catches up from the newest stored bucket. `manage.py rebuild_rollups --since <iso>` backfills older ranges.
+BATMON_ROLLUP_LOOKBACK = 300
+
+# BatMon retention
+# Days to keep each tier ('raw' CheckResult rows, '1m'/'1h'/'1d' rollups, AlertLog); None keeps it forever.
+# purge_expired_data deletes expired rows in primary-key chunks of BATMON_PURGE_CHUNK_SIZE.
+BATMON_RETENTION = {
+    'raw': 7,
+    '1m': 90,
+    '1h': None,
+    '1d': None,
+    'alertlog': 90,
+}
+BATMON_PURGE_CHUNK_SIZE = 10000
+# Daily CheckResult partitions created ahead of time once the table is partitioned
+# (manage.py partition_checkresults --convert, PostgreSQL only).
+BATMON_PARTITION_DAYS_AHEAD = 3
+
+CELERY_BEAT_SCHEDULE = {
+    'compact-rollups': {
+        'task': 'monitoring.tasks.compact_rollups',
+        'schedule': 60.0,
+    },
+    'refresh-status-pages': {
+        'task': 'monitoring.tasks.refresh_status_pages',
+        'schedule': 5.0,
+    },
+    'purge-expired-data': {
+        'task': 'monitoring.tasks.purge_expired_data',
+        'schedule': 3600.0,
+    },
+}
+if BATMON_SCHEDULER_MODE == 'batched':
+    CELERY_BEAT_SCHEDULE['dispatch-due-checks'] = {
+        'task': 'monitoring.tasks.dispatch_due_checks',
+        'schedule': 1.0,
+        'options': {'expires': 5},
+    }
+if BATMON_ALERT_BATCH_WINDOW:
+    CELERY_BEAT_SCHEDULE['dispatch-pending-alerts'] = {
+        'task': 'monitoring.alert_tasks.dispatch_pending_alerts',
+        'schedule': BATMON_ALERT_BATCH_WINDOW,
+    }
@@ -1,12 +1,15 @@
 from django.contrib import admin
-from .models import ServiceCheck, CheckResult, Alert, AlertLog, MaintenanceWindow # Import MaintenanceWindow
+from .models import ServiceCheck, CheckResult, CheckResultRollup, Alert, AlertLog, Incident, MaintenanceWindow, SampleBlock
+from .maintenance_cache import publish_maintenance_change
+from .status_cache import schedule_rebuild
 
 @admin.register(ServiceCheck)
 class ServiceCheckAdmin(admin.ModelAdmin):
-    list_display = ('name', 'url_or_host', 'check_type', 'interval', 'timeout', 'status_atual', 'last_check', 'periodic_task')
-    list_filter = ('check_type', 'status_atual')
+    list_display = ('name', 'url_or_host', 'check_type', 'interval', 'timeout', 'active', 'status_atual', 'last_check', 'periodic_task')
+    list_filter = ('check_type', 'status_atual', 'active', 'adaptive_schedule')
     search_fields = ('name', 'url_or_host')
-    readonly_fields = ('last_check', 'status_atual', 'periodic_task')
+    readonly_fields = ('last_check', 'status_atual', 'consecutive_failures', 'alerted_failures', 'flap_score', 'backoff_level',
+                       'next_run_at', 'periodic_task')
 
 @admin.register(CheckResult)
 class CheckResultAdmin(admin.ModelAdmin):
@@ -14,6 +17,15 @@ class CheckResultAdmin(admin.ModelAdmin):
     list_filter = ('service', 'success')
     search_fields = ('service__name', 'message')
     readonly_fields = ('service', 'timestamp', 'success', 'response_time', 'status_code', 'message')
+    ordering = ('-timestamp',)
+
+@admin.register(Incident)
+class IncidentAdmin(admin.ModelAdmin):
+    list_display = ('service', 'started_at', 'ended_at', 'failed_probes', 'first_error')
+    list_filter = ('service',)
+    search_fields = ('service__name', 'first_error')
+    readonly_fields = ('service', 'started_at', 'ended_at', 'first_error', 'failed_probes')
+    ordering = ('-started_at',)
 
 @admin.register(Alert)
 class AlertAdmin(admin.ModelAdmin):
@@ -27,7 +39,8 @@ class AlertLogAdmin(admin.ModelAdmin):
     list_display = ('alert', 'timestamp', 'success', 'response_message')
     list_filter = ('alert__service__name', 'success')
     search_fields = ('alert__service__name', 'message_sent', 'response_message')
-    readonly_fields = ('alert', 'timestamp', 'message_sent', 'success', 'response_message')
+    readonly_fields = ('alert', 'incident', 'timestamp', 'message_sent', 'success', 'response_message')
+    ordering = ('-timestamp',)
 
 @admin.register(MaintenanceWindow)
 class MaintenanceWindowAdmin(admin.ModelAdmin):
@@ -39,10 +52,30 @@ class MaintenanceWindowAdmin(admin.ModelAdmin):
 
     def activate_maintenance(self, request, queryset):
         queryset.update(active=True)
+        publish_maintenance_change() # update() bypasses the post_save signal
+        schedule_rebuild()
         self.message_user(request, "Selected maintenance windows activated.")
     activate_maintenance.short_description = "Activate selected maintenance windows"
 
     def deactivate_maintenance(self, request, queryset):
         queryset.update(active=False)
+        publish_maintenance_change() # update() bypasses the post_save signal
+        schedule_rebuild()
         self.message_user(request, "Selected maintenance windows deactivated.")
     deactivate_maintenance.short_description = "Deactivate selected maintenance windows"
+
+@admin.register(CheckResultRollup)
+class CheckResultRollupAdmin(admin.ModelAdmin):
+    list_display = ('service', 'resolution', 'bucket_start', 'count', 'successes', 'response_time_p95')
+    list_filter = ('resolution', 'service')
+    readonly_fields = ('service', 'resolution', 'bucket_start', 'count', 'successes', 'response_time_count',
+                       'response_time_sum', 'response_time_min', 'response_time_max', 'response_time_p95')
+
+@admin.register(SampleBlock)
+class SampleBlockAdmin(admin.ModelAdmin):
+    list_display = ('service', 'start', 'count', 'successes')
+    list_filter = ('service',)
+    # The packed columns are unreadable in a form; the samples API decodes them.
+    fields = ('service', 'start', 'count', 'successes')
+    readonly_fields = ('service', 'start', 'count', 'successes')
+    ordering = ('-start',)
@@ -0,0 +1,294 @@
+"""
+Batched alert delivery.
+
+Triggered alerts are queued in Redis and drained every
+BATMON_ALERT_BATCH_WINDOW seconds by the dispatch_pending_alerts task. A
+drained batch is grouped by destination: all e-mails go over one SMTP
+connection and all Telegram/webhook calls over one HTTP session, and with
+BATMON_ALERT_DIGEST several alerts for the same inbox or chat become a
+single digest message. Every alert still gets its own AlertLog row, linked
+to its service's latest Incident; the rows of a batch are written with one
+bulk INSERT.
+
+Delivery is at-least-once: a drained batch is moved to its own processing
+list and only removed once it has been dispatched. A batch left behind by
+a worker that died (or whose dispatch failed) goes back to the queue after
+BATMON_ALERT_REDELIVERY_TIMEOUT seconds, so its alerts may be sent twice.
+"""
+import json
+import logging
+import subprocess
+import time
+import uuid
+from collections import defaultdict
+
+import requests
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+
+from . import incidents, metrics
+from .models import Alert, AlertLog
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+PENDING_ALERTS_KEY = 'batmon:alerts:pending'
+# Sorted set of the processing batch lists, scored by the time they were claimed
+PROCESSING_ALERTS_KEY = 'batmon:alerts:processing'
+DEFAULT_ALERT_BATCH_WINDOW = 5.0
+DEFAULT_ALERT_BATCH_MAX = 1000
+DEFAULT_ALERT_REDELIVERY_TIMEOUT = 300
+DEFAULT_ALERT_DIGEST = True
+DEFAULT_ALERT_FROM_EMAIL = "noreply@batmon.com"
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+HTTP_TIMEOUT = 10
+
+
+def batch_window():
+    return getattr(settings, 'BATMON_ALERT_BATCH_WINDOW', DEFAULT_ALERT_BATCH_WINDOW)
+
+
+def enqueue(alert_id, message):
+    get_redis().rpush(PENDING_ALERTS_KEY, json.dumps([alert_id, message]))
+
+
+def claim_pending(limit=None):
+    """
+    Move up to ``limit`` queued ``(alert_id, message)`` pairs into a new processing batch.
+
+    Returns ``(batch_key, items)``; ``ack(batch_key)`` once the items have
+    been dispatched.
+    """
+    limit = limit or getattr(settings, 'BATMON_ALERT_BATCH_MAX', DEFAULT_ALERT_BATCH_MAX)
+    client = get_redis()
+    count = min(client.llen(PENDING_ALERTS_KEY), limit)
+    if not count:
+        return None, []
+    batch_key = f"{PROCESSING_ALERTS_KEY}:{uuid.uuid4().hex}"
+    pipe = client.pipeline(transaction=True)
+    for _ in range(count):
+        pipe.lmove(PENDING_ALERTS_KEY, batch_key, 'LEFT', 'RIGHT')
+    pipe.zadd(PROCESSING_ALERTS_KEY, {batch_key: time.time()})
+    # Another dispatcher may have claimed some of them in the meantime.
+    items = [item for item in pipe.execute()[:-1] if item is not None]
+    if not items:
+        ack(batch_key)
+        return None, []
+    return batch_key, [tuple(json.loads(item)) for item in items]
+
+
+def ack(batch_key):
+    """Forget a dispatched batch."""
+    pipe = get_redis().pipeline(transaction=True)
+    pipe.delete(batch_key)
+    pipe.zrem(PROCESSING_ALERTS_KEY, batch_key)
+    pipe.execute()
+
+
+def requeue_stale(timeout=None):
+    """
+    Put the alerts of batches claimed more than ``timeout`` seconds ago, and
+    never acknowledged, back at the head of the queue. Returns how many.
+    """
+    if timeout is None:
+        timeout = getattr(settings, 'BATMON_ALERT_REDELIVERY_TIMEOUT', DEFAULT_ALERT_REDELIVERY_TIMEOUT)
+    client = get_redis()
+    requeued = 0
+    for batch_key in client.zrangebyscore(PROCESSING_ALERTS_KEY, '-inf', time.time() - timeout):
+        # One item at a time, last first, so the queue keeps their order and nothing is lost midway
+        while client.lmove(batch_key, PENDING_ALERTS_KEY, 'RIGHT', 'LEFT') is not None:
+            requeued += 1
+        client.zrem(PROCESSING_ALERTS_KEY, batch_key)
+    return requeued
+
+
+class Delivery:
+    """One alert message on its way out, and how its delivery went."""
+
+    def __init__(self, alert, message):
+        self.alert = alert
+        self.message = message
+        self.success = False
+        self.response_message = ""
+
+    def done(self, success, response_message):
+        self.success = success
+        self.response_message = response_message
+
+    def log(self, incident_id=None):
+        return AlertLog(alert=self.alert, incident_id=incident_id, message_sent=self.message, success=self.success,
+                        response_message=self.response_message)
+
+
+def destination(alert):
+    """Key of the inbox, chat or endpoint an alert is delivered to."""
+    config = alert.config
+    if alert.alert_type == 'email':
+        return ('email', config.get('email_address'))
+    if alert.alert_type == 'telegram':
+        return ('telegram', config.get('token'), config.get('chat_id'))
+    if alert.alert_type == 'webhook':
+        return ('webhook', config.get('webhook_url'))
+    return (alert.alert_type, alert.id)
+
+
+def digest_chunks(entries, limit):
+    """
+    Pack ``(text, delivery)`` pairs into as few messages of at most ``limit`` characters as possible.
+
+    Returns ``[(text, deliveries)]``.
+    """
+    chunks = []
+    for text, delivery in entries:
+        text = text[:limit]
+        if chunks and len(chunks[-1][0]) + 2 + len(text) <= limit:
+            chunks[-1] = (f"{chunks[-1][0]}\n\n{text}", chunks[-1][1] + [delivery])
+        else:
+            chunks.append((text, [delivery]))
+    return chunks
+
+
+def _email_subject(deliveries):
+    if len(deliveries) == 1:
+        return f"BatMon Alert: {deliveries[0].alert.service.name}"
+    return f"BatMon: {len(deliveries)} alerts"
+
+
+def send_email_group(deliveries, connection, digest):
+    address = deliveries[0].alert.config.get('email_address')
+    from_email = getattr(settings, 'BATMON_ALERT_FROM_EMAIL', DEFAULT_ALERT_FROM_EMAIL)
+    batches = [deliveries] if digest else [[delivery] for delivery in deliveries]
+    for batch in batches:
+        email = EmailMessage(
+            subject=_email_subject(batch),
+            body="\n\n".join(delivery.message for delivery in batch),
+            from_email=from_email,
+            to=[address],
+            connection=connection,
+        )
+        try:
+            email.send(fail_silently=False)
+            outcome = (True, "Email sent successfully." if len(batch) == 1 else f"Email digest of {len(batch)} alerts sent successfully.")
+        except Exception as e:
+            outcome = (False, f"Email sending failed: {e}")
+        for delivery in batch:
+            delivery.done(*outcome)
+
+
+def send_telegram_group(deliveries, session, digest):
+    config = deliveries[0].alert.config
+    token, chat_id = config.get('token'), config.get('chat_id')
+    if not token or not chat_id:
+        missing = "bot token" if not token else "chat ID"
+        for delivery in deliveries:
+            delivery.done(False, f"Telegram configuration error: Telegram {missing} is missing in alert configuration.")
+        return
+
+    # A configured 'message' replaces the generated alert text.
+    entries = [(delivery.alert.config.get('message') or delivery.message, delivery) for delivery in deliveries]
+    if digest:
+        batches = digest_chunks(entries, TELEGRAM_MAX_MESSAGE_LENGTH)
+    else:
+        batches = [(text, [delivery]) for text, delivery in entries]
+
+    url = f"https://api.telegram.org/bot{token}/sendMessage"
+    for text, batch in batches:
+        try:
+            response = session.post(url, data={"chat_id": chat_id, "text": text}, timeout=HTTP_TIMEOUT)
+            response.raise_for_status()
+            outcome = (True, f"Telegram message sent successfully. Status: {response.status_code} - Response: {response.text}")
+        except requests.exceptions.RequestException as e:
+            outcome = (False, f"Telegram message failed: {e}")
+        for delivery in batch:
+            delivery.done(*outcome)
+
+
+def send_webhook(delivery, session):
+    # Webhook consumers expect one payload per alert, so webhooks are never digested.
+    alert = delivery.alert
+    try:
+        payload = {'alert_message': delivery.message, 'service_name': alert.service.name, 'status': alert.service.status_atual}
+        response = session.post(alert.config.get('webhook_url'), headers={'Content-Type': 'application/json'},
+                                data=json.dumps(payload), timeout=HTTP_TIMEOUT)
+        response.raise_for_status()
+        delivery.done(True, f"Webhook sent successfully. Status: {response.status_code}")
+    except requests.exceptions.RequestException as e:
+        delivery.done(False, f"Webhook failed: {e}")
+
+
+def run_command(delivery):
+    config = delivery.alert.config
+    try:
+        process = subprocess.run(config.get('command'), shell=True, capture_output=True, text=True,
+                                 timeout=config.get('timeout', 60))
+        if process.returncode == 0:
+            delivery.done(True, f"Command executed successfully. Output: {process.stdout}")
+        else:
+            delivery.done(False, f"Command failed. Error: {process.stderr}")
+    except subprocess.TimeoutExpired:
+        delivery.done(False, f"Command timed out after {config.get('timeout', 60)} seconds.")
+    except Exception as e:
+        delivery.done(False, f"Command execution failed: {e}")
+
+
+def dispatch(items, digest=None):
+    """
+    Deliver ``(alert_id, message)`` pairs, grouped by destination.
+
+    Returns the AlertLog rows written, one per delivered (or failed) alert.
+    """
+    if digest is None:
+        digest = getattr(settings, 'BATMON_ALERT_DIGEST', DEFAULT_ALERT_DIGEST)
+    alerts = Alert.objects.select_related('service').in_bulk({alert_id for alert_id, _ in items})
+    missing = {alert_id for alert_id, _ in items} - set(alerts)
+    if missing:
+        logger.error(f"Alerts {sorted(missing)} not found.")
+
+    groups = defaultdict(list)
+    for alert_id, message in items:
+        if alert_id in alerts:
+            delivery = Delivery(alerts[alert_id], message)
+            groups[destination(delivery.alert)].append(delivery)
+
+    email_connection = None
+    session = None
+    try:
+        for key, deliveries in groups.items():
+            channel = key[0]
+            started = time.perf_counter()
+            try:
+                if channel == 'email':
+                    if email_connection is None:
+                        email_connection = get_connection(fail_silently=False)
+                        email_connection.open()
+                    send_email_group(deliveries, email_connection, digest)
+                elif channel in ('telegram', 'webhook'):
+                    session = session or requests.Session()
+                    if channel == 'telegram':
+                        send_telegram_group(deliveries, session, digest)
+                    else:
+                        for delivery in deliveries:
+                            send_webhook(delivery, session)
+                else:
+                    for delivery in deliveries:
+                        run_command(delivery)
+            except Exception as e:
+                logger.error(f"Error dispatching alerts to {channel}: {e}", exc_info=True)
+                for delivery in deliveries:
+                    if not delivery.response_message:
+                        delivery.done(False, f"Dispatch failed: {e}")
+            metrics.ALERT_DELIVERY.observe(time.perf_counter() - started, channel=channel)
+            for delivery in deliveries:
+                metrics.ALERTS.inc(channel=channel, outcome='delivered' if delivery.success else 'failed')
+    finally:
+        if email_connection is not None:
+            email_connection.close()
+        if session is not None:
+            session.close()
+
+    # Alerts are sent on failures and recoveries, so the latest incident is the one they are about.
+    incident_ids = incidents.latest_incident_ids({alert.service_id for alert in alerts.values()}) if groups else {}
+    return AlertLog.objects.bulk_create([
+        delivery.log(incident_ids.get(delivery.alert.service_id))
+        for deliveries in groups.values() for delivery in deliveries
+    ])
@@ -1,97 +1,54 @@
 from celery import shared_task
-from django.core.mail import send_mail
-import requests
-import json
-import subprocess
-from .models import Alert, AlertLog
+import logging
+import redis
+from . import alert_dispatch
+
+logger = logging.getLogger(__name__)
+
+def queue_alert(alert_id, message):
+    """
+    Hand a triggered alert to the batching dispatcher.
+
+    With batching disabled (BATMON_ALERT_BATCH_WINDOW = 0), or if Redis is
+    unreachable, the alert is sent right away by its own task.
+    """
+    if alert_dispatch.batch_window():
+        try:
+            alert_dispatch.enqueue(alert_id, message)
+            return
+        except (redis.RedisError, OSError) as e:
+            logger.warning(f"Could not queue alert {alert_id} for batching, sending it directly: {e}")
+    send_alerts.delay([[alert_id, message]])
 
 @shared_task
 def send_alert(alert_id, message):
-    try:
-        alert = Alert.objects.get(id=alert_id)
-        success = False
-        response_message = ""
-
-        if alert.alert_type == 'email':
-            try:
-                send_mail(
-                    subject=f"BatMon Alert: {alert.service.name}",
-                    message=message,
-                    from_email="noreply@batmon.com", # This should be configured in settings.py
-                    recipient_list=[alert.config.get('email_address')],
-                    fail_silently=False,
-                )
-                success = True
-                response_message = "Email sent successfully."
-            except Exception as e:
-                response_message = f"Email sending failed: {e}"
-
-        elif alert.alert_type == 'telegram':
-            try:
-                telegram_token = alert.config.get('token')
-                telegram_chat_id = alert.config.get('chat_id')
-                telegram_message = alert.config.get('message')
-
-                if not telegram_token:
-                    raise ValueError("Telegram bot token is missing in alert configuration.")
-                if not telegram_chat_id:
-                    raise ValueError("Telegram chat ID is missing in alert configuration.")
-
-                url = f"https://api.telegram.org/bot{telegram_token}/sendMessage"
-                payload = {
-                    "chat_id": telegram_chat_id,
-                    "text": telegram_message
-                }
-                
-                response = requests.post(url, data=payload, timeout=10)
-                response.raise_for_status()
-                
-                success = True
-                response_message = f"Telegram message sent successfully. Status: {response.status_code} - Response: {response.text}"
-                print(f"Telegram API Response: {response.status_code} - {response.text}")
-            except requests.exceptions.RequestException as e:
-                response_message = f"Telegram message failed: {e}"
-                print(f"Telegram message failed: {e}")
-            except ValueError as e:
-                response_message = f"Telegram configuration error: {e}"
-                print(f"Telegram configuration error: {e}")
-            except Exception as e:
-                response_message = f"An unexpected error occurred during Telegram message sending: {e}"
-                print(f"An unexpected error occurred during Telegram message sending: {e}")
+    """Deliver a single alert right away (kept for callers that bypass the batching queue)."""
+    send_alerts([[alert_id, message]])
 
-        elif alert.alert_type == 'webhook':
-            try:
-                headers = {'Content-Type': 'application/json'}
-                payload = {'alert_message': message, 'service_name': alert.service.name, 'status': alert.service.status_atual}
-                response = requests.post(alert.config.get('webhook_url'), headers=headers, data=json.dumps(payload), timeout=10)
-                response.raise_for_status()
-                success = True
-                response_message = f"Webhook sent successfully. Status: {response.status_code}"
-            except requests.exceptions.RequestException as e:
-                response_message = f"Webhook failed: {e}"
-
-        elif alert.alert_type == 'command':
-            try:
-                command = alert.config.get('command')
-                process = subprocess.run(command, shell=True, capture_output=True, text=True, timeout=alert.config.get('timeout', 60))
-                if process.returncode == 0:
-                    success = True
-                    response_message = f"Command executed successfully. Output: {process.stdout}"
-                else:
-                    response_message = f"Command failed. Error: {process.stderr}"
-            except subprocess.TimeoutExpired:
-                response_message = f"Command timed out after {alert.config.get('timeout', 60)} seconds."
-            except Exception as e:
-                response_message = f"Command execution failed: {e}"
-
-        AlertLog.objects.create(
-            alert=alert,
-            message_sent=message,
-            success=success,
-            response_message=response_message
-        )
-
-    except Alert.DoesNotExist:
-        print(f"Alert with id {alert_id} not found.")
+@shared_task
+def send_alerts(items):
+    """Deliver ``[alert_id, message]`` pairs, grouped by destination."""
+    try:
+        logs = alert_dispatch.dispatch(items)
+        logger.info(f"Dispatched {len(logs)} alerts, {sum(log.success for log in logs)} delivered.")
     except Exception as e:
-        print(f"Error in send_alert task for alert {alert_id}: {e}")
\ No newline at end of file
+        logger.error(f"Error in send_alerts task for {len(items)} alerts: {e}", exc_info=True)
+
+@shared_task(ignore_result=True)
+def dispatch_pending_alerts():
+    """Drain the alerts queued during the last batch window and deliver them together."""
+    requeued = alert_dispatch.requeue_stale()
+    if requeued:
+        logger.warning(f"Requeued {requeued} alerts from batches that were never acknowledged.")
+    while True:
+        batch_key, items = alert_dispatch.claim_pending()
+        if not items:
+            break
+        try:
+            logs = alert_dispatch.dispatch(items)
+        except Exception as e:
+            # The batch stays claimed and is requeued after BATMON_ALERT_REDELIVERY_TIMEOUT.
+            logger.error(f"Error dispatching {len(items)} queued alerts, they will be retried: {e}", exc_info=True)
+            break
+        alert_dispatch.ack(batch_key)
+        logger.info(f"Dispatched {len(logs)} alerts, {sum(log.success for log in logs)} delivered.")
@@ -1,23 +1,223 @@
+import csv
+import json
+from datetime import timedelta
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+
+from django.core.handlers.asgi import ASGIRequest
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from django.utils.cache import patch_cache_control
+from django.utils.dateparse import parse_datetime
 from rest_framework import viewsets
-from .models import ServiceCheck, CheckResult, Alert, AlertLog, MaintenanceWindow
-from .serializers import ServiceCheckSerializer, CheckResultSerializer, AlertSerializer, AlertLogSerializer, MaintenanceWindowSerializer
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+from . import charts, samples, sla
+from .models import ServiceCheck, CheckResult, Alert, AlertLog, Incident, MaintenanceWindow
+from .pagination import TimestampCursorPagination
+from .serializers import (
+    ServiceCheckSerializer, CheckResultSerializer, AlertSerializer, AlertLogSerializer, IncidentSerializer,
+    MaintenanceWindowSerializer,
+)
+
+EXPORT_CHUNK_SIZE = 2000
+MAX_SAMPLES_SPAN = timedelta(days=7)
+DEFAULT_SLA_SPAN = timedelta(days=30)
+
+class Echo:
+    """File-like object whose write() returns the value, for streaming csv.writer output."""
+    def write(self, value):
+        return value
+
+def query_datetime(request, name):
+    value = request.query_params.get(name)
+    if not value:
+        return None
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise ValidationError({name: "Expected an ISO 8601 date and time."})
+    return parsed
+
+class HistoryViewSetMixin:
+    """
+    Cursor pagination plus ``?service=<id>&since=<iso>&until=<iso>`` filters,
+    and a streaming ``export.ndjson`` / ``export.csv`` action over the same filters.
+    """
+    pagination_class = TimestampCursorPagination
+    service_lookup = 'service_id'
+    timestamp_field = 'timestamp'
+    export_fields = ()
+
+    def _query_datetime(self, name):
+        return query_datetime(self.request, name)
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        service = self.request.query_params.get('service')
+        if service:
+            if not service.isdigit():
+                raise ValidationError({'service': "Expected a service id."})
+            queryset = queryset.filter(**{self.service_lookup: service})
+        since = self._query_datetime('since')
+        if since:
+            queryset = queryset.filter(**{f'{self.timestamp_field}__gte': since})
+        until = self._query_datetime('until')
+        if until:
+            queryset = queryset.filter(**{f'{self.timestamp_field}__lt': until})
+        return queryset
+
+    @action(detail=False, url_path=r'export\.(?P<export_format>ndjson|csv)')
+    def export(self, request, export_format):
+        """
+        Stream every matching row, oldest first, in constant memory (server-side cursor on PostgreSQL).
+
+        Under ASGI the response gets an async iterator that fetches one chunk
+        at a time: Django would read a sync iterator into a list first.
+        """
+        rows = (
+            self.filter_queryset(self.get_queryset())
+            .order_by(self.timestamp_field, 'id')
+            .values_list(*self.export_fields)
+            .iterator(chunk_size=EXPORT_CHUNK_SIZE)
+        )
+        if export_format == 'csv':
+            format_row = csv.writer(Echo()).writerow
+            header = self.export_fields
+            content_type = 'text/csv'
+        else:
+            fields = self.export_fields
+            format_row = lambda row: json.dumps(dict(zip(fields, row)), cls=DjangoJSONEncoder) + '\n'
+            header = None
+            content_type = 'application/x-ndjson'
+        if isinstance(request._request, ASGIRequest):
+            lines = _async_lines(format_row, header, rows)
+        else:
+            lines = _lines(format_row, header, rows)
+        response = StreamingHttpResponse(lines, content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="{self.basename}.{export_format}"'
+        return response
+
+def _lines(format_row, header, rows):
+    if header:
+        yield format_row(header)
+    for row in rows:
+        yield format_row(row)
+
+async def _async_lines(format_row, header, rows):
+    if header:
+        yield format_row(header)
+    # Thread-sensitive, so every chunk is read on the request's database connection.
+    fetch = sync_to_async(lambda: list(islice(rows, EXPORT_CHUNK_SIZE)))
+    try:
+        while chunk := await fetch():
+            for row in chunk:
+                yield format_row(row)
+    finally:
+        await sync_to_async(rows.close)()
 
 class ServiceCheckViewSet(viewsets.ModelViewSet):
     queryset = ServiceCheck.objects.all().order_by('name')
     serializer_class = ServiceCheckSerializer
 
-class CheckResultViewSet(viewsets.ReadOnlyModelViewSet):
-    queryset = CheckResult.objects.all().order_by('-timestamp')
+    @action(detail=True)
+    def chart(self, request, pk=None):
+        """Downsampled response time and uptime series of the service (``?window=24h|7d|30d``), cached."""
+        window = request.query_params.get('window', charts.DEFAULT_CHART_WINDOW)
+        if window not in charts.CHART_WINDOWS:
+            raise ValidationError({'window': f"Expected one of {', '.join(charts.CHART_WINDOWS)}."})
+        data = charts.cached_chart_data(pk, window)
+        if data is None:
+            data = charts.build_chart_data(self.get_object().pk, window)
+        response = Response(data)
+        # Public, like the status page the charts are on.
+        patch_cache_control(response, public=True, max_age=charts.cache_ttl())
+        return response
+
+    @action(detail=True)
+    def samples(self, request, pk=None):
+        """Raw samples of the service in ``[since, until)`` (default: the last hour) as parallel arrays."""
+        until = query_datetime(request, 'until') or timezone.now()
+        since = query_datetime(request, 'since') or until - timedelta(hours=1)
+        if not timedelta(0) <= until - since <= MAX_SAMPLES_SPAN:
+            raise ValidationError({'since': f"Expected a range of at most {MAX_SAMPLES_SPAN.days} days."})
+        rows = samples.service_samples(self.get_object().pk, since, until)
+        return Response({
+            't': [round(sample.timestamp.timestamp(), 3) for sample in rows],
+            'success': [sample.success for sample in rows],
+            'response_time': [sample.response_time for sample in rows],
+        })
+
+    @action(detail=False)
+    def sla(self, request):
+        """
+        Availability, downtime, incidents, MTTR, MTBF and latency of every service (or ``?service=<id>,<id>``)
+        in ``[since, until)`` (default: the last 30 days), maintenance windows excluded.
+        """
+        until = query_datetime(request, 'until') or timezone.now()
+        since = query_datetime(request, 'since') or until - DEFAULT_SLA_SPAN
+        if since >= until:
+            raise ValidationError({'since': "Expected a time before until."})
+        service_ids = None
+        if request.query_params.get('service'):
+            try:
+                service_ids = [int(service_id) for service_id in request.query_params['service'].split(',')]
+            except ValueError:
+                raise ValidationError({'service': "Expected comma-separated service IDs."})
+        return Response({
+            'since': since,
+            'until': until,
+            'services': sla.service_sla(since, until, service_ids),
+        })
+
+class CheckResultViewSet(HistoryViewSetMixin, viewsets.ReadOnlyModelViewSet):
+    queryset = CheckResult.objects.select_related('service').order_by('-timestamp', '-id')
     serializer_class = CheckResultSerializer
+    export_fields = (
+        'id', 'service_id', 'service__name', 'timestamp', 'success', 'response_time',
+        'dns_time', 'connect_time', 'tls_time', 'ttfb', 'status_code', 'message',
+    )
 
 class AlertViewSet(viewsets.ModelViewSet):
     queryset = Alert.objects.all().order_by('service__name', 'alert_type')
     serializer_class = AlertSerializer
 
-class AlertLogViewSet(viewsets.ReadOnlyModelViewSet):
-    queryset = AlertLog.objects.all().order_by('-timestamp')
+class AlertLogViewSet(HistoryViewSetMixin, viewsets.ReadOnlyModelViewSet):
+    queryset = AlertLog.objects.select_related('alert__service').order_by('-timestamp', '-id')
     serializer_class = AlertLogSerializer
+    service_lookup = 'alert__service_id'
+    export_fields = (
+        'id', 'alert_id', 'alert__alert_type', 'alert__service_id', 'alert__service__name', 'incident_id', 'timestamp',
+        'success', 'message_sent', 'response_message',
+    )
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        incident = self.request.query_params.get('incident')
+        if incident:
+            if not incident.isdigit():
+                raise ValidationError({'incident': "Expected an incident id."})
+            queryset = queryset.filter(incident_id=incident)
+        return queryset
+
+class IncidentViewSet(HistoryViewSetMixin, viewsets.ReadOnlyModelViewSet):
+    """Outages, newest first; ``since``/``until`` filter on their start and ``?open=true`` keeps the ongoing ones."""
+    queryset = Incident.objects.select_related('service').order_by('-started_at', '-id')
+    serializer_class = IncidentSerializer
+    timestamp_field = 'started_at'
+    export_fields = ('id', 'service_id', 'service__name', 'started_at', 'ended_at', 'failed_probes', 'first_error')
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        is_open = self.request.query_params.get('open')
+        if is_open:
+            if is_open not in ('true', 'false'):
+                raise ValidationError({'open': "Expected true or false."})
+            queryset = queryset.filter(ended_at__isnull=is_open == 'true')
+        return queryset
 
 class MaintenanceWindowViewSet(viewsets.ModelViewSet):
     queryset = MaintenanceWindow.objects.all().order_by('-start_time')
-    serializer_class = MaintenanceWindowSerializer
\ No newline at end of file
+    serializer_class = MaintenanceWindowSerializer
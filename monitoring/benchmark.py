@@ -0,0 +1,310 @@
+"""
+Performance benchmark of the check pipeline and the overview pages.
+
+Drives run_service_check and run_service_check_batch against local
+stand-in HTTP and TCP servers, and renders the status page, a service
+detail page and the dashboard at growing numbers of services. Everything
+runs in the calling process against whatever database is configured; the
+``benchmark`` management command points it at a throwaway test database.
+"""
+import http.server
+import platform
+import socket
+import socketserver
+import subprocess
+import threading
+import time
+from datetime import timedelta
+
+import django
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import connection
+from django.db.models import Sum
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import rollups, samples, status_cache
+from .models import ServiceCheck, CheckResult, SampleBlock
+from .result_sink import result_sink
+from .tasks import run_service_check, run_service_check_batch
+
+DEFAULT_SIZES = (100, 1000, 10000)
+DEFAULT_RESULTS_PER_SERVICE = 24
+DEFAULT_CHECKS = 500
+DEFAULT_REPEAT = 5
+# Share of seeded services that are down, so the pages render both states.
+FAILING_SHARE = 0.1
+
+
+class StandInHTTPHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive, like real HTTP servers
+    # Headers and body go out in separate writes; without this, Nagle plus delayed ACKs add ~40 ms per request.
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInTCPHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        pass # Accept and close
+
+
+class StandInHTTPServer(http.server.ThreadingHTTPServer):
+    # The default backlog of 5 drops SYNs under a concurrent batch, which then retry after a second.
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+class StandInTCPServer(socketserver.ThreadingTCPServer):
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+class StandInServers:
+    """Local HTTP and TCP servers for the checks to probe, run in background threads."""
+
+    def __enter__(self):
+        self.http = StandInHTTPServer(('127.0.0.1', 0), StandInHTTPHandler)
+        self.tcp = StandInTCPServer(('127.0.0.1', 0), StandInTCPHandler)
+        for server in (self.http, self.tcp):
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        for server in (self.http, self.tcp):
+            server.shutdown()
+            server.server_close()
+
+    @property
+    def http_url(self):
+        return f"http://127.0.0.1:{self.http.server_address[1]}/"
+
+    @property
+    def tcp_address(self):
+        return f"127.0.0.1:{self.tcp.server_address[1]}"
+
+
+def seed_services(first, count, servers, results_per_service, now):
+    """
+    Create services ``first .. first + count - 1`` with ``results_per_service`` results over the last 24h.
+
+    Bulk inserts bypass ServiceCheck.save, so no periodic tasks are created.
+    """
+    services = ServiceCheck.objects.bulk_create([
+        ServiceCheck(
+            name=f'benchmark-{number:05d}',
+            check_type='http' if number % 2 else 'tcp',
+            url_or_host=servers.http_url if number % 2 else servers.tcp_address,
+            timeout=5,
+            status_atual='fail' if number % int(1 / FAILING_SHARE) == 0 else 'ok',
+            last_check=now,
+            next_run_at=now + timedelta(days=365), # Keep a running scheduler away from them
+        )
+        for number in range(first, first + count)
+    ], batch_size=1000)
+    if results_per_service:
+        step = timedelta(hours=24) / results_per_service
+        results = [
+            CheckResult(service=service, timestamp=now - step * i, success=service.status_atual == 'ok' or i > 0,
+                        response_time=0.05 + (i % 10) / 100, status_code=200)
+            for service in services for i in range(results_per_service)
+        ]
+        if samples.block_storage_enabled():
+            samples.append_samples(results)
+            results = [result for result in results if not result.success]
+        CheckResult.objects.bulk_create(results, batch_size=5000)
+    return services
+
+
+def build_rollups(now):
+    start = now - timedelta(hours=25)
+    rollups.rollup_raw_results(start, now)
+    rollups.rollup_buckets('1h', start, now)
+    rollups.rollup_buckets('1d', start - timedelta(days=1), now)
+
+
+def latency_summary(seconds):
+    ordered = sorted(seconds)
+    return {
+        'p50_ms': rollups.percentile(ordered, 0.5) * 1000,
+        'p99_ms': rollups.percentile(ordered, 0.99) * 1000,
+        'max_ms': ordered[-1] * 1000,
+    }
+
+
+def bench_run_service_check(service_ids, checks):
+    """Sequential run_service_check calls, as one worker process runs them."""
+    latencies = []
+    with CaptureQueriesContext(connection) as queries:
+        started = time.perf_counter()
+        for i in range(checks):
+            call_started = time.perf_counter()
+            run_service_check(service_ids[i % len(service_ids)])
+            latencies.append(time.perf_counter() - call_started)
+        result_sink.flush()
+        elapsed = time.perf_counter() - started
+    return {
+        'checks': checks,
+        'seconds': elapsed,
+        'checks_per_second': checks / elapsed,
+        'queries_per_check': len(queries) / checks,
+        'latency': latency_summary(latencies),
+    }
+
+
+def bench_run_service_check_batch(service_ids, checks, batch_size=100):
+    """run_service_check_batch over ``checks`` probes in batches of ``batch_size``."""
+    # A batch probes each id once, so no batch may be longer than the list of services.
+    batch_size = min(batch_size, len(service_ids))
+    ids = [service_ids[i % len(service_ids)] for i in range(checks)]
+    batches = [ids[i:i + batch_size] for i in range(0, len(ids), batch_size)]
+    latencies = []
+    with CaptureQueriesContext(connection) as queries:
+        started = time.perf_counter()
+        for batch in batches:
+            call_started = time.perf_counter()
+            run_service_check_batch(batch)
+            latencies.append(time.perf_counter() - call_started)
+        result_sink.flush()
+        elapsed = time.perf_counter() - started
+    return {
+        'checks': checks,
+        'batch_size': batch_size,
+        'seconds': elapsed,
+        'checks_per_second': checks / elapsed,
+        'queries_per_check': len(queries) / checks,
+        'batch_latency': latency_summary(latencies),
+    }
+
+
+def time_request(client, url, repeat, before=None):
+    """Median and worst render time of ``url`` over ``repeat`` requests, and the queries of the last one."""
+    timings = []
+    for _ in range(repeat):
+        if before:
+            before()
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            response = client.get(url)
+            timings.append(time.perf_counter() - started)
+        if response.status_code != 200:
+            raise RuntimeError(f"GET {url} answered {response.status_code}")
+    timings.sort()
+    return {
+        'median_ms': rollups.percentile(timings, 0.5) * 1000,
+        'max_ms': timings[-1] * 1000,
+        'queries': len(queries),
+        'bytes': len(response.content),
+    }
+
+
+def bench_views(client, service_id, repeat):
+    page_cache = caches[getattr(settings, 'BATMON_STATUS_CACHE', status_cache.DEFAULT_STATUS_CACHE)]
+    status_url = reverse('monitoring:status_page')
+    detail_url = reverse('monitoring:service_detail', args=[service_id])
+    chart_url = reverse('monitoring:servicecheck-chart', args=[service_id]) + '?window=7d'
+    return {
+        # Cold renders are what a cache refresh costs; warm hits are what visitors get.
+        'status_page': {
+            'cold': time_request(client, status_url, repeat, before=page_cache.clear),
+            'warm': time_request(client, status_url, repeat),
+        },
+        'service_detail': {
+            'cold': time_request(client, detail_url, repeat, before=page_cache.clear),
+            'warm': time_request(client, detail_url, repeat),
+        },
+        'dashboard': time_request(client, reverse('monitoring:dashboard'), repeat),
+        'chart': {
+            'cold': time_request(client, chart_url, repeat, before=page_cache.clear),
+            'warm': time_request(client, chart_url, repeat),
+        },
+        # Every service over the default 30 days, from the rollups build_rollups wrote.
+        'sla': time_request(client, reverse('monitoring:servicecheck-sla'), repeat),
+    }
+
+
+def storage_summary():
+    """On-disk size (tables, TOAST and indexes) of the raw samples and what they cost per probe, on PostgreSQL."""
+    if connection.vendor != 'postgresql':
+        return None
+    probes = (
+        CheckResult.objects.count() if not samples.block_storage_enabled()
+        else SampleBlock.objects.aggregate(total=Sum('count'))['total'] or 0
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT pg_total_relation_size(%s) + pg_total_relation_size(%s)",
+            [CheckResult._meta.db_table, SampleBlock._meta.db_table],
+        )
+        total_bytes = cursor.fetchone()[0]
+    return {
+        'storage': getattr(settings, 'BATMON_SAMPLE_STORAGE', samples.SAMPLE_STORAGE_ROWS),
+        'probes': probes,
+        'bytes': total_bytes,
+        'bytes_per_probe': total_bytes / probes if probes else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes=DEFAULT_SIZES, results_per_service=DEFAULT_RESULTS_PER_SERVICE, checks=DEFAULT_CHECKS,
+        repeat=DEFAULT_REPEAT, log=print):
+    """Run the whole benchmark and return the report as a JSON-serialisable dict."""
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'started_at': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'host': socket.gethostname(),
+            'results_per_service': results_per_service,
+            'checks': checks,
+            'repeat': repeat,
+        },
+        'pipeline': {},
+        'views': {},
+    }
+    user = get_user_model().objects.create_superuser('benchmark', 'benchmark@example.invalid', None)
+    client = Client()
+    client.force_login(user)
+    now = timezone.now()
+
+    with StandInServers() as servers:
+        seeded = []
+        for size in sorted(sizes):
+            log(f"Seeding {size - len(seeded)} services ({size} in total)...")
+            seeded += seed_services(len(seeded), size - len(seeded), servers, results_per_service, now)
+            build_rollups(now)
+
+            if not report['pipeline']:
+                service_ids = [service.id for service in seeded if service.status_atual == 'ok']
+                log(f"Running {checks} checks through run_service_check...")
+                report['pipeline']['run_service_check'] = bench_run_service_check(service_ids, checks)
+                log(f"Running {checks} checks through run_service_check_batch...")
+                report['pipeline']['run_service_check_batch'] = bench_run_service_check_batch(service_ids, checks)
+
+            log(f"Rendering pages with {size} services...")
+            report['views'][str(size)] = bench_views(client, seeded[0].id, repeat)
+
+    report['storage'] = storage_summary()
+    report['meta']['finished_at'] = timezone.now().isoformat()
+    return report
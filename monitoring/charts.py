@@ -0,0 +1,122 @@
+"""
+Chart data for the status page, the service detail pages and the dashboard.
+
+Pages do not embed their series: each chart fetches
+``/api/servicechecks/<id>/chart/?window=<name>`` once it scrolls into view.
+A series is read from the rollups at the window's resolution, downsampled to
+at most BATMON_CHART_MAX_POINTS points with Largest-Triangle-Three-Buckets
+(which keeps the spikes and dips a plain stride would drop), and cached per
+service and window for BATMON_CHART_CACHE_TTL seconds in the status page
+cache, so every web process serves the same copy.
+"""
+import logging
+from datetime import timedelta
+
+import redis
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+
+from . import status_cache
+from .models import CheckResultRollup
+from .rollups import bucket_start
+
+logger = logging.getLogger(__name__)
+
+# Window name -> (span, rollup resolution the series is read from)
+CHART_WINDOWS = {
+    '24h': (timedelta(hours=24), '1m'),
+    '7d': (timedelta(days=7), '1h'),
+    '30d': (timedelta(days=30), '1h'),
+}
+DEFAULT_CHART_WINDOW = '24h'
+DEFAULT_CHART_MAX_POINTS = 300
+DEFAULT_CHART_CACHE_TTL = 60
+
+CHART_KEY = 'chart:{}:{}'
+
+
+def _cache():
+    return caches[getattr(settings, 'BATMON_STATUS_CACHE', status_cache.DEFAULT_STATUS_CACHE)]
+
+
+def cache_ttl():
+    return getattr(settings, 'BATMON_CHART_CACHE_TTL', DEFAULT_CHART_CACHE_TTL)
+
+
+def lttb(points, threshold):
+    """
+    Downsample ``[(x, y)]``, ordered by x, to ``threshold`` points with Largest-Triangle-Three-Buckets.
+
+    The first and last points are kept; from each of the ``threshold - 2``
+    buckets in between, the point forming the largest triangle with the
+    previously kept point and the average of the next bucket is kept.
+    """
+    if threshold >= len(points) or threshold < 3:
+        return list(points)
+    every = (len(points) - 2) / (threshold - 2)
+    sampled = [points[0]]
+    previous = points[0]
+    for i in range(threshold - 2):
+        next_start = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, len(points))
+        next_bucket = points[next_start:next_end]
+        average_x = sum(x for x, _ in next_bucket) / len(next_bucket)
+        average_y = sum(y for _, y in next_bucket) / len(next_bucket)
+
+        best, best_area = None, -1
+        for point in points[int(i * every) + 1:next_start]:
+            area = abs(
+                (previous[0] - average_x) * (point[1] - previous[1])
+                - (previous[0] - point[0]) * (average_y - previous[1])
+            )
+            if area > best_area:
+                best, best_area = point, area
+        sampled.append(best)
+        previous = best
+    sampled.append(points[-1])
+    return sampled
+
+
+def _series(points, digits):
+    # Epoch seconds and rounded values keep the payload small.
+    return {'t': [x for x, _ in points], 'v': [round(y, digits) for _, y in points]}
+
+
+def build_chart_data(service_id, window):
+    """Response time and uptime series of ``service_id`` over ``window``, downsampled, and cache them."""
+    span, resolution = CHART_WINDOWS[window]
+    since = bucket_start(timezone.now() - span, resolution)
+    rows = CheckResultRollup.objects.filter(
+        service_id=service_id, resolution=resolution, bucket_start__gte=since,
+    ).order_by('bucket_start').values_list('bucket_start', 'count', 'successes', 'response_time_count', 'response_time_sum')
+
+    response_times, uptimes = [], []
+    for start, count, successes, response_time_count, response_time_sum in rows:
+        moment = int(start.timestamp())
+        if response_time_count:
+            response_times.append((moment, response_time_sum / response_time_count))
+        if count:
+            uptimes.append((moment, successes / count))
+
+    max_points = getattr(settings, 'BATMON_CHART_MAX_POINTS', DEFAULT_CHART_MAX_POINTS)
+    data = {
+        'window': window,
+        'resolution': resolution,
+        'response_time': _series(lttb(response_times, max_points), 4),
+        'uptime': _series(lttb(uptimes, max_points), 3),
+    }
+    try:
+        _cache().set(CHART_KEY.format(service_id, window), data, timeout=cache_ttl())
+    except (redis.RedisError, OSError) as e:
+        logger.warning(f"Could not store chart data of service {service_id}: {e}")
+    return data
+
+
+def cached_chart_data(service_id, window):
+    """The cached series of ``service_id`` over ``window``, or None."""
+    try:
+        return _cache().get(CHART_KEY.format(service_id, window))
+    except (redis.RedisError, OSError) as e:
+        logger.warning(f"Could not read chart data of service {service_id}: {e}")
+        return None
@@ -0,0 +1,227 @@
+"""
+Per-worker cache of host name lookups, shared by every probe type.
+
+Many checks point at the same few hosts, so each worker process keeps the
+addresses it resolved until their DNS TTL runs out (capped by
+BATMON_DNS_CACHE_MAX_TTL) instead of asking the resolver on every probe.
+Names that do not exist are cached too, for BATMON_DNS_NEGATIVE_TTL
+seconds. Temporary resolver failures are not cached.
+
+With dnspython installed, lookups ask the DNS servers directly, which gives
+the records' TTL and lets the ProbeEngine resolve without blocking a thread
+of the event loop's executor. Names DNS does not know (e.g. from /etc/hosts)
+fall back to the system resolver, like every lookup without dnspython; their
+TTL is unknown, so they are kept for BATMON_DNS_CACHE_TTL seconds.
+Concurrent async lookups of one host share a single query.
+"""
+import asyncio
+import functools
+import ipaddress
+import logging
+import os
+import socket
+import time
+
+from django.conf import settings
+
+from . import metrics
+
+try:
+    import dns.asyncresolver
+    import dns.exception
+    import dns.resolver
+except ImportError: # dnspython is optional
+    dns = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DNS_CACHE_TTL = 60
+DEFAULT_DNS_CACHE_MAX_TTL = 300
+DEFAULT_DNS_NEGATIVE_TTL = 30
+
+# getaddrinfo errors meaning the name has no address, as opposed to the resolver failing.
+NEGATIVE_ERRORS = {socket.EAI_NONAME, getattr(socket, 'EAI_NODATA', socket.EAI_NONAME)}
+
+
+def _ttl(setting, default):
+    return getattr(settings, setting, default)
+
+
+def _literal(host):
+    try:
+        return [str(ipaddress.ip_address(host))]
+    except ValueError:
+        return None
+
+
+def _from_addrinfo(host, addresses):
+    # Keep order, drop duplicates (one entry per socket type/protocol pair).
+    resolved = []
+    for _, _, _, _, sockaddr in addresses:
+        if sockaddr[0] not in resolved:
+            resolved.append(sockaddr[0])
+    if not resolved:
+        raise socket.gaierror(socket.EAI_NONAME, f"No address found for {host}")
+    return resolved
+
+
+def _from_answers(answers):
+    """``(addresses, ttl)`` of the A and AAAA answers, or None if there were none."""
+    addresses = [record.address for answer in answers for record in answer]
+    if not addresses:
+        return None
+    return addresses, min(answer.rrset.ttl for answer in answers)
+
+
+class DNSCache:
+    """Resolved addresses (or the absence of any) per host name, until they expire."""
+
+    def __init__(self):
+        # host -> (expires_at, addresses or None, gaierror arguments or None)
+        self._entries = {}
+        # host -> in-flight asyncio lookup, shared by concurrent callers on the same loop
+        self._pending = {}
+
+    def clear(self):
+        self._entries.clear()
+        self._pending.clear()
+
+    def _cached(self, host):
+        entry = self._entries.get(host)
+        if entry is None or entry[0] <= time.monotonic():
+            metrics.DNS_LOOKUPS.inc(outcome='miss')
+            return None
+        metrics.DNS_LOOKUPS.inc(outcome='hit')
+        _, addresses, error = entry
+        if error is not None:
+            raise socket.gaierror(*error)
+        return addresses
+
+    def _store(self, host, addresses, ttl):
+        ttl = min(ttl, _ttl('BATMON_DNS_CACHE_MAX_TTL', DEFAULT_DNS_CACHE_MAX_TTL))
+        if ttl > 0:
+            self._entries[host] = (time.monotonic() + ttl, addresses, None)
+        return addresses
+
+    def _store_error(self, host, error):
+        ttl = _ttl('BATMON_DNS_NEGATIVE_TTL', DEFAULT_DNS_NEGATIVE_TTL)
+        if error.errno in NEGATIVE_ERRORS and ttl > 0:
+            self._entries[host] = (time.monotonic() + ttl, None, (error.errno, error.strerror))
+
+    def resolve(self, host, timeout=None):
+        """
+        Addresses of ``host``, from the cache or the resolver.
+
+        Raises socket.gaierror if it has none, TimeoutError if DNS did not
+        answer within ``timeout`` seconds.
+        """
+        literal = _literal(host)
+        if literal is not None:
+            return literal
+        addresses = self._cached(host)
+        if addresses is not None:
+            return addresses
+        try:
+            if dns is not None:
+                resolved = self._query(host, timeout)
+                if resolved is not None:
+                    return self._store(host, *resolved)
+            return self._store(host, _from_addrinfo(host, socket.getaddrinfo(host, None, type=socket.SOCK_STREAM)),
+                               _ttl('BATMON_DNS_CACHE_TTL', DEFAULT_DNS_CACHE_TTL))
+        except socket.gaierror as e:
+            self._store_error(host, e)
+            raise
+
+    async def async_resolve(self, host, timeout=None):
+        """Async counterpart of resolve."""
+        literal = _literal(host)
+        if literal is not None:
+            return literal
+        addresses = self._cached(host)
+        if addresses is not None:
+            return addresses
+        loop = asyncio.get_running_loop()
+        pending = self._pending.get(host)
+        if pending is None or pending.get_loop() is not loop:
+            pending = self._pending[host] = loop.create_task(self._async_lookup(host, timeout))
+            pending.add_done_callback(functools.partial(self._forget_pending, host))
+        # Shielded so that one caller timing out does not cancel the lookup the others wait for.
+        return await asyncio.shield(pending)
+
+    def _forget_pending(self, host, task):
+        if self._pending.get(host) is task:
+            del self._pending[host]
+        if not task.cancelled():
+            task.exception() # Retrieved, even if every caller gave up waiting
+
+    async def _async_lookup(self, host, timeout):
+        try:
+            if dns is not None:
+                resolved = await self._async_query(host, timeout)
+                if resolved is not None:
+                    return self._store(host, *resolved)
+            addresses = await asyncio.get_running_loop().getaddrinfo(host, None, type=socket.SOCK_STREAM)
+            return self._store(host, _from_addrinfo(host, addresses), _ttl('BATMON_DNS_CACHE_TTL', DEFAULT_DNS_CACHE_TTL))
+        except socket.gaierror as e:
+            self._store_error(host, e)
+            raise
+
+    def _query(self, host, timeout):
+        resolver = dns.resolver.get_default_resolver()
+        answers = []
+        try:
+            for rdtype in ('A', 'AAAA'):
+                try:
+                    answers.append(resolver.resolve(host, rdtype, search=True, lifetime=timeout))
+                except dns.resolver.NoAnswer:
+                    pass
+        except dns.exception.Timeout as e:
+            raise TimeoutError(f"Resolving {host} timed out") from e
+        except dns.exception.DNSException as e:
+            logger.debug(f"DNS lookup of {host} failed, asking the system resolver: {e}")
+            return None
+        return _from_answers(answers)
+
+    async def _async_query(self, host, timeout):
+        resolver = dns.asyncresolver.get_default_resolver()
+        answers = []
+        try:
+            for rdtype in ('A', 'AAAA'):
+                try:
+                    answers.append(await resolver.resolve(host, rdtype, search=True, lifetime=timeout))
+                except dns.resolver.NoAnswer:
+                    pass
+        except dns.exception.Timeout as e:
+            raise TimeoutError(f"Resolving {host} timed out") from e
+        except dns.exception.DNSException as e:
+            logger.debug(f"DNS lookup of {host} failed, asking the system resolver: {e}")
+            return None
+        return _from_answers(answers)
+
+
+_dns_cache = None
+
+
+def get_dns_cache():
+    """The worker process's DNS cache."""
+    global _dns_cache
+    if _dns_cache is None:
+        _dns_cache = DNSCache()
+    return _dns_cache
+
+
+def _forget_cache():
+    # In-flight lookups belong to the parent's event loop.
+    global _dns_cache
+    _dns_cache = None
+
+
+os.register_at_fork(after_in_child=_forget_cache)
+
+
+def resolve(host, timeout=None):
+    return get_dns_cache().resolve(host, timeout)
+
+
+async def async_resolve(host, timeout=None):
+    return await get_dns_cache().async_resolve(host, timeout)
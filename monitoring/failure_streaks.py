@@ -0,0 +1,56 @@
+"""
+Rebuild of the per-service failure streak counters from CheckResult.
+
+The result sink keeps ServiceCheck.consecutive_failures and alerted_failures
+current as results are written; this recomputes them from the stored
+history, for the deploy that introduces them or after results were written
+behind the sink's back.
+"""
+from django.apps import apps as global_apps
+
+
+def service_streak(service, apps=global_apps):
+    """``(consecutive_failures, alerted_failures)`` of ``service`` according to its stored history."""
+    CheckResult = apps.get_model('monitoring', 'CheckResult')
+    AlertLog = apps.get_model('monitoring', 'AlertLog')
+
+    failures = CheckResult.objects.filter(service_id=service.pk, success=False)
+    last_success = (
+        CheckResult.objects.filter(service_id=service.pk, success=True)
+        .order_by('-timestamp').values_list('timestamp', flat=True).first()
+    )
+    if last_success is not None:
+        failures = failures.filter(timestamp__gt=last_success)
+    consecutive_failures = failures.count()
+    if not consecutive_failures:
+        return 0, 0
+
+    # The streak counts as alerted if a 'fails X times' alert it reached was delivered since it began.
+    streak_start = failures.order_by('timestamp').values_list('timestamp', flat=True).first()
+    alerted = AlertLog.objects.filter(
+        alert__service_id=service.pk, alert__trigger='on_fail_x_times',
+        alert__trigger_value__lte=consecutive_failures, success=True, timestamp__gte=streak_start,
+    ).exists()
+    return consecutive_failures, consecutive_failures if alerted else 0
+
+
+def rebuild_failure_streaks(service_ids=None, apps=global_apps):
+    """
+    Recompute the failure streak of every service (or of ``service_ids``).
+
+    Also usable from a data migration by passing its ``apps``. Returns the
+    number of services whose counters changed.
+    """
+    ServiceCheck = apps.get_model('monitoring', 'ServiceCheck')
+    services = ServiceCheck.objects.only('consecutive_failures', 'alerted_failures').order_by('pk')
+    if service_ids is not None:
+        services = services.filter(pk__in=service_ids)
+
+    changed = []
+    for service in services.iterator():
+        streak = service_streak(service, apps)
+        if streak != (service.consecutive_failures, service.alerted_failures):
+            service.consecutive_failures, service.alerted_failures = streak
+            changed.append(service)
+    ServiceCheck.objects.bulk_update(changed, ['consecutive_failures', 'alerted_failures'], batch_size=500)
+    return len(changed)
@@ -6,7 +6,8 @@ class ServiceCheckForm(forms.ModelForm):
     class Meta:
         model = ServiceCheck
         fields = [
-            'name', 'url_or_host', 'check_type', 'interval', 'timeout'
+            'name', 'url_or_host', 'check_type', 'interval', 'timeout', 'active',
+            'adaptive_schedule', 'recheck_interval', 'max_interval', 'flap_threshold',
         ]
 
 class AlertForm(forms.ModelForm):
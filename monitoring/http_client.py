@@ -0,0 +1,253 @@
+"""
+Pooled HTTP clients for the HTTP checks.
+
+Each worker process keeps one ``httpx.Client`` (for run_service_check) and
+one ``httpx.AsyncClient`` (for the ProbeEngine's event loop), so repeated
+checks of a host reuse kept-alive connections instead of paying a new TCP
+and TLS handshake every time. Every request also records how long each
+phase took: name resolution, TCP connect, TLS handshake and time to first
+byte. Phases that did not happen (e.g. connect on a reused connection) are
+left as None. Host names are looked up through the worker's DNS cache, and
+the reported response time leaves the lookup out.
+"""
+import asyncio
+import contextvars
+import os
+import socket
+import time
+
+import httpcore
+import httpx
+from django.conf import settings
+
+from . import dns_cache
+
+DEFAULT_HTTP_MAX_CONNECTIONS = 500
+DEFAULT_HTTP_MAX_CONNECTIONS_PER_HOST = 10
+DEFAULT_HTTP_KEEPALIVE = True
+DEFAULT_HTTP_KEEPALIVE_EXPIRY = 30.0
+
+# Timings of the request running in the current thread or asyncio task.
+_current_timings = contextvars.ContextVar('batmon_http_timings', default=None)
+
+
+class PhaseTimings:
+    """Phase durations of one HTTP check, collected from httpcore trace events."""
+
+    def __init__(self):
+        self.dns = None
+        self.connect = None
+        self.tls = None
+        self.ttfb = None
+        self._started = {}
+
+    def record_dns(self, seconds):
+        self.dns = (self.dns or 0) + seconds
+
+    def on_event(self, event_name, info):
+        # e.g. 'connection.connect_tcp.started' or 'http11.receive_response_headers.complete'
+        _, phase, stage = event_name.rsplit('.', 2)
+        now = time.perf_counter()
+        if stage == 'started':
+            self._started[phase] = now
+            return
+        if stage != 'complete' or phase not in self._started:
+            return
+        if phase == 'connect_tcp':
+            # The resolving backend looks the host up inside connect_tcp.
+            self.connect = now - self._started[phase] - (self.dns or 0)
+        elif phase == 'start_tls':
+            self.tls = now - self._started[phase]
+        elif phase == 'receive_response_headers' and 'send_request_headers' in self._started:
+            self.ttfb = now - self._started['send_request_headers']
+
+    def trace(self, event_name, info):
+        self.on_event(event_name, info)
+
+    async def atrace(self, event_name, info):
+        self.on_event(event_name, info)
+
+    def as_result(self):
+        return {
+            'dns_time': self.dns,
+            'connect_time': self.connect,
+            'tls_time': self.tls,
+            'ttfb': self.ttfb,
+        }
+
+
+def _record_dns(started):
+    timings = _current_timings.get()
+    if timings is not None:
+        timings.record_dns(time.perf_counter() - started)
+
+
+class ResolvingBackend(httpcore.NetworkBackend):
+    """
+    Network backend that resolves the host itself (through the DNS cache)
+    before connecting, so name resolution is timed apart from the TCP connect.
+
+    TLS still verifies and sends SNI for the original host name.
+    """
+
+    def __init__(self, backend=None):
+        self._backend = backend or httpcore.SyncBackend()
+
+    def resolve(self, host, port, timeout=None):
+        started = time.perf_counter()
+        try:
+            return dns_cache.resolve(host, timeout)
+        except TimeoutError as e:
+            raise httpcore.ConnectTimeout(str(e)) from e
+        except socket.gaierror as e:
+            raise httpcore.ConnectError(f"Could not resolve {host}: {e}") from e
+        finally:
+            _record_dns(started)
+
+    def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        addresses = self.resolve(host, port, timeout)
+        if not addresses:
+            raise httpcore.ConnectError(f"No addresses for {host}")
+        last_error = None
+        for address in addresses:
+            try:
+                return self._backend.connect_tcp(address, port, timeout, local_address, socket_options)
+            except httpcore.ConnectError as e:
+                last_error = e
+        raise last_error
+
+    def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        return self._backend.connect_unix_socket(path, timeout, socket_options)
+
+    def sleep(self, seconds):
+        self._backend.sleep(seconds)
+
+
+class AsyncResolvingBackend(httpcore.AsyncNetworkBackend):
+    """Async counterpart of ResolvingBackend."""
+
+    def __init__(self, backend=None):
+        self._backend = backend or httpcore.AnyIOBackend()
+
+    async def resolve(self, host, port, timeout=None):
+        started = time.perf_counter()
+        try:
+            return await asyncio.wait_for(dns_cache.async_resolve(host, timeout), timeout)
+        except asyncio.TimeoutError as e: # Also raised by the cache when DNS does not answer
+            raise httpcore.ConnectTimeout(f"Resolving {host} timed out") from e
+        except socket.gaierror as e:
+            raise httpcore.ConnectError(f"Could not resolve {host}: {e}") from e
+        finally:
+            _record_dns(started)
+
+    async def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        addresses = await self.resolve(host, port, timeout)
+        if not addresses:
+            raise httpcore.ConnectError(f"No addresses for {host}")
+        last_error = None
+        for address in addresses:
+            try:
+                return await self._backend.connect_tcp(address, port, timeout, local_address, socket_options)
+            except httpcore.ConnectError as e:
+                last_error = e
+        raise last_error
+
+    async def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        return await self._backend.connect_unix_socket(path, timeout, socket_options)
+
+    async def sleep(self, seconds):
+        await self._backend.sleep(seconds)
+
+
+class HTTPTransport(httpx.HTTPTransport):
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # httpx does not expose httpcore's network_backend option.
+        self._pool._network_backend = ResolvingBackend(self._pool._network_backend)
+
+
+class AsyncHTTPTransport(httpx.AsyncHTTPTransport):
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._pool._network_backend = AsyncResolvingBackend(self._pool._network_backend)
+
+
+def max_connections_per_host():
+    return getattr(settings, 'BATMON_HTTP_MAX_CONNECTIONS_PER_HOST', DEFAULT_HTTP_MAX_CONNECTIONS_PER_HOST)
+
+
+def _limits():
+    max_connections = getattr(settings, 'BATMON_HTTP_MAX_CONNECTIONS', DEFAULT_HTTP_MAX_CONNECTIONS)
+    keepalive = getattr(settings, 'BATMON_HTTP_KEEPALIVE', DEFAULT_HTTP_KEEPALIVE)
+    return httpx.Limits(
+        max_connections=max_connections,
+        # 0 closes every connection once its response has been read.
+        max_keepalive_connections=max_connections if keepalive else 0,
+        keepalive_expiry=getattr(settings, 'BATMON_HTTP_KEEPALIVE_EXPIRY', DEFAULT_HTTP_KEEPALIVE_EXPIRY),
+    )
+
+
+_client = None
+_async_client = None
+
+
+def get_http_client():
+    """The worker process's pooled synchronous client."""
+    global _client
+    if _client is None:
+        _client = httpx.Client(transport=HTTPTransport(limits=_limits()), follow_redirects=True)
+    return _client
+
+
+def get_async_http_client():
+    """
+    The worker process's pooled async client.
+
+    Its connections belong to the event loop they were opened on, so it
+    must only be used from the ProbeEngine's long-lived loop.
+    """
+    global _async_client
+    if _async_client is None:
+        _async_client = httpx.AsyncClient(transport=AsyncHTTPTransport(limits=_limits()), follow_redirects=True)
+    return _async_client
+
+
+def _forget_clients():
+    # Connections inherited from the parent are shared sockets; never reuse them.
+    global _client, _async_client
+    _client = None
+    _async_client = None
+
+
+os.register_at_fork(after_in_child=_forget_clients)
+
+
+def _elapsed(started, timings):
+    # Resolver slowness is reported as dns_time, not as the service's response time.
+    return time.perf_counter() - started - (timings.dns or 0)
+
+
+def timed_get(client, url, timeout):
+    """GET ``url`` and return ``(response, seconds excluding name resolution, PhaseTimings)``."""
+    timings = PhaseTimings()
+    token = _current_timings.set(timings)
+    started = time.perf_counter()
+    try:
+        response = client.get(url, timeout=timeout, extensions={'trace': timings.trace})
+    finally:
+        _current_timings.reset(token)
+    return response, _elapsed(started, timings), timings
+
+
+async def async_timed_get(client, url, timeout):
+    """Async counterpart of timed_get."""
+    timings = PhaseTimings()
+    token = _current_timings.set(timings)
+    started = time.perf_counter()
+    try:
+        response = await client.get(url, timeout=timeout, extensions={'trace': timings.atrace})
+    finally:
+        _current_timings.reset(token)
+    return response, _elapsed(started, timings), timings
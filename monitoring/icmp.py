@@ -0,0 +1,295 @@
+"""
+In-process ICMP echo ("ping") for the ping checks.
+
+Uses an unprivileged ICMP datagram socket where the kernel allows it
+(Linux: net.ipv4.ping_group_range) and falls back to a raw socket, which
+needs root or CAP_NET_RAW. The reported round-trip time is measured from
+send to reply, without process start-up noise. IPv4 only; callers fall back
+to the system ``ping`` binary when no ICMP socket can be opened or the host
+has no IPv4 address.
+"""
+import asyncio
+import ipaddress
+import logging
+import os
+import random
+import re
+import select
+import socket
+import struct
+import time
+
+from . import dns_cache
+
+logger = logging.getLogger(__name__)
+
+ICMP_ECHO_REPLY = 0
+ICMP_DEST_UNREACHABLE = 3
+ICMP_ECHO_REQUEST = 8
+ICMP_TIME_EXCEEDED = 11
+
+ICMP_ERRORS = {
+    ICMP_DEST_UNREACHABLE: "Destination unreachable",
+    ICMP_TIME_EXCEEDED: "Time to live exceeded",
+}
+
+PING_TIME_RE = re.compile(r'time[=<]([\d.]+) ?ms')
+
+_HEADER = struct.Struct('!BBHHH')
+PAYLOAD = b'batmon-ping-----' * 2 # 32 bytes, like most ping tools' default minimum
+RECEIVE_BUFFER_SIZE = 4 * 1024 * 1024 # The kernel caps this at net.core.rmem_max
+
+
+class ICMPUnavailable(OSError):
+    """Neither a datagram nor a raw ICMP socket could be opened."""
+
+
+class PingError(Exception):
+    """The host answered with an ICMP error, or could not be pinged at all."""
+
+
+class NoIPv4Address(PingError):
+    """The host resolves, but only to non-IPv4 addresses."""
+
+
+def checksum(data):
+    if len(data) % 2:
+        data += b'\0'
+    total = sum(struct.unpack(f'!{len(data) // 2}H', data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+def echo_request(identifier, sequence, payload=PAYLOAD):
+    header = _HEADER.pack(ICMP_ECHO_REQUEST, 0, 0, identifier, sequence)
+    return _HEADER.pack(ICMP_ECHO_REQUEST, 0, checksum(header + payload), identifier, sequence) + payload
+
+
+def _first_ipv4(host, addresses):
+    for address in addresses:
+        if ipaddress.ip_address(address).version == 4:
+            return address
+    raise NoIPv4Address(f"{host} has no IPv4 address")
+
+
+def resolve(host):
+    """First IPv4 address of ``host``, through the worker's DNS cache."""
+    try:
+        addresses = dns_cache.resolve(host)
+    except (socket.gaierror, TimeoutError) as e:
+        raise PingError(f"Could not resolve {host}: {e}") from e
+    return _first_ipv4(host, addresses)
+
+
+async def async_resolve(host):
+    try:
+        addresses = await dns_cache.async_resolve(host)
+    except (socket.gaierror, TimeoutError) as e:
+        raise PingError(f"Could not resolve {host}: {e}") from e
+    return _first_ipv4(host, addresses)
+
+
+class ICMPSocket:
+    """
+    A non-blocking ICMP socket that sends echo requests and parses what comes back.
+
+    With a datagram socket the kernel picks the echo identifier and only
+    delivers this socket's replies; with a raw socket every ICMP packet
+    arrives (IP header included) and replies are matched on our identifier.
+    """
+
+    # Set once neither socket type could be opened, so later checks fall back without retrying.
+    unavailable = False
+
+    def __init__(self):
+        if self.unavailable:
+            raise ICMPUnavailable("No ICMP socket available.")
+        try:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+            self.raw = False
+        except PermissionError:
+            try:
+                self.sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+            except PermissionError as e:
+                type(self).unavailable = True
+                logger.warning(
+                    "No ICMP socket available; ping checks fall back to the ping command. Allow unprivileged "
+                    "ping (net.ipv4.ping_group_range) or grant CAP_NET_RAW to use the built-in engine."
+                )
+                raise ICMPUnavailable("No ICMP socket available.") from e
+            self.raw = True
+        # Replies to many concurrent pings (and, on raw sockets, every other ICMP packet) queue up here.
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_SIZE)
+        self.sock.setblocking(False)
+        self.identifier = random.getrandbits(16)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def packet(self, sequence):
+        return echo_request(self.identifier, sequence)
+
+    def send(self, address, sequence):
+        self.sock.sendto(self.packet(sequence), (address, 0))
+
+    def receive(self):
+        """
+        Read every pending packet and return ``[(sequence, source, error)]`` for ours.
+
+        ``error`` is None for an echo reply, or a description of the ICMP
+        error that ``source`` sent back for one of our requests.
+        """
+        replies = []
+        while True:
+            try:
+                data, (source, _) = self.sock.recvfrom(2048)
+            except (BlockingIOError, InterruptedError):
+                return replies
+            reply = self._parse(data)
+            if reply is not None:
+                sequence, error = reply
+                replies.append((sequence, source, error))
+
+    def _parse(self, data):
+        if self.raw:
+            data = data[(data[0] & 0x0F) * 4:] # Strip the IP header
+        if len(data) < _HEADER.size:
+            return None
+        icmp_type, _, _, identifier, sequence = _HEADER.unpack_from(data)
+        if icmp_type == ICMP_ECHO_REPLY:
+            # Datagram sockets only see their own replies, with the identifier the kernel chose.
+            if self.raw and identifier != self.identifier:
+                return None
+            return sequence, None
+        if icmp_type in ICMP_ERRORS and self.raw:
+            # The error quotes the offending IP header and the first 8 bytes of our request.
+            inner = data[_HEADER.size:]
+            if len(inner) < 20:
+                return None
+            inner = inner[(inner[0] & 0x0F) * 4:]
+            if len(inner) < _HEADER.size:
+                return None
+            inner_type, _, _, identifier, sequence = _HEADER.unpack_from(inner)
+            if inner_type == ICMP_ECHO_REQUEST and identifier == self.identifier:
+                return sequence, ICMP_ERRORS[icmp_type]
+        return None
+
+
+def parse_ping_output(stdout):
+    """
+    ``(rtt_seconds, summary_line)`` from the output of the system ``ping``.
+
+    Used by the subprocess fallback so it stores one line, not the whole transcript.
+    """
+    for line in stdout.splitlines():
+        match = PING_TIME_RE.search(line)
+        if match:
+            return float(match.group(1)) / 1000, line.strip()
+    return None, stdout.strip().splitlines()[-1] if stdout.strip() else ''
+
+
+def ping(host, timeout):
+    """Send one echo request to ``host`` and return the round-trip time in seconds."""
+    address = resolve(host)
+    with ICMPSocket() as icmp:
+        sequence = 1
+        sent_at = time.perf_counter()
+        icmp.send(address, sequence)
+        deadline = sent_at + timeout
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                raise TimeoutError
+            readable, _, _ = select.select([icmp], [], [], remaining)
+            if not readable:
+                continue
+            for reply_sequence, source, error in icmp.receive():
+                if reply_sequence != sequence:
+                    continue
+                if error:
+                    raise PingError(f"{error} (from {source})")
+                if source == address:
+                    return time.perf_counter() - sent_at
+
+
+class AsyncPinger:
+    """
+    Pings many hosts concurrently over a single ICMP socket.
+
+    Each in-flight request gets its own sequence number; the socket's
+    reader callback resolves the waiting future when its reply arrives.
+    """
+
+    def __init__(self, loop=None):
+        self.loop = loop or asyncio.get_running_loop()
+        self.icmp = ICMPSocket()
+        self._waiters = {}
+        self._sequence = 0
+        self.loop.add_reader(self.icmp.fileno(), self._on_readable)
+
+    def close(self):
+        self.loop.remove_reader(self.icmp.fileno())
+        self.icmp.close()
+
+    def _next_sequence(self):
+        for _ in range(0x10000):
+            self._sequence = (self._sequence + 1) & 0xFFFF
+            if self._sequence not in self._waiters:
+                return self._sequence
+        raise PingError("Too many pings in flight.")
+
+    def _on_readable(self):
+        now = time.perf_counter()
+        for sequence, source, error in self.icmp.receive():
+            waiter = self._waiters.get(sequence)
+            if waiter is None or waiter[1].done():
+                continue
+            address, future, sent_at = waiter
+            if error:
+                future.set_exception(PingError(f"{error} (from {source})"))
+            elif source == address:
+                future.set_result(now - sent_at)
+
+    async def ping(self, host, timeout):
+        """Async counterpart of ``ping``."""
+        address = await async_resolve(host)
+        sequence = self._next_sequence()
+        future = self.loop.create_future()
+        self._waiters[sequence] = (address, future, time.perf_counter())
+        try:
+            await self.loop.sock_sendto(self.icmp.sock, self.icmp.packet(sequence), (address, 0))
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            del self._waiters[sequence]
+
+
+_async_pinger = None
+
+
+def get_async_pinger():
+    """The AsyncPinger of the running event loop (one per process, like its loop)."""
+    global _async_pinger
+    loop = asyncio.get_running_loop()
+    if _async_pinger is None or _async_pinger.loop is not loop:
+        if _async_pinger is not None:
+            _async_pinger.icmp.close() # Its loop is gone
+        _async_pinger = AsyncPinger(loop)
+    return _async_pinger
+
+
+def _forget_pinger():
+    global _async_pinger
+    _async_pinger = None
+
+
+os.register_at_fork(after_in_child=_forget_pinger)
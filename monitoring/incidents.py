@@ -0,0 +1,106 @@
+"""
+Outages recorded as Incidents when a service's status changes.
+
+The result sink hands every flush's transitions (failed checks, and
+successful ones that follow another status) to record(), in the flush's
+transaction. A failure that starts a streak opens an Incident with its time
+and message, later failures of the streak count towards its failed_probes,
+and the next success closes it. A success following a success writes
+nothing. When an outage started and how long it lasted is then a lookup on
+the incident indexes instead of a scan of the results.
+
+Maintenance does not close an incident: the check is not probed then, so it
+stays open until a probe succeeds.
+"""
+from django.apps import apps as global_apps
+from django.db.models import OuterRef, Subquery
+
+from .models import Incident, ServiceCheck
+
+
+def record(transitions):
+    """
+    Open, extend and close the incidents of the buffered ``transitions`` (PendingResults, oldest first).
+
+    The open incidents of the services involved are locked while they are
+    updated, so concurrent flushes cannot both open one.
+    """
+    by_service = {}
+    for pending in transitions:
+        by_service.setdefault(pending.service_check.id, []).append(pending)
+    if not by_service:
+        return
+
+    open_incidents = {
+        incident.service_id: incident
+        for incident in Incident.objects.select_for_update().filter(service_id__in=by_service, ended_at__isnull=True).order_by()
+    }
+    changed, created = [], []
+    for service_id, results in by_service.items():
+        incident = open_incidents.get(service_id)
+        for pending in results:
+            check_result = pending.check_result
+            if check_result.success:
+                if incident is not None:
+                    incident.ended_at = check_result.timestamp
+                    incident = None
+                continue
+            if incident is not None and pending.consecutive_failures == 1:
+                # A success never reached the sink (e.g. it was written behind its back); start afresh.
+                incident.ended_at = check_result.timestamp
+                incident = None
+            if incident is None:
+                incident = Incident(service_id=service_id, started_at=check_result.timestamp,
+                                    first_error=check_result.message, failed_probes=0)
+                created.append(incident)
+            incident.failed_probes += 1
+        if service_id in open_incidents:
+            changed.append(open_incidents[service_id])
+
+    # Closed before the new ones are inserted, for unique_open_incident.
+    Incident.objects.bulk_update(changed, ['ended_at', 'failed_probes'], batch_size=500)
+    Incident.objects.bulk_create(created, batch_size=500)
+
+
+def latest_incident_ids(service_ids):
+    """``{service_id: incident_id}`` of each service's latest incident (its open one, if any), in one query."""
+    latest = Incident.objects.filter(service=OuterRef('pk')).order_by('-started_at').values('id')[:1]
+    rows = ServiceCheck.objects.filter(pk__in=service_ids).annotate(incident_id=Subquery(latest))
+    return {service_id: incident_id for service_id, incident_id in rows.values_list('pk', 'incident_id') if incident_id}
+
+
+def rebuild_incidents(service_ids=None, apps=global_apps):
+    """
+    Replace the incidents of every service (or of ``service_ids``) with the ones in their stored CheckResults.
+
+    Works from the rows of either sample storage, since failures and
+    recoveries always have one. Also usable from a data migration by passing
+    its ``apps``. Returns the number of incidents written.
+    """
+    CheckResult = apps.get_model('monitoring', 'CheckResult')
+    Incident = apps.get_model('monitoring', 'Incident')
+
+    incidents = Incident.objects.all()
+    results = CheckResult.objects.all()
+    if service_ids is not None:
+        incidents = incidents.filter(service_id__in=service_ids)
+        results = results.filter(service_id__in=service_ids)
+    incidents.delete()
+
+    rebuilt = []
+    current = {}
+    rows = results.order_by('service_id', 'timestamp').values_list('service_id', 'timestamp', 'success', 'message')
+    for service_id, timestamp, success, message in rows.iterator(chunk_size=5000):
+        incident = current.get(service_id)
+        if success:
+            if incident is not None:
+                incident.ended_at = timestamp
+                del current[service_id]
+            continue
+        if incident is None:
+            incident = current[service_id] = Incident(service_id=service_id, started_at=timestamp, first_error=message,
+                                                      failed_probes=0)
+            rebuilt.append(incident)
+        incident.failed_probes += 1
+    Incident.objects.bulk_create(rebuilt, batch_size=1000)
+    return len(rebuilt)
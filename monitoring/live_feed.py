@@ -0,0 +1,176 @@
+"""
+Live status feed for the dashboard and status page.
+
+Workers publish every flushed batch of results (and the status transitions
+they cause) as one message on a Redis channel. Each ASGI web process holds
+a single subscription to that channel and fans the events out to its open
+Server-Sent Events streams, so an open page costs an in-memory queue rather
+than a Redis connection or a periodic full render.
+"""
+import asyncio
+import json
+import logging
+import os
+
+import redis
+from django.conf import settings
+
+from .models import ServiceCheck
+from .redis_client import create_async_subscriber_redis, get_redis
+
+logger = logging.getLogger(__name__)
+
+LIVE_FEED_CHANNEL = 'batmon:live'
+DEFAULT_LIVE_FEED_KEEPALIVE = 15
+DEFAULT_LIVE_FEED_QUEUE_SIZE = 100
+RECONNECT_DELAY = 5
+STATUS_DISPLAY = dict(ServiceCheck.STATUS_CHOICES)
+
+# Sent to a client that fell too far behind; the page reloads to catch up.
+RESYNC = [(None, b'event: resync\ndata: {}\n\n')]
+
+
+def result_event(service_check, check_result):
+    return {
+        'type': 'result',
+        'service': service_check.id,
+        'name': service_check.name,
+        'timestamp': check_result.timestamp.isoformat(),
+        'success': check_result.success,
+        'response_time': check_result.response_time,
+        'status_code': check_result.status_code,
+    }
+
+
+def status_event(service_check, status, previous_status, timestamp):
+    return {
+        'type': 'status',
+        'service': service_check.id,
+        'name': service_check.name,
+        'status': status,
+        'status_display': STATUS_DISPLAY.get(status, status),
+        'previous': previous_status,
+        'timestamp': timestamp.isoformat(),
+    }
+
+
+def publish(events):
+    """Broadcast ``events`` to every live feed subscriber in one Redis message."""
+    if not events:
+        return
+    try:
+        get_redis().publish(LIVE_FEED_CHANNEL, json.dumps(events))
+    except (redis.RedisError, OSError) as e:
+        logger.warning(f"Could not publish {len(events)} live feed events: {e}")
+
+
+def encode(message):
+    """``[(service_id, sse_bytes)]`` for a published batch, encoded once for all subscribers."""
+    return [
+        (event['service'], f"event: {event['type']}\ndata: {json.dumps(event)}\n\n".encode())
+        for event in json.loads(message)
+    ]
+
+
+class LiveFeedHub:
+    """
+    One Redis subscription per process, fanned out to per-client queues.
+
+    The subscription is opened with the first client and closed with the
+    last. A client whose queue fills up gets a single 'resync' event instead
+    of the backlog.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self._queues = set()
+        self._listener = None
+
+    def subscribe(self):
+        queue = asyncio.Queue(getattr(settings, 'BATMON_LIVE_FEED_QUEUE_SIZE', DEFAULT_LIVE_FEED_QUEUE_SIZE))
+        self._queues.add(queue)
+        if self._listener is None or self._listener.done():
+            self._listener = self.loop.create_task(self._listen())
+        return queue
+
+    def unsubscribe(self, queue):
+        self._queues.discard(queue)
+        if not self._queues and self._listener is not None:
+            self._listener.cancel()
+            self._listener = None
+
+    def __len__(self):
+        return len(self._queues)
+
+    def broadcast(self, batch):
+        for queue in self._queues:
+            try:
+                queue.put_nowait(batch)
+            except asyncio.QueueFull:
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(RESYNC)
+
+    async def _listen(self):
+        while True:
+            client = create_async_subscriber_redis()
+            pubsub = client.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(LIVE_FEED_CHANNEL)
+                async for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self.broadcast(encode(message['data']))
+            except (redis.RedisError, OSError) as e:
+                logger.warning(f"Live feed lost its Redis subscription ({e}); retrying in {RECONNECT_DELAY}s.")
+            finally:
+                await pubsub.aclose()
+                await client.aclose()
+            await asyncio.sleep(RECONNECT_DELAY)
+
+
+_hub = None
+
+
+def get_hub():
+    """The LiveFeedHub of the running event loop."""
+    global _hub
+    loop = asyncio.get_running_loop()
+    if _hub is None or _hub.loop is not loop:
+        _hub = LiveFeedHub(loop)
+    return _hub
+
+
+def _forget_hub():
+    global _hub
+    _hub = None
+
+
+os.register_at_fork(after_in_child=_forget_hub)
+
+
+async def event_stream(service_ids=None):
+    """
+    Server-Sent Events for one client, optionally only for ``service_ids``.
+
+    A comment line goes out every BATMON_LIVE_FEED_KEEPALIVE seconds so
+    proxies keep idle streams open.
+    """
+    hub = get_hub()
+    queue = hub.subscribe()
+    keepalive = getattr(settings, 'BATMON_LIVE_FEED_KEEPALIVE', DEFAULT_LIVE_FEED_KEEPALIVE)
+    try:
+        yield f"retry: {RECONNECT_DELAY * 1000}\n\n".encode()
+        while True:
+            try:
+                batch = await asyncio.wait_for(queue.get(), keepalive)
+            except asyncio.TimeoutError:
+                yield b': keepalive\n\n'
+                continue
+            chunk = b''.join(
+                data for service_id, data in batch
+                if service_ids is None or service_id is None or service_id in service_ids
+            )
+            if chunk:
+                yield chunk
+    finally:
+        hub.unsubscribe(queue)
@@ -0,0 +1,173 @@
+"""
+Process-local cache of the maintenance schedule.
+
+Answers "is service X in maintenance now?" from memory instead of querying
+MaintenanceWindow for every probe and page render. The cache is rebuilt
+after a MaintenanceWindow changes (signalled to every process through Redis
+pub/sub) or after BATMON_MAINTENANCE_CACHE_TTL seconds, whichever comes first.
+"""
+import bisect
+import logging
+import threading
+import time
+from collections import defaultdict
+
+import redis
+from django.conf import settings
+from django.utils import timezone
+
+from .models import MaintenanceWindow
+from .redis_client import get_redis, get_subscriber_redis
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = 'batmon:maintenance:invalidate'
+DEFAULT_MAINTENANCE_CACHE_TTL = 60
+
+
+class IntervalSet:
+    """
+    Static set of ``(start, end)`` intervals with O(log n) point queries.
+
+    Intervals are sorted by start; ``_max_ends[i]`` is the latest end among
+    the first ``i + 1`` intervals, so a point is covered iff the latest end
+    among intervals starting at or before it reaches it.
+    """
+
+    def __init__(self, intervals):
+        intervals = sorted(intervals)
+        self._starts = [start for start, _ in intervals]
+        self._max_ends = []
+        latest = None
+        for _, end in intervals:
+            latest = end if latest is None or end > latest else latest
+            self._max_ends.append(latest)
+
+    def __contains__(self, moment):
+        index = bisect.bisect_right(self._starts, moment) - 1
+        return index >= 0 and self._max_ends[index] >= moment
+
+    def __len__(self):
+        return len(self._starts)
+
+
+class MaintenanceSchedule:
+    """Snapshot of active (current and upcoming) windows, keyed by service plus a global list."""
+
+    def __init__(self, windows):
+        self.windows = sorted(windows, key=lambda mw: mw.start_time)
+        per_service = defaultdict(list)
+        global_windows = []
+        for mw in self.windows:
+            interval = (mw.start_time, mw.end_time)
+            if mw.service_id is None:
+                global_windows.append(interval)
+            else:
+                per_service[mw.service_id].append(interval)
+        self.global_windows = IntervalSet(global_windows)
+        self.per_service = {service_id: IntervalSet(intervals) for service_id, intervals in per_service.items()}
+
+    def in_maintenance(self, service_id, now):
+        if now in self.global_windows:
+            return True
+        intervals = self.per_service.get(service_id)
+        return intervals is not None and now in intervals
+
+    def active_windows(self, now):
+        return [mw for mw in self.windows if mw.start_time <= now <= mw.end_time]
+
+    def next_change(self, now, service_id=None):
+        """
+        Earliest window start or end after ``now``, or None.
+
+        With ``service_id`` only global windows and that service's count;
+        without it, every window does.
+        """
+        boundaries = [
+            moment
+            for mw in self.windows
+            if service_id is None or mw.service_id in (None, service_id)
+            for moment in (mw.start_time, mw.end_time)
+            if moment > now
+        ]
+        return min(boundaries, default=None)
+
+
+class MaintenanceCache:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._schedule = None
+        self._loaded_at = 0.0
+        self._generation = 0
+        self._listener = None
+
+    @property
+    def ttl(self):
+        return getattr(settings, 'BATMON_MAINTENANCE_CACHE_TTL', DEFAULT_MAINTENANCE_CACHE_TTL)
+
+    def schedule(self):
+        self._ensure_listener()
+        schedule = self._schedule
+        if schedule is None or time.monotonic() - self._loaded_at >= self.ttl:
+            schedule = self.refresh()
+        return schedule
+
+    def refresh(self):
+        generation = self._generation
+        windows = list(
+            MaintenanceWindow.objects.filter(active=True, end_time__gte=timezone.now()).select_related('service')
+        )
+        schedule = MaintenanceSchedule(windows)
+        with self._lock:
+            # Do not cache a snapshot that an invalidation arriving mid-query has already outdated.
+            if generation == self._generation:
+                self._schedule = schedule
+                self._loaded_at = time.monotonic()
+        return schedule
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._schedule = None
+
+    def in_maintenance(self, service_id, now=None):
+        return self.schedule().in_maintenance(service_id, now or timezone.now())
+
+    def active_windows(self, now=None):
+        return self.schedule().active_windows(now or timezone.now())
+
+    def next_change(self, now=None, service_id=None):
+        return self.schedule().next_change(now or timezone.now(), service_id)
+
+    def _ensure_listener(self):
+        # Started lazily so each (forked) process subscribes for itself.
+        if self._listener is None or not self._listener.is_alive():
+            self._listener = threading.Thread(target=self._listen, name='batmon-maintenance-cache', daemon=True)
+            self._listener.start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = get_subscriber_redis().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(INVALIDATION_CHANNEL)
+                # Anything may have changed while we were not subscribed.
+                self.invalidate()
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self.invalidate()
+            except (redis.RedisError, OSError) as e:
+                logger.warning(f"Maintenance cache lost its Redis subscription ({e}); relying on the TTL until it reconnects.")
+                time.sleep(5)
+
+
+maintenance_cache = MaintenanceCache()
+
+
+def publish_maintenance_change():
+    """Drop the cached schedule in this process and tell every other process to do the same."""
+    maintenance_cache.invalidate()
+    try:
+        get_redis().publish(INVALIDATION_CHANNEL, '1')
+    except (redis.RedisError, OSError) as e:
+        logger.warning(f"Could not publish maintenance cache invalidation: {e}")
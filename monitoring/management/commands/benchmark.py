@@ -0,0 +1,80 @@
+import json
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+from monitoring import benchmark
+
+# Pages are cached in-process so the numbers do not depend on a Redis round trip.
+BENCHMARK_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'status': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'batmon-benchmark'},
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the check pipeline and the status, detail and dashboard pages against local stand-in "
+        "servers, in a throwaway test database, and write the results as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes',
+            type=lambda value: [int(size) for size in value.split(',')],
+            default=list(benchmark.DEFAULT_SIZES),
+            help="Comma-separated numbers of services to render the pages at (default: 100,1000,10000).",
+        )
+        parser.add_argument(
+            '--results-per-service',
+            type=int,
+            default=benchmark.DEFAULT_RESULTS_PER_SERVICE,
+            help="CheckResults seeded per service, spread over the last 24 hours.",
+        )
+        parser.add_argument(
+            '--checks',
+            type=int,
+            default=benchmark.DEFAULT_CHECKS,
+            help="Checks to run through each pipeline.",
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=benchmark.DEFAULT_REPEAT,
+            help="Requests per page measurement.",
+        )
+        parser.add_argument(
+            '--output',
+            default='benchmark.json',
+            help="File to write the JSON report to ('-' for stdout).",
+        )
+        parser.add_argument(
+            '--keepdb',
+            action='store_true',
+            help="Reuse the test database if it exists (it is still emptied first).",
+        )
+
+    def handle(self, *args, **options):
+        log = self.stderr.write if options['output'] == '-' else self.stdout.write
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False,
+                                                      keepdb=options['keepdb'])
+        setup_test_environment()
+        try:
+            if options['keepdb']:
+                call_command('flush', interactive=False, verbosity=0)
+            with override_settings(CACHES=BENCHMARK_CACHES, BATMON_STATUS_CACHE='status'):
+                report = benchmark.run(options['sizes'], options['results_per_service'], options['checks'],
+                                       options['repeat'], log=log)
+        finally:
+            teardown_test_environment()
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+
+        output = json.dumps(report, indent=2)
+        if options['output'] == '-':
+            self.stdout.write(output)
+        else:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+            log(self.style.SUCCESS(f"Wrote {options['output']}"))
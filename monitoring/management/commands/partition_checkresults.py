@@ -0,0 +1,40 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from monitoring import partitions
+from monitoring.retention import DEFAULT_PARTITION_DAYS_AHEAD
+
+
+class Command(BaseCommand):
+    help = "Manage daily range partitions of the CheckResult table (PostgreSQL only)."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--convert',
+            action='store_true',
+            help="Rebuild the existing CheckResult table as a partitioned table. Stop workers first.",
+        )
+        parser.add_argument(
+            '--days-ahead',
+            type=int,
+            default=getattr(settings, 'BATMON_PARTITION_DAYS_AHEAD', DEFAULT_PARTITION_DAYS_AHEAD),
+            help="Number of future daily partitions to create.",
+        )
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        if options['convert']:
+            try:
+                partitions.convert_to_partitioned(now, options['days_ahead'])
+            except RuntimeError as e:
+                raise CommandError(str(e))
+            self.stdout.write(self.style.SUCCESS("CheckResult is now partitioned by day."))
+
+        if not partitions.is_partitioned():
+            raise CommandError("CheckResult is not partitioned. Run with --convert first.")
+
+        created = partitions.ensure_partitions(now, options['days_ahead'])
+        self.stdout.write(f"Created {created} partitions.")
+        for name, day in partitions.list_partitions():
+            self.stdout.write(f"{name}\t{day.date()}")
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from monitoring.failure_streaks import rebuild_failure_streaks
+
+
+class Command(BaseCommand):
+    help = "Recompute each service's consecutive-failure counter and alerted-streak marker from its CheckResults."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'service_ids',
+            nargs='*',
+            type=int,
+            help="Only rebuild these services (default: all).",
+        )
+
+    def handle(self, *args, **options):
+        changed = rebuild_failure_streaks(options['service_ids'] or None)
+        self.stdout.write(f"Updated the failure streak of {changed} services.")
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from monitoring.incidents import rebuild_incidents
+
+
+class Command(BaseCommand):
+    help = "Replace each service's incidents with the outages found in its CheckResults."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'service_ids',
+            nargs='*',
+            type=int,
+            help="Only rebuild these services (default: all).",
+        )
+
+    def handle(self, *args, **options):
+        count = rebuild_incidents(options['service_ids'] or None)
+        self.stdout.write(f"Rebuilt {count} incidents.")
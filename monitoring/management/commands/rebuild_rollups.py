@@ -0,0 +1,27 @@
+from datetime import timezone as dt_timezone
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from monitoring import rollups
+
+
+class Command(BaseCommand):
+    help = "Rebuild the 1m/1h/1d rollups from the raw results stored since a point in time."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--since',
+            required=True,
+            help="ISO 8601 date and time to rebuild from (UTC unless it has an offset).",
+        )
+
+    def handle(self, *args, **options):
+        since = parse_datetime(options['since'])
+        if since is None:
+            raise CommandError("--since expects an ISO 8601 date and time.")
+        if timezone.is_naive(since):
+            since = since.replace(tzinfo=dt_timezone.utc)
+        counts = rollups.rebuild(since, timezone.now())
+        self.stdout.write(f"Rebuilt rollups since {since.isoformat()}: {counts}")
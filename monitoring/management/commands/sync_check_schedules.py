@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from django_celery_beat.models import PeriodicTask, PeriodicTasks
+
+from monitoring.models import ServiceCheck
+from monitoring.scheduling import batched_scheduling_enabled
+
+
+class Command(BaseCommand):
+    help = (
+        "Bring every check in line with BATMON_SCHEDULER_MODE: in 'batched' mode, delete the per-check "
+        "PeriodicTasks left from the periodic_task mode; in 'periodic_task' mode, create the missing ones."
+    )
+
+    def handle(self, *args, **options):
+        if batched_scheduling_enabled():
+            # The checks' periodic_task is SET_NULL, which hands them over to dispatch_due_checks.
+            deleted, _ = PeriodicTask.objects.filter(servicecheck__isnull=False).delete()
+            PeriodicTasks.update_changed() # Make beat reload its schedule
+            self.stdout.write(f"Deleted {deleted} per-check periodic tasks.")
+            return
+
+        created = 0
+        for service_check in ServiceCheck.objects.filter(periodic_task__isnull=True):
+            service_check.save() # Creates its PeriodicTask
+            created += 1
+        self.stdout.write(f"Created {created} per-check periodic tasks.")
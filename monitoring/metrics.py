@@ -0,0 +1,320 @@
+"""
+BatMon's own instrumentation, exposed in the Prometheus text format.
+
+Recording a sample only updates a dict in the recording process. Each
+process pushes what it recorded since the last push to Redis every
+BATMON_METRICS_PUSH_INTERVAL seconds, in one pipeline of HINCRBYFLOATs, so
+counters and histograms are summed across every worker process (and
+survive their restarts). Gauges are sampled at push time and stored per
+process with an expiry, so a process that died drops out of the sum. The
+/metrics view reads the totals back and renders them.
+"""
+import atexit
+import json
+import logging
+import math
+import os
+import socket
+import threading
+import time
+
+import redis
+from celery.signals import worker_process_shutdown
+from django.conf import settings
+
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'batmon:metrics:'
+DEFAULT_METRICS_PUSH_INTERVAL = 10
+# Seconds, from sub-millisecond queries to checks running into their timeout.
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+REGISTRY = []
+
+
+def push_interval():
+    return getattr(settings, 'BATMON_METRICS_PUSH_INTERVAL', DEFAULT_METRICS_PUSH_INTERVAL)
+
+
+def _field(label_values, suffix=None):
+    field = json.dumps(label_values)
+    return field if suffix is None else f"{field}|{suffix}"
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Metric:
+    """Base of the metric types: a name, help text, label names and this process's unpushed values."""
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        REGISTRY.append(self)
+
+    @property
+    def key(self):
+        return KEY_PREFIX + self.name
+
+    def _label_values(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes the labels {self.labelnames}, got {tuple(labels)}")
+        return [str(labels[name]) for name in self.labelnames]
+
+    def collect(self):
+        """Hand over (and forget) what was recorded since the last call, as ``{field: delta}``."""
+        with self._lock:
+            values, self._values = self._values, {}
+        return values
+
+    def restore(self, values):
+        """Put back deltas that could not be pushed."""
+        with self._lock:
+            for field, delta in values.items():
+                self._values[field] = self._values.get(field, 0) + delta
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+    def samples(self, totals):
+        """``(suffix, labels, value)`` lines for the aggregated ``{field: value}`` hash."""
+        for field, value in sorted(totals.items()):
+            yield '', list(zip(self.labelnames, json.loads(field))), value
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        field = _field(self._label_values(labels))
+        with self._lock:
+            self._values[field] = self._values.get(field, 0) + amount
+        _ensure_pusher()
+
+
+class Histogram(Metric):
+    """
+    Counts of observations per bucket, plus their sum and count.
+
+    Buckets are kept (and pushed) non-cumulative so that processes can be
+    summed field by field; they are made cumulative when rendered.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(float(bound) for bound in buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        label_values = self._label_values(labels)
+        if not math.isfinite(value):
+            # NaN would match no bucket, and an infinite value would wreck the sum.
+            return
+        bound = next((bound for bound in self.buckets if value <= bound), self.buckets[-1])
+        with self._lock:
+            for field, delta in (
+                (_field(label_values, _format_value(bound)), 1),
+                (_field(label_values, 'sum'), value),
+                (_field(label_values, 'count'), 1),
+            ):
+                self._values[field] = self._values.get(field, 0) + delta
+        _ensure_pusher()
+
+    def samples(self, totals):
+        series = {}
+        for field, value in totals.items():
+            label_json, suffix = field.rsplit('|', 1)
+            series.setdefault(label_json, {})[suffix] = value
+        for label_json, values in sorted(series.items()):
+            labels = list(zip(self.labelnames, json.loads(label_json)))
+            cumulative = 0
+            for bound in self.buckets:
+                cumulative += values.get(_format_value(bound), 0)
+                yield '_bucket', labels + [('le', _format_value(bound))], cumulative
+            yield '_sum', labels, values.get('sum', 0)
+            yield '_count', labels, values.get('count', 0)
+
+
+class Gauge(Metric):
+    """
+    A value sampled from ``function`` whenever this process pushes.
+
+    Each process stores its own sample under an expiring key; the rendered
+    value is the sum over the processes still alive.
+    """
+    type = 'gauge'
+
+    def __init__(self, name, documentation, function=None):
+        super().__init__(name, documentation)
+        self.function = function
+
+    def set_function(self, function):
+        self.function = function
+        return function
+
+    def collect(self):
+        if self.function is None:
+            return {}
+        return {_field([]): self.function()}
+
+    def restore(self, values):
+        pass # A fresh sample is taken on the next push
+
+
+def process_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def push(client=None):
+    """Add this process's unpushed counts to the Redis totals and refresh its gauge samples."""
+    client = client or get_redis()
+    collected = [(metric, metric.collect()) for metric in REGISTRY]
+    if not any(values for _, values in collected):
+        return
+    expiry = max(int(push_interval() * 3), 1)
+    pipe = client.pipeline(transaction=False)
+    for metric, values in collected:
+        if isinstance(metric, Gauge):
+            if values:
+                key = f"{metric.key}:{process_id()}"
+                pipe.hset(key, mapping=values)
+                pipe.expire(key, expiry)
+            continue
+        for field, delta in values.items():
+            pipe.hincrbyfloat(metric.key, field, delta)
+    try:
+        pipe.execute()
+    except (redis.RedisError, OSError):
+        for metric, values in collected:
+            metric.restore(values)
+        raise
+
+
+def read_totals(client=None):
+    """``{metric name: {field: value}}`` summed over every process, as stored in Redis."""
+    client = client or get_redis()
+    pipe = client.pipeline(transaction=False)
+    keys = []
+    for metric in REGISTRY:
+        if isinstance(metric, Gauge):
+            keys.extend((metric, key) for key in client.scan_iter(match=f"{metric.key}:*", count=1000))
+        else:
+            keys.append((metric, metric.key))
+    for _, key in keys:
+        pipe.hgetall(key)
+    totals = {metric.name: {} for metric in REGISTRY}
+    for (metric, _), values in zip(keys, pipe.execute()):
+        for field, value in values.items():
+            field = field.decode() if isinstance(field, bytes) else field
+            totals[metric.name][field] = totals[metric.name].get(field, 0) + float(value)
+    return totals
+
+
+def render(totals):
+    """The Prometheus text exposition of ``totals``, as returned by read_totals."""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for suffix, labels, value in metric.samples(totals.get(metric.name, {})):
+            lines.append(f"{metric.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+    return '\n'.join(lines) + '\n'
+
+
+_pusher = None
+_pusher_lock = threading.Lock()
+
+
+def _ensure_pusher():
+    # Started lazily so it lives in the (forked) worker process that records the samples.
+    global _pusher
+    if _pusher is not None:
+        return
+    with _pusher_lock:
+        if _pusher is None:
+            _pusher = threading.Thread(target=_push_periodically, name='batmon-metrics', daemon=True)
+            _pusher.start()
+
+
+def _push_periodically():
+    while True:
+        time.sleep(push_interval())
+        if _pusher is not threading.current_thread():
+            return # Replaced, e.g. by the metrics being reset
+        try:
+            push()
+        except (redis.RedisError, OSError) as e:
+            logger.warning(f"Could not push metrics to Redis, keeping them for the next attempt: {e}")
+        except Exception as e:
+            logger.error(f"Metrics push failed: {e}", exc_info=True)
+
+
+def _forget_samples():
+    # Whatever the parent recorded is the parent's to push.
+    global _pusher, _pusher_lock
+    _pusher = None
+    _pusher_lock = threading.Lock()
+    for metric in REGISTRY:
+        metric._lock = threading.Lock()
+        metric.reset()
+
+
+os.register_at_fork(after_in_child=_forget_samples)
+
+
+def push_on_exit(**kwargs):
+    if _pusher is None:
+        return
+    try:
+        push()
+    except Exception as e:
+        logger.warning(f"Could not push metrics on shutdown: {e}")
+
+
+worker_process_shutdown.connect(push_on_exit, weak=False)
+atexit.register(push_on_exit)
+
+
+CHECK_DURATION = Histogram(
+    'batmon_check_duration_seconds', "Time spent probing a service, by check type.", ['check_type'])
+CHECKS = Counter(
+    'batmon_checks_total', "Check results recorded, by check type and outcome.", ['check_type', 'outcome'])
+TASK_QUEUE_LAG = Histogram(
+    'batmon_task_queue_lag_seconds', "Delay between a task being due (sent, or its ETA) and a worker starting it.",
+    ['task'])
+TASK_DURATION = Histogram(
+    'batmon_task_duration_seconds', "Run time of Celery tasks.", ['task'])
+TASK_DB_TIME = Histogram(
+    'batmon_task_db_seconds', "Time a Celery task spent in database queries.", ['task'])
+TASK_FAILURES = Counter(
+    'batmon_task_failures_total', "Celery tasks that raised.", ['task'])
+ALERT_DELIVERY = Histogram(
+    'batmon_alert_delivery_seconds', "Time to deliver the alerts of one batch to one destination, by channel.",
+    ['channel'])
+ALERTS = Counter(
+    'batmon_alerts_total', "Alerts delivered or failed, by channel and outcome.", ['channel', 'outcome'])
+DNS_LOOKUPS = Counter(
+    'batmon_dns_lookups_total', "Host name lookups of the checks, by whether the DNS cache answered.", ['outcome'])
+RESULT_BUFFER_DEPTH = Gauge(
+    'batmon_result_buffer_depth', "Check results buffered in the worker result sinks, waiting to be written.")
@@ -0,0 +1,50 @@
+"""
+Migration operations for indexes on the large, constantly written tables.
+
+On PostgreSQL they build and drop indexes CONCURRENTLY, so check results
+and alert logs keep being written meanwhile; migrations using them must set
+``atomic = False``. Elsewhere, and on a partitioned CheckResult (which
+PostgreSQL cannot index concurrently), they are plain AddIndex/RemoveIndex.
+"""
+from django.contrib.postgres import operations as postgres_operations
+from django.db import migrations
+
+
+def _concurrently(schema_editor, model):
+    connection = schema_editor.connection
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", [model._meta.db_table])
+        row = cursor.fetchone()
+    return not (row and row[0] == 'p')
+
+
+class AddIndexConcurrently(postgres_operations.AddIndexConcurrently):
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if _concurrently(schema_editor, to_state.apps.get_model(app_label, self.model_name)):
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+        else:
+            migrations.AddIndex.database_forwards(self, app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if _concurrently(schema_editor, from_state.apps.get_model(app_label, self.model_name)):
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+        else:
+            migrations.AddIndex.database_backwards(self, app_label, schema_editor, from_state, to_state)
+
+
+class RemoveIndexConcurrently(postgres_operations.RemoveIndexConcurrently):
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if _concurrently(schema_editor, from_state.apps.get_model(app_label, self.model_name)):
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+        else:
+            migrations.RemoveIndex.database_forwards(self, app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if _concurrently(schema_editor, to_state.apps.get_model(app_label, self.model_name)):
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+        else:
+            migrations.RemoveIndex.database_backwards(self, app_label, schema_editor, from_state, to_state)
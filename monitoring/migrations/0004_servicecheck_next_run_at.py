@@ -0,0 +1,32 @@
+# Generated by Django 5.0.10 on 2026-10-18 03:25
+
+import random
+from datetime import timedelta
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def spread_next_run_at(apps, schema_editor):
+    ServiceCheck = apps.get_model('monitoring', 'ServiceCheck')
+    now = timezone.now()
+    service_checks = list(ServiceCheck.objects.filter(next_run_at__isnull=True).only('id', 'interval'))
+    for service_check in service_checks:
+        service_check.next_run_at = now + timedelta(seconds=random.uniform(0, service_check.interval))
+    ServiceCheck.objects.bulk_update(service_checks, ['next_run_at'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monitoring', '0003_maintenancewindow'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='servicecheck',
+            name='next_run_at',
+            field=models.DateTimeField(blank=True, db_index=True, help_text='Next run for the batched scheduler.', null=True),
+        ),
+        migrations.RunPython(spread_next_run_at, migrations.RunPython.noop),
+    ]
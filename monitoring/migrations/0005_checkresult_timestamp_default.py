@@ -0,0 +1,19 @@
+# Generated by Django 5.0.10 on 2026-10-18 03:26
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monitoring', '0004_servicecheck_next_run_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='checkresult',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
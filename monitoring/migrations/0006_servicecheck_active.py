@@ -0,0 +1,18 @@
+# Generated by Django 5.0.10 on 2026-10-18 03:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monitoring', '0005_checkresult_timestamp_default'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='servicecheck',
+            name='active',
+            field=models.BooleanField(default=True, help_text='Disabled checks are not scheduled.'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.0.10 on 2026-10-18 03:27
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monitoring', '0006_servicecheck_active'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CheckResultRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.CharField(choices=[('1m', '1 minute'), ('1h', '1 hour'), ('1d', '1 day')], max_length=2)),
+                ('bucket_start', models.DateTimeField()),
+                ('count', models.IntegerField(default=0)),
+                ('successes', models.IntegerField(default=0)),
+                ('response_time_count', models.IntegerField(default=0, help_text='Results with a response time in this bucket')),
+                ('response_time_sum', models.FloatField(default=0)),
+                ('response_time_min', models.FloatField(blank=True, null=True)),
+                ('response_time_max', models.FloatField(blank=True, null=True)),
+                ('response_time_p95', models.FloatField(blank=True, null=True)),
+                ('service', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='monitoring.servicecheck')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='checkresultrollup',
+            constraint=models.UniqueConstraint(fields=('service', 'resolution', 'bucket_start'), name='unique_rollup_bucket'),
+        ),
+    ]
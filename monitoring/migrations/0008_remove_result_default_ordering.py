@@ -0,0 +1,21 @@
+# Generated by Django 5.0.10 on 2026-10-18 03:29
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monitoring', '0007_checkresultrollup'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='alertlog',
+            options={},
+        ),
+        migrations.AlterModelOptions(
+            name='checkresult',
+            options={},
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 5.0.10 on 2026-10-18 03:31
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+from monitoring.migration_operations import AddIndexConcurrently
+
+
+class Migration(migrations.Migration):
+    # CheckResult and AlertLog are indexed concurrently, which cannot run in a transaction.
+    atomic = False
+
+    dependencies = [
+        ('django_celery_beat', '0018_improve_crontab_helptext'),
+        ('monitoring', '0008_remove_result_default_ordering'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='servicecheck',
+            name='next_run_at',
+            field=models.DateTimeField(blank=True, help_text='Next run for the batched scheduler.', null=True),
+        ),
+        AddIndexConcurrently(
+            model_name='alertlog',
+            index=models.Index(condition=models.Q(('success', True)), fields=['alert', '-timestamp'], name='alertlog_alert_sent_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='alertlog',
+            index=models.Index(fields=['timestamp'], name='alertlog_ts_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='checkresult',
+            index=models.Index(fields=['service', '-timestamp'], name='checkresult_service_ts_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='checkresult',
+            index=models.Index(condition=models.Q(('success', False)), fields=['service', '-timestamp'], name='checkresult_service_fail_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='checkresult',
+            index=models.Index(fields=['timestamp'], name='checkresult_ts_idx'),
+        ),
+        # Only once checkresult_service_ts_idx exists: until then the service_id index serves per-service
+        # queries and cascades.
+        migrations.AlterField(
+            model_name='checkresult',
+            name='service',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='results', to='monitoring.servicecheck'),
+        ),
+        migrations.AddIndex(
+            model_name='maintenancewindow',
+            index=models.Index(condition=models.Q(('active', True)), fields=['start_time', 'end_time'], name='maintenance_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='servicecheck',
+            index=models.Index(condition=models.Q(('active', True)), fields=['next_run_at'], name='servicecheck_due_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.0.10 on 2026-10-18 03:35
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monitoring', '0009_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='checkresultrollup',
+            name='service',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='monitoring.servicecheck'),
+        ),
+        migrations.AddIndex(
+            model_name='checkresultrollup',
+            index=models.Index(fields=['resolution', 'bucket_start'], name='rollup_window_idx'),
+        ),
+    ]
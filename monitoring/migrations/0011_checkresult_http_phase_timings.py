@@ -0,0 +1,33 @@
+# Generated by Django 5.0.10 on 2026-10-18 03:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monitoring', '0010_rollup_window_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='checkresult',
+            name='connect_time',
+            field=models.FloatField(blank=True, help_text='Conexão TCP em segundos', null=True),
+        ),
+        migrations.AddField(
+            model_name='checkresult',
+            name='dns_time',
+            field=models.FloatField(blank=True, help_text='Resolução DNS em segundos', null=True),
+        ),
+        migrations.AddField(
+            model_name='checkresult',
+            name='tls_time',
+            field=models.FloatField(blank=True, help_text='Handshake TLS em segundos', null=True),
+        ),
+        migrations.AddField(
+            model_name='checkresult',
+            name='ttfb',
+            field=models.FloatField(blank=True, help_text='Tempo até o primeiro byte, desde o envio da requisição, em segundos', null=True),
+        ),
+    ]
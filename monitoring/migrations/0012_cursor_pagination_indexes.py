@@ -0,0 +1,57 @@
+# Generated by Django 5.0.10 on 2026-10-18 03:47
+
+from django.db import migrations, models
+
+from monitoring.migration_operations import AddIndexConcurrently, RemoveIndexConcurrently
+
+
+class Migration(migrations.Migration):
+    # Each index gains the id tie-breaker of cursor pagination. The new one is built concurrently
+    # under a temporary name before the old one is dropped, so the tables are never without it.
+    atomic = False
+
+    dependencies = [
+        ('monitoring', '0011_checkresult_http_phase_timings'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='alertlog',
+            index=models.Index(fields=['timestamp', 'id'], name='alertlog_ts_id_idx'),
+        ),
+        RemoveIndexConcurrently(
+            model_name='alertlog',
+            name='alertlog_ts_idx',
+        ),
+        migrations.RenameIndex(
+            model_name='alertlog',
+            new_name='alertlog_ts_idx',
+            old_name='alertlog_ts_id_idx',
+        ),
+        AddIndexConcurrently(
+            model_name='checkresult',
+            index=models.Index(fields=['service', '-timestamp', '-id'], name='checkresult_service_ts_id_idx'),
+        ),
+        RemoveIndexConcurrently(
+            model_name='checkresult',
+            name='checkresult_service_ts_idx',
+        ),
+        migrations.RenameIndex(
+            model_name='checkresult',
+            new_name='checkresult_service_ts_idx',
+            old_name='checkresult_service_ts_id_idx',
+        ),
+        AddIndexConcurrently(
+            model_name='checkresult',
+            index=models.Index(fields=['timestamp', 'id'], name='checkresult_ts_id_idx'),
+        ),
+        RemoveIndexConcurrently(
+            model_name='checkresult',
+            name='checkresult_ts_idx',
+        ),
+        migrations.RenameIndex(
+            model_name='checkresult',
+            new_name='checkresult_ts_idx',
+            old_name='checkresult_ts_id_idx',
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 5.0.10 on 2026-10-18 03:50
+
+from django.db import migrations, models
+
+
+def backfill_failure_streaks(apps, schema_editor):
+    # A frozen copy of failure_streaks.rebuild_failure_streaks, against the historical models.
+    ServiceCheck = apps.get_model('monitoring', 'ServiceCheck')
+    CheckResult = apps.get_model('monitoring', 'CheckResult')
+    AlertLog = apps.get_model('monitoring', 'AlertLog')
+
+    changed = []
+    for service in ServiceCheck.objects.only('pk').order_by('pk').iterator():
+        failures = CheckResult.objects.filter(service_id=service.pk, success=False)
+        last_success = (
+            CheckResult.objects.filter(service_id=service.pk, success=True)
+            .order_by('-timestamp').values_list('timestamp', flat=True).first()
+        )
+        if last_success is not None:
+            failures = failures.filter(timestamp__gt=last_success)
+        consecutive_failures = failures.count()
+        if not consecutive_failures:
+            continue
+        streak_start = failures.order_by('timestamp').values_list('timestamp', flat=True).first()
+        alerted = AlertLog.objects.filter(
+            alert__service_id=service.pk, alert__trigger='on_fail_x_times',
+            alert__trigger_value__lte=consecutive_failures, success=True, timestamp__gte=streak_start,
+        ).exists()
+        service.consecutive_failures = consecutive_failures
+        service.alerted_failures = consecutive_failures if alerted else 0
+        changed.append(service)
+    ServiceCheck.objects.bulk_update(changed, ['consecutive_failures', 'alerted_failures'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monitoring', '0012_cursor_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='servicecheck',
+            name='alerted_failures',
+            field=models.PositiveIntegerField(default=0, help_text="Streak length up to which 'fails X times' alerts have been sent (0 if none this streak)."),
+        ),
+        migrations.AddField(
+            model_name='servicecheck',
+            name='consecutive_failures',
+            field=models.PositiveIntegerField(default=0, help_text='Failed checks since the last successful one.'),
+        ),
+        migrations.RunPython(backfill_failure_streaks, migrations.RunPython.noop),
+    ]
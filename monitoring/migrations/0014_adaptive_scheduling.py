@@ -0,0 +1,44 @@
+# Generated by Django 5.0.10 on 2026-10-18 04:15
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monitoring', '0013_servicecheck_failure_streak'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='servicecheck',
+            name='adaptive_schedule',
+            field=models.BooleanField(default=False, help_text='Re-check failures sooner, back off during long outages and maintenance, and damp flapping.'),
+        ),
+        migrations.AddField(
+            model_name='servicecheck',
+            name='backoff_level',
+            field=models.PositiveSmallIntegerField(default=0, help_text='Backoff steps taken in the current outage or maintenance.'),
+        ),
+        migrations.AddField(
+            model_name='servicecheck',
+            name='flap_score',
+            field=models.FloatField(default=0, help_text='Moving average of state changes per result (0 stable, 1 always changing).'),
+        ),
+        migrations.AddField(
+            model_name='servicecheck',
+            name='flap_threshold',
+            field=models.FloatField(blank=True, help_text='Flap score (0-1) from which the check counts as flapping.', null=True, validators=[django.core.validators.MinValueValidator(0), django.core.validators.MaxValueValidator(1)]),
+        ),
+        migrations.AddField(
+            model_name='servicecheck',
+            name='max_interval',
+            field=models.PositiveIntegerField(blank=True, help_text='Longest interval, in seconds, a failing or maintained check backs off to.', null=True),
+        ),
+        migrations.AddField(
+            model_name='servicecheck',
+            name='recheck_interval',
+            field=models.PositiveIntegerField(blank=True, help_text='Seconds before confirming a new failure (adaptive scheduling).', null=True),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.0.10 on 2026-10-18 04:28
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monitoring', '0014_adaptive_scheduling'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SampleBlock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start', models.DateTimeField(help_text='Start (UTC) of the hour the samples belong to')),
+                ('count', models.IntegerField(default=0)),
+                ('successes', models.IntegerField(default=0)),
+                ('last_offset', models.IntegerField(default=0, help_text='Milliseconds from start to the last appended sample')),
+                ('timestamps', models.BinaryField(default=bytes)),
+                ('response_times', models.BinaryField(default=bytes)),
+                ('success_bitmap', models.BinaryField(default=bytes)),
+                ('service', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='sample_blocks', to='monitoring.servicecheck')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['start'], name='sampleblock_start_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='sampleblock',
+            constraint=models.UniqueConstraint(fields=('service', 'start'), name='unique_sample_block'),
+        ),
+    ]
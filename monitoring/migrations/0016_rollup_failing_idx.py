@@ -0,0 +1,14 @@
+# Generated by Django 5.0.10 on 2026-10-18 04:35
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    # rollup_failing_idx used to be created here, only for 0017 to drop it again once incidents replaced
+    # the query it served. 0017 drops it where an earlier version of this migration built it.
+
+    dependencies = [
+        ('monitoring', '0015_sample_blocks'),
+    ]
+
+    operations = []
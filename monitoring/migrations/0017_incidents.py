@@ -0,0 +1,83 @@
+# Generated by Django 5.0.10 on 2026-10-18 04:51
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+from monitoring.migration_operations import AddIndexConcurrently
+
+
+def backfill_incidents(apps, schema_editor):
+    # A frozen copy of incidents.rebuild_incidents, against the historical models.
+    CheckResult = apps.get_model('monitoring', 'CheckResult')
+    Incident = apps.get_model('monitoring', 'Incident')
+
+    incidents = []
+    current = {}
+    rows = CheckResult.objects.order_by('service_id', 'timestamp').values_list('service_id', 'timestamp', 'success', 'message')
+    for service_id, timestamp, success, message in rows.iterator(chunk_size=5000):
+        incident = current.get(service_id)
+        if success:
+            if incident is not None:
+                incident.ended_at = timestamp
+                del current[service_id]
+            continue
+        if incident is None:
+            incident = current[service_id] = Incident(service_id=service_id, started_at=timestamp, first_error=message,
+                                                      failed_probes=0)
+            incidents.append(incident)
+        incident.failed_probes += 1
+    Incident.objects.bulk_create(incidents, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+    # AlertLog is indexed concurrently, which cannot run in a transaction.
+    atomic = False
+
+    dependencies = [
+        ('monitoring', '0016_rollup_failing_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Incident',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('started_at', models.DateTimeField(help_text='Time of the first failed check.')),
+                ('ended_at', models.DateTimeField(blank=True, help_text='Time of the check that succeeded again; empty while ongoing.', null=True)),
+                ('first_error', models.TextField(blank=True, help_text='Message of the first failed check.', null=True)),
+                ('failed_probes', models.PositiveIntegerField(default=0, help_text='Failed checks during the incident.')),
+            ],
+            options={
+                'ordering': ['-started_at'],
+            },
+        ),
+        migrations.AddField(
+            model_name='incident',
+            name='service',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='incidents', to='monitoring.servicecheck'),
+        ),
+        migrations.AddField(
+            model_name='alertlog',
+            name='incident',
+            field=models.ForeignKey(blank=True, db_index=False, help_text='Latest incident of the service when the alert was sent.', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='alert_logs', to='monitoring.incident'),
+        ),
+        AddIndexConcurrently(
+            model_name='alertlog',
+            index=models.Index(fields=['incident'], name='alertlog_incident_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='incident',
+            index=models.Index(fields=['service', '-started_at'], name='incident_service_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='incident',
+            index=models.Index(fields=['started_at', 'id'], name='incident_start_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='incident',
+            constraint=models.UniqueConstraint(condition=models.Q(('ended_at__isnull', True)), fields=('service',), name='unique_open_incident'),
+        ),
+        migrations.RunPython(backfill_incidents, migrations.RunPython.noop, atomic=True),
+        # Left behind by an earlier version of 0016
+        migrations.RunSQL('DROP INDEX IF EXISTS rollup_failing_idx', migrations.RunSQL.noop),
+    ]
@@ -1,6 +1,8 @@
+from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
 from django_celery_beat.models import PeriodicTask, IntervalSchedule
 from django.utils import timezone
+from .scheduling import batched_scheduling_enabled, initial_next_run
 import json
 
 class ServiceCheck(models.Model):
@@ -24,6 +26,27 @@ class ServiceCheck(models.Model):
     timeout = models.IntegerField(default=10, help_text="Timeout em segundos")
     status_atual = models.CharField(max_length=15, choices=STATUS_CHOICES, default='ok')
     last_check = models.DateTimeField(null=True, blank=True)
+    active = models.BooleanField(default=True, help_text="Disabled checks are not scheduled.")
+    next_run_at = models.DateTimeField(null=True, blank=True, help_text="Next run for the batched scheduler.")
+    consecutive_failures = models.PositiveIntegerField(default=0, help_text="Failed checks since the last successful one.")
+    alerted_failures = models.PositiveIntegerField(
+        default=0,
+        help_text="Streak length up to which 'fails X times' alerts have been sent (0 if none this streak).",
+    )
+    # Adaptive scheduling (batched scheduler only); blank settings fall back to BATMON_ADAPTIVE_*.
+    adaptive_schedule = models.BooleanField(
+        default=False,
+        help_text="Re-check failures sooner, back off during long outages and maintenance, and damp flapping.",
+    )
+    recheck_interval = models.PositiveIntegerField(
+        null=True, blank=True, help_text="Seconds before confirming a new failure (adaptive scheduling).")
+    max_interval = models.PositiveIntegerField(
+        null=True, blank=True, help_text="Longest interval, in seconds, a failing or maintained check backs off to.")
+    flap_threshold = models.FloatField(
+        null=True, blank=True, validators=[MinValueValidator(0), MaxValueValidator(1)],
+        help_text="Flap score (0-1) from which the check counts as flapping.")
+    flap_score = models.FloatField(default=0, help_text="Moving average of state changes per result (0 stable, 1 always changing).")
+    backoff_level = models.PositiveSmallIntegerField(default=0, help_text="Backoff steps taken in the current outage or maintenance.")
     periodic_task = models.ForeignKey(
         PeriodicTask,
         null=True,
@@ -32,53 +55,76 @@ class ServiceCheck(models.Model):
         help_text="Celery Periodic Task associated with this check."
     )
 
+    # Fields mirrored into the check's PeriodicTask
+    SCHEDULE_FIELDS = ('name', 'interval', 'active')
+
+    class Meta:
+        indexes = [
+            # dispatch_due_checks: active=True AND next_run_at <= now ORDER BY next_run_at
+            models.Index(fields=['next_run_at'], condition=models.Q(active=True), name='servicecheck_due_idx'),
+        ]
+
     def __str__(self):
         return self.name
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_schedule_state = instance._schedule_state()
+        return instance
+
+    def _schedule_state(self):
+        # Read from __dict__ so deferred fields are not loaded just to compare them
+        return tuple(self.__dict__.get(field) for field in self.SCHEDULE_FIELDS)
+
+    def _schedule_changed(self, update_fields):
+        if update_fields is not None and not set(update_fields) & set(self.SCHEDULE_FIELDS):
+            return False
+        return getattr(self, '_loaded_schedule_state', None) != self._schedule_state()
+
     def save(self, *args, **kwargs):
+        if self.next_run_at is None:
+            self.next_run_at = initial_next_run(timezone.now(), self.interval)
         is_new = not self.pk
+        schedule_changed = is_new or self._schedule_changed(kwargs.get('update_fields'))
         super().save(*args, **kwargs)  # Save the instance first to ensure self.id is available
 
-        if is_new:
-            schedule, created = IntervalSchedule.objects.get_or_create(
-                every=self.interval,
-                period=IntervalSchedule.SECONDS,
-            )
+        if batched_scheduling_enabled():
+            # The dispatch_due_checks tick drives this check; drop any per-check task left over
+            # from the periodic_task mode so beat stops scheduling it.
+            if self.periodic_task_id:
+                PeriodicTask.objects.filter(pk=self.periodic_task_id).delete()
+                self.periodic_task = None
+                super().save(update_fields=['periodic_task'])
+            return
+
+        # Saves that leave name, interval and active untouched (status writes, admin edits of
+        # other fields) must not touch the beat tables: every PeriodicTask save bumps
+        # PeriodicTasks.last_update and makes beat reload its whole schedule.
+        if self.periodic_task_id and not schedule_changed:
+            return
+
+        schedule, created = IntervalSchedule.objects.get_or_create(
+            every=self.interval,
+            period=IntervalSchedule.SECONDS,
+        )
+        if self.periodic_task:
+            self.periodic_task.interval = schedule
+            self.periodic_task.name = f'Service Check: {self.name}'
+            self.periodic_task.task = 'monitoring.tasks.run_service_check'
+            self.periodic_task.args = json.dumps([self.id])
+            self.periodic_task.enabled = self.active
+            self.periodic_task.save()
+        else: # New check, or periodic_task is null for an existing one: create it
             self.periodic_task = PeriodicTask.objects.create(
                 interval=schedule,
                 name=f'Service Check: {self.name}',
                 task='monitoring.tasks.run_service_check', # Task to be executed
                 args=json.dumps([self.id]), # Pass the ID as a JSON-encoded list
-                enabled=True,
+                enabled=self.active,
             )
-        else:  # Existing ServiceCheck
-            if self.periodic_task:
-                # Ensure the schedule is updated or created if it doesn't exist
-                schedule, created = IntervalSchedule.objects.get_or_create(
-                    every=self.interval,
-                    period=IntervalSchedule.SECONDS,
-                )
-                self.periodic_task.interval = schedule
-                self.periodic_task.name = f'Service Check: {self.name}'
-                self.periodic_task.task = 'monitoring.tasks.run_service_check'
-                self.periodic_task.args = json.dumps([self.id])
-                self.periodic_task.enabled = True
-                self.periodic_task.save()
-            else: # If for some reason periodic_task is null for an existing service check, create it
-                schedule, created = IntervalSchedule.objects.get_or_create(
-                    every=self.interval,
-                    period=IntervalSchedule.SECONDS,
-                )
-                self.periodic_task = PeriodicTask.objects.create(
-                    interval=schedule,
-                    name=f'Service Check: {self.name}',
-                    task='monitoring.tasks.run_service_check',
-                    args=json.dumps([self.id]), # Pass the ID as a JSON-encoded list
-                    enabled=True,
-                )
-        # Ensure the periodic_task foreign key is saved if it was just created or updated
-        if is_new or (self.periodic_task and not self.periodic_task.pk):
             super().save(update_fields=['periodic_task'])
+        self._loaded_schedule_state = self._schedule_state()
 
     def delete(self, *args, **kwargs):
         if self.periodic_task:
@@ -87,19 +133,138 @@ class ServiceCheck(models.Model):
 
 
 class CheckResult(models.Model):
-    service = models.ForeignKey(ServiceCheck, on_delete=models.CASCADE, related_name='results')
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Covered by checkresult_service_ts_idx, so no separate index on service_id
+    service = models.ForeignKey(ServiceCheck, on_delete=models.CASCADE, related_name='results', db_index=False)
+    timestamp = models.DateTimeField(default=timezone.now)
     success = models.BooleanField(default=False)
     response_time = models.FloatField(null=True, blank=True, help_text="Tempo de resposta em segundos")
+    # HTTP phase timings; null when the phase did not happen (e.g. no connect on a kept-alive connection)
+    dns_time = models.FloatField(null=True, blank=True, help_text="Resolução DNS em segundos")
+    connect_time = models.FloatField(null=True, blank=True, help_text="Conexão TCP em segundos")
+    tls_time = models.FloatField(null=True, blank=True, help_text="Handshake TLS em segundos")
+    ttfb = models.FloatField(null=True, blank=True, help_text="Tempo até o primeiro byte, desde o envio da requisição, em segundos")
     status_code = models.IntegerField(null=True, blank=True)
     message = models.TextField(null=True, blank=True)
 
     class Meta:
-        ordering = ['-timestamp']
+        indexes = [
+            # service_detail history, per-service time ranges and API cursor pages (id breaks timestamp ties)
+            models.Index(fields=['service', '-timestamp', '-id'], name='checkresult_service_ts_idx'),
+            # Failure streak backfill: service's failures ORDER BY timestamp DESC
+            models.Index(fields=['service', '-timestamp'], condition=models.Q(success=False), name='checkresult_service_fail_idx'),
+            # Cross-service time ranges: rollup compaction, retention purge, dashboard recent results, API cursor pages
+            models.Index(fields=['timestamp', 'id'], name='checkresult_ts_idx'),
+        ]
 
     def __str__(self):
         return f"{self.service.name} - {self.timestamp.strftime('%Y-%m-%d %H:%M:%S')} - {'OK' if self.success else 'FAIL'}"
 
+class SampleBlock(models.Model):
+    """
+    One service's probe samples for one hour, packed column by column (see monitoring.samples).
+
+    Used instead of a CheckResult row per probe when BATMON_SAMPLE_STORAGE is 'blocks'.
+    """
+    # Covered by unique_sample_block, so no separate index on service_id
+    service = models.ForeignKey(ServiceCheck, on_delete=models.CASCADE, related_name='sample_blocks', db_index=False)
+    start = models.DateTimeField(help_text="Start (UTC) of the hour the samples belong to")
+    count = models.IntegerField(default=0)
+    successes = models.IntegerField(default=0)
+    last_offset = models.IntegerField(default=0, help_text="Milliseconds from start to the last appended sample")
+    # Little-endian int32 milliseconds from the previous sample (the first one from start)
+    timestamps = models.BinaryField(default=bytes)
+    # Little-endian float32 seconds, NaN for probes without a response time
+    response_times = models.BinaryField(default=bytes)
+    # Bit i (LSB first) set when sample i succeeded
+    success_bitmap = models.BinaryField(default=bytes)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['service', 'start'], name='unique_sample_block'),
+        ]
+        indexes = [
+            # Cross-service time ranges: rollup compaction, retention purge
+            models.Index(fields=['start'], name='sampleblock_start_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.service.name} - {self.count} samples @ {self.start.strftime('%Y-%m-%d %H:%M')}"
+
+
+class CheckResultRollup(models.Model):
+    RESOLUTION_CHOICES = [
+        ('1m', '1 minute'),
+        ('1h', '1 hour'),
+        ('1d', '1 day'),
+    ]
+
+    # Covered by unique_rollup_bucket, so no separate index on service_id
+    service = models.ForeignKey(ServiceCheck, on_delete=models.CASCADE, related_name='rollups', db_index=False)
+    resolution = models.CharField(max_length=2, choices=RESOLUTION_CHOICES)
+    bucket_start = models.DateTimeField()
+    count = models.IntegerField(default=0)
+    successes = models.IntegerField(default=0)
+    response_time_count = models.IntegerField(default=0, help_text="Results with a response time in this bucket")
+    response_time_sum = models.FloatField(default=0)
+    response_time_min = models.FloatField(null=True, blank=True)
+    response_time_max = models.FloatField(null=True, blank=True)
+    response_time_p95 = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['service', 'resolution', 'bucket_start'], name='unique_rollup_bucket'),
+        ]
+        indexes = [
+            # All services' buckets in a time window (status page and dashboard charts)
+            models.Index(fields=['resolution', 'bucket_start'], name='rollup_window_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.service.name} - {self.resolution} @ {self.bucket_start.strftime('%Y-%m-%d %H:%M')}"
+
+    @property
+    def response_time_avg(self):
+        if not self.response_time_count:
+            return None
+        return self.response_time_sum / self.response_time_count
+
+    @property
+    def uptime_ratio(self):
+        if not self.count:
+            return None
+        return self.successes / self.count
+
+class Incident(models.Model):
+    """An outage: from the check that failed after a success to the next successful one."""
+    # Covered by incident_service_idx, so no separate index on service_id
+    service = models.ForeignKey(ServiceCheck, on_delete=models.CASCADE, related_name='incidents', db_index=False)
+    started_at = models.DateTimeField(help_text="Time of the first failed check.")
+    ended_at = models.DateTimeField(null=True, blank=True, help_text="Time of the check that succeeded again; empty while ongoing.")
+    first_error = models.TextField(null=True, blank=True, help_text="Message of the first failed check.")
+    failed_probes = models.PositiveIntegerField(default=0, help_text="Failed checks during the incident.")
+
+    class Meta:
+        ordering = ['-started_at']
+        constraints = [
+            # Also finds a service's open incident on every failed check
+            models.UniqueConstraint(fields=['service'], condition=models.Q(ended_at__isnull=True), name='unique_open_incident'),
+        ]
+        indexes = [
+            # Incidents of one service, latest first (detail page, alert logs)
+            models.Index(fields=['service', '-started_at'], name='incident_service_idx'),
+            # Incidents in a time range (SLA report, dashboard, API cursor pages)
+            models.Index(fields=['started_at', 'id'], name='incident_start_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.service.name} down since {self.started_at.strftime('%Y-%m-%d %H:%M:%S')}"
+
+    @property
+    def duration(self):
+        if self.ended_at is None:
+            return None
+        return self.ended_at - self.started_at
+
 class Alert(models.Model):
     ALERT_TYPE_CHOICES = [
         ('email', 'Email'),
@@ -130,9 +295,19 @@ class AlertLog(models.Model):
     message_sent = models.TextField()
     success = models.BooleanField(default=False)
     response_message = models.TextField(null=True, blank=True)
+    # Indexed by alertlog_incident_idx, which the migration builds concurrently
+    incident = models.ForeignKey(Incident, on_delete=models.SET_NULL, null=True, blank=True, related_name='alert_logs',
+                                 db_index=False, help_text="Latest incident of the service when the alert was sent.")
 
     class Meta:
-        ordering = ['-timestamp']
+        indexes = [
+            # Failure streak backfill: alert's last successful delivery
+            models.Index(fields=['alert', '-timestamp'], condition=models.Q(success=True), name='alertlog_alert_sent_idx'),
+            # Dashboard recent alerts, retention purge and API cursor pages
+            models.Index(fields=['timestamp', 'id'], name='alertlog_ts_idx'),
+            # ?incident= filter, and SET NULL when an incident is deleted
+            models.Index(fields=['incident'], name='alertlog_incident_idx'),
+        ]
 
     def __str__(self):
         return f"Log for {self.alert.service.name} ({self.alert.get_alert_type_display()}) - {self.timestamp.strftime('%Y-%m-%d %H:%M:%S')}"
@@ -147,6 +322,10 @@ class MaintenanceWindow(models.Model):
 
     class Meta:
         ordering = ['-start_time']
+        indexes = [
+            # "Is anything in maintenance now?": active=True AND start_time <= now AND end_time >= now
+            models.Index(fields=['start_time', 'end_time'], condition=models.Q(active=True), name='maintenance_active_idx'),
+        ]
 
     def __str__(self):
         return f"{self.title} ({self.start_time.strftime('%Y-%m-%d %H:%M')} - {self.end_time.strftime('%Y-%m-%d %H:%M')})"
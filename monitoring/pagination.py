@@ -0,0 +1,86 @@
+import base64
+
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class TimestampCursorPagination(BasePagination):
+    """
+    Keyset pagination over ``(timestamp, id)``, newest first.
+
+    Each page is one indexed range query, however deep the client has
+    paged, and rows inserted meanwhile never shift later pages. The opaque
+    cursor is the (timestamp, id) of the last row served. The view's
+    ``timestamp_field`` names the timestamp column, ``timestamp`` by default.
+    """
+    page_size = 100
+    max_page_size = 1000
+    page_size_query_param = 'page_size'
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        page_size = self.get_page_size(request)
+        field = getattr(view, 'timestamp_field', 'timestamp')
+        queryset = queryset.order_by(f'-{field}', '-id')
+
+        position = self.decode_cursor(request)
+        if position is not None:
+            timestamp, pk = position
+            # (timestamp, id) < position, written so the timestamp index still bounds the scan
+            queryset = queryset.filter(**{f'{field}__lte': timestamp}).exclude(**{field: timestamp, 'id__gte': pk})
+
+        page = list(queryset[:page_size + 1])
+        self.next_position = None
+        if len(page) > page_size:
+            page = page[:page_size]
+            self.next_position = (getattr(page[-1], field), page[-1].id)
+        return page
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(page_size, self.max_page_size))
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            timestamp, pk = base64.urlsafe_b64decode(encoded.encode()).decode().rsplit('|', 1)
+            timestamp = parse_datetime(timestamp)
+            pk = int(pk)
+        except (TypeError, ValueError, UnicodeDecodeError):
+            raise NotFound(self.invalid_cursor_message)
+        if timestamp is None:
+            raise NotFound(self.invalid_cursor_message)
+        return timestamp, pk
+
+    def encode_cursor(self, position):
+        timestamp, pk = position
+        encoded = base64.urlsafe_b64encode(f"{timestamp.isoformat()}|{pk}".encode()).decode()
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        return self.encode_cursor(self.next_position)
+
+    def get_paginated_response(self, data):
+        return Response({'next': self.get_next_link(), 'results': data})
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
@@ -0,0 +1,155 @@
+"""
+Optional daily range partitioning of CheckResult on PostgreSQL.
+
+Once the table has been converted with ``manage.py partition_checkresults
+--convert``, expiring raw results is a cheap partition drop instead of a
+large DELETE. Everything here is a no-op on other databases or on an
+unpartitioned table.
+"""
+import logging
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.db import connection, transaction
+
+from .models import CheckResult
+
+logger = logging.getLogger(__name__)
+
+PARTITION_SUFFIX_FORMAT = '%Y%m%d'
+
+
+def _table():
+    return CheckResult._meta.db_table
+
+
+def _partition_name(day):
+    return f"{_table()}_p{day.strftime(PARTITION_SUFFIX_FORMAT)}"
+
+
+def is_partitioned():
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", [_table()])
+        row = cursor.fetchone()
+    return bool(row) and row[0] == 'p'
+
+
+def list_partitions():
+    """Return ``[(name, day)]`` for every daily partition of CheckResult, oldest first."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class parent ON pg_inherits.inhparent = parent.oid "
+            "JOIN pg_class child ON pg_inherits.inhrelid = child.oid "
+            "WHERE parent.relname = %s",
+            [_table()],
+        )
+        names = [row[0] for row in cursor.fetchall()]
+
+    prefix = f"{_table()}_p"
+    partitions = []
+    for name in names:
+        if not name.startswith(prefix):
+            continue  # e.g. the default partition
+        try:
+            day = datetime.strptime(name[len(prefix):], PARTITION_SUFFIX_FORMAT).replace(tzinfo=dt_timezone.utc)
+        except ValueError:
+            continue
+        partitions.append((name, day))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+def _create_partition(cursor, day):
+    qn = connection.ops.quote_name
+    cursor.execute(
+        f"CREATE TABLE IF NOT EXISTS {qn(_partition_name(day))} PARTITION OF {qn(_table())} "
+        f"FOR VALUES FROM (%s) TO (%s)",
+        [day, day + timedelta(days=1)],
+    )
+
+
+def ensure_partitions(now, days_ahead):
+    """Create the daily partitions for today and the next ``days_ahead`` days."""
+    if not is_partitioned():
+        return 0
+    today = now.astimezone(dt_timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    existing = {name for name, _ in list_partitions()}
+    created = 0
+    with connection.cursor() as cursor:
+        for offset in range(days_ahead + 1):
+            day = today + timedelta(days=offset)
+            if _partition_name(day) not in existing:
+                _create_partition(cursor, day)
+                created += 1
+    return created
+
+
+def drop_partitions_before(cutoff):
+    """Drop every daily partition whose whole range is older than ``cutoff``."""
+    if not is_partitioned():
+        return []
+    qn = connection.ops.quote_name
+    dropped = []
+    for name, day in list_partitions():
+        if day + timedelta(days=1) > cutoff:
+            break
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f"ALTER TABLE {qn(_table())} DETACH PARTITION {qn(name)}")
+            cursor.execute(f"DROP TABLE {qn(name)}")
+        dropped.append(name)
+        logger.info(f"Dropped expired CheckResult partition {name}.")
+    return dropped
+
+
+def convert_to_partitioned(now, days_ahead):
+    """
+    Rebuild CheckResult as a table range-partitioned by day on ``timestamp``.
+
+    Existing rows are copied into daily partitions and the old table is
+    dropped. The primary key becomes ``(id, timestamp)``, as PostgreSQL
+    requires the partition key in every unique constraint. Run this with
+    workers stopped: it rewrites the whole table in one transaction.
+    """
+    if connection.vendor != 'postgresql':
+        raise RuntimeError("CheckResult partitioning requires PostgreSQL.")
+    if is_partitioned():
+        raise RuntimeError(f"{_table()} is already partitioned.")
+
+    qn = connection.ops.quote_name
+    table = _table()
+    legacy = f"{table}_legacy"
+    service_table = CheckResult._meta.get_field('service').related_model._meta.db_table
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"ALTER TABLE {qn(table)} RENAME TO {qn(legacy)}")
+        cursor.execute(
+            f"CREATE TABLE {qn(table)} (LIKE {qn(legacy)} INCLUDING DEFAULTS INCLUDING IDENTITY) "
+            f"PARTITION BY RANGE (\"timestamp\")"
+        )
+        cursor.execute(f"CREATE TABLE {qn(table + '_default')} PARTITION OF {qn(table)} DEFAULT")
+
+        cursor.execute(f"SELECT min(\"timestamp\") FROM {qn(legacy)}")
+        oldest = cursor.fetchone()[0] or now
+        day = oldest.astimezone(dt_timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+        last_day = now.astimezone(dt_timezone.utc) + timedelta(days=days_ahead)
+        while day <= last_day:
+            _create_partition(cursor, day)
+            day += timedelta(days=1)
+
+        cursor.execute(f"INSERT INTO {qn(table)} OVERRIDING SYSTEM VALUE SELECT * FROM {qn(legacy)}")
+        cursor.execute(
+            f"SELECT setval(pg_get_serial_sequence(%s, 'id'), COALESCE((SELECT max(id) FROM {qn(table)}), 0) + 1, false)",
+            [table],
+        )
+        # Drop the old table before adding keys and indexes so their names are free again.
+        cursor.execute(f"DROP TABLE {qn(legacy)}")
+        cursor.execute(f"ALTER TABLE {qn(table)} ADD PRIMARY KEY (id, \"timestamp\")")
+        cursor.execute(
+            f"ALTER TABLE {qn(table)} ADD FOREIGN KEY (service_id) REFERENCES {qn(service_table)} (id) "
+            f"DEFERRABLE INITIALLY DEFERRED"
+        )
+        with connection.schema_editor(atomic=False) as editor:
+            for statement in editor._model_indexes_sql(CheckResult):
+                editor.execute(statement)
+    logger.info(f"Converted {table} to daily range partitions.")
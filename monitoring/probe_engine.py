@@ -0,0 +1,253 @@
+import asyncio
+import logging
+import os
+import time
+from collections import defaultdict
+
+import httpx
+from django.conf import settings
+
+from . import dns_cache, icmp, metrics
+from .http_client import async_timed_get, get_async_http_client, max_connections_per_host
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PROBE_CONCURRENCY = 500
+
+_loop = None
+
+
+def _event_loop():
+    """
+    The worker process's long-lived event loop.
+
+    Reusing one loop across batches lets the pooled async HTTP client keep
+    its connections alive between run_service_check_batch tasks.
+    """
+    global _loop
+    if _loop is None or _loop.is_closed():
+        _loop = asyncio.new_event_loop()
+    return _loop
+
+
+def _forget_loop():
+    global _loop
+    _loop = None
+
+
+os.register_at_fork(after_in_child=_forget_loop)
+
+
+async def async_check_ping(service_check):
+    try:
+        response_time = await icmp.get_async_pinger().ping(service_check.url_or_host, service_check.timeout)
+        return {
+            'success': True,
+            'response_time': response_time,
+            'message': f"Echo reply in {response_time * 1000:.2f} ms"
+        }
+    except asyncio.TimeoutError:
+        return {
+            'success': False,
+            'message': f"Ping timed out after {service_check.timeout} seconds."
+        }
+    except icmp.ICMPUnavailable:
+        return await async_check_ping_command(service_check)
+    except icmp.NoIPv4Address:
+        return await async_check_ping_command(service_check) # The ICMP engine is IPv4 only
+    except (icmp.PingError, OSError) as e:
+        return {
+            'success': False,
+            'message': str(e)
+        }
+
+
+async def async_check_ping_command(service_check):
+    start_time = time.time()
+    try:
+        command = ['ping', '-c', '1', '-W', str(service_check.timeout), service_check.url_or_host]
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=service_check.timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise
+        rtt, summary = icmp.parse_ping_output(stdout.decode(errors='replace'))
+
+        if process.returncode == 0:
+            return {
+                'success': True,
+                'response_time': rtt if rtt is not None else time.time() - start_time,
+                'message': summary
+            }
+        else:
+            return {
+                'success': False,
+                'message': stderr.decode(errors='replace').strip() or summary
+            }
+    except asyncio.TimeoutError:
+        return {
+            'success': False,
+            'message': f"Ping timed out after {service_check.timeout} seconds."
+        }
+    except Exception as e:
+        return {
+            'success': False,
+            'message': str(e)
+        }
+
+
+async def async_check_http(service_check, client):
+    try:
+        response, response_time, timings = await async_timed_get(client, service_check.url_or_host, service_check.timeout)
+
+        if 200 <= response.status_code < 300:
+            return {
+                'success': True,
+                'response_time': response_time,
+                **timings.as_result(),
+                'status_code': response.status_code,
+                'message': f"Status code: {response.status_code}"
+            }
+        else:
+            return {
+                'success': False,
+                'response_time': response_time,
+                **timings.as_result(),
+                'status_code': response.status_code,
+                'message': f"Unexpected status code: {response.status_code}"
+            }
+    except httpx.TimeoutException:
+        return {
+            'success': False,
+            'message': f"Request timed out after {service_check.timeout} seconds."
+        }
+    except httpx.HTTPError as e:
+        return {
+            'success': False,
+            'message': str(e)
+        }
+
+
+async def async_open_connection(host, addresses, port, timeout):
+    """Async counterpart of tasks.connect_tcp."""
+    if not addresses:
+        raise OSError(f"No addresses for {host}")
+    last_error = None
+    for address in addresses:
+        try:
+            return await asyncio.wait_for(asyncio.open_connection(address, port), timeout=timeout)
+        except asyncio.TimeoutError:
+            raise
+        except OSError as e:
+            last_error = e
+    raise last_error
+
+
+async def async_check_tcp(service_check):
+    try:
+        host, port = service_check.url_or_host.split(':')
+        port = int(port)
+
+        dns_started = time.time()
+        addresses = await asyncio.wait_for(dns_cache.async_resolve(host, service_check.timeout),
+                                           timeout=service_check.timeout)
+        start_time = time.time()
+        reader, writer = await async_open_connection(host, addresses, port, service_check.timeout)
+        response_time = (time.time() - start_time)
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+        return {
+            'success': True,
+            'response_time': response_time,
+            'dns_time': start_time - dns_started,
+            'message': f"Successfully connected to {host}:{port}"
+        }
+    except asyncio.TimeoutError:
+        return {
+            'success': False,
+            'message': f"Connection to {service_check.url_or_host} timed out after {service_check.timeout} seconds."
+        }
+    except (OSError, ValueError) as e:
+        return {
+            'success': False,
+            'message': str(e)
+        }
+
+
+def _origin(url):
+    try:
+        url = httpx.URL(url)
+    except httpx.InvalidURL:
+        return url
+    return (url.scheme, url.host, url.port)
+
+
+class ProbeEngine:
+    """
+    Runs HTTP, TCP and ping checks for many ServiceCheck rows concurrently
+    inside a single event loop, bounded by a per-worker concurrency limit
+    and, for HTTP, by BATMON_HTTP_MAX_CONNECTIONS_PER_HOST per host.
+
+    The engine only probes; persisting results and triggering alerts is left
+    to the caller so that it stays free of blocking ORM calls.
+    """
+
+    def __init__(self, concurrency=None):
+        if concurrency is None:
+            concurrency = getattr(settings, 'BATMON_PROBE_CONCURRENCY', DEFAULT_PROBE_CONCURRENCY)
+        self.concurrency = concurrency
+
+    async def _probe(self, service_check, semaphore, host_semaphores, client):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                return await self._run_check(service_check, host_semaphores, client)
+            finally:
+                metrics.CHECK_DURATION.observe(time.perf_counter() - started, check_type=service_check.check_type)
+
+    async def _run_check(self, service_check, host_semaphores, client):
+        if service_check.check_type == 'ping':
+            return await async_check_ping(service_check)
+        elif service_check.check_type == 'http':
+            async with host_semaphores[_origin(service_check.url_or_host)]:
+                return await async_check_http(service_check, client)
+        elif service_check.check_type == 'tcp':
+            return await async_check_tcp(service_check)
+        return {
+            'success': False,
+            'message': f"Unknown check type: {service_check.check_type}"
+        }
+
+    async def run_async(self, service_checks):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        per_host = max_connections_per_host()
+        host_semaphores = defaultdict(lambda: asyncio.Semaphore(per_host))
+        client = get_async_http_client()
+        results = await asyncio.gather(
+            *(self._probe(service_check, semaphore, host_semaphores, client) for service_check in service_checks),
+            return_exceptions=True,
+        )
+
+        outcomes = []
+        for service_check, result in zip(service_checks, results):
+            if isinstance(result, BaseException):
+                logger.error(f"Probe for '{service_check.name}' raised: {result!r}")
+                result = {'success': False, 'message': str(result)}
+            outcomes.append((service_check, result))
+        return outcomes
+
+    def run(self, service_checks):
+        """Probe every check in ``service_checks`` and return ``(service_check, result)`` pairs."""
+        service_checks = list(service_checks)
+        if not service_checks:
+            return []
+        return _event_loop().run_until_complete(self.run_async(service_checks))
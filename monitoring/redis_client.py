@@ -0,0 +1,42 @@
+import redis
+import redis.asyncio
+from django.conf import settings
+
+_client = None
+_subscriber_client = None
+
+
+def _redis_url():
+    return getattr(settings, 'BATMON_REDIS_URL', None) or settings.CELERY_BROKER_URL
+
+
+def get_redis():
+    """
+    Process-wide Redis client for BatMon's own pub/sub and counters.
+
+    Uses BATMON_REDIS_URL, falling back to the Celery broker. redis-py
+    resets its connection pool after a fork, so the client is safe to share
+    with prefork worker children.
+    """
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(_redis_url(), socket_connect_timeout=2, socket_timeout=5, health_check_interval=30)
+    return _client
+
+
+def get_subscriber_redis():
+    """Like get_redis, but without a read timeout, for long-lived pub/sub subscriptions."""
+    global _subscriber_client
+    if _subscriber_client is None:
+        _subscriber_client = redis.Redis.from_url(_redis_url(), socket_connect_timeout=2, health_check_interval=30)
+    return _subscriber_client
+
+
+def create_async_subscriber_redis():
+    """
+    A new ``redis.asyncio`` client for a long-lived subscription.
+
+    Not shared: asyncio connections belong to the event loop that opened
+    them, so the caller owns the client and closes it when done.
+    """
+    return redis.asyncio.Redis.from_url(_redis_url(), socket_connect_timeout=2, health_check_interval=30)
@@ -0,0 +1,355 @@
+import atexit
+import logging
+import threading
+import time
+
+from celery.signals import worker_process_shutdown, worker_shutdown
+from django.conf import settings
+from django.db import InterfaceError, IntegrityError, OperationalError, close_old_connections, connection, transaction
+from django.utils import timezone
+
+from . import incidents, metrics, samples, scheduling
+from .models import ServiceCheck, CheckResult
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RESULT_BUFFER_SIZE = 500
+DEFAULT_RESULT_BUFFER_MAX_AGE = 2.0
+# Results kept for retry while the database is unreachable; beyond this the oldest are dropped.
+DEFAULT_RESULT_BUFFER_LIMIT = 50000
+
+
+# ServiceCheck columns owned by the sink, written together after each flush. next_run_at is
+# only written for adaptively scheduled checks (None in a queued state leaves it to the dispatcher).
+STATE_FIELDS = (
+    'status_atual', 'last_check', 'consecutive_failures', 'alerted_failures', 'flap_score', 'backoff_level',
+    'next_run_at',
+)
+
+
+class PendingResult:
+    __slots__ = ('service_check', 'check_result', 'previous_status', 'result', 'consecutive_failures', 'alerted_failures')
+
+    def __init__(self, service_check, check_result, previous_status, result):
+        self.service_check = service_check
+        self.check_result = check_result
+        self.previous_status = previous_status
+        self.result = result
+        # Snapshot of the failure streak right after this result
+        self.consecutive_failures = service_check.consecutive_failures
+        self.alerted_failures = service_check.alerted_failures
+
+
+def write_status_updates(updates):
+    """
+    Write ``{service_check_id: state}``, with ``state`` holding the STATE_FIELDS values, in one statement.
+
+    On PostgreSQL this is a single ``UPDATE ... FROM (VALUES ...)`` touching
+    only those columns; other backends fall back to one ``UPDATE`` per row.
+    A None next_run_at keeps the stored one.
+    """
+    if not updates:
+        return
+    if connection.vendor != 'postgresql':
+        for service_check_id, state in updates.items():
+            fields = dict(zip(STATE_FIELDS, state))
+            if fields['next_run_at'] is None:
+                del fields['next_run_at']
+            ServiceCheck.objects.filter(pk=service_check_id).update(**fields)
+        return
+
+    qn = connection.ops.quote_name
+    values_sql = ', '.join(
+        ['(%s::bigint, %s, %s::timestamptz, %s::integer, %s::integer, %s::double precision, %s::smallint, '
+         '%s::timestamptz)'] * len(updates)
+    )
+    params = []
+    for service_check_id, state in updates.items():
+        params.extend([service_check_id, *state])
+    assignments = ', '.join(
+        f"{qn(field)} = COALESCE(v.{qn(field)}, s.{qn(field)})" if field == 'next_run_at' else f"{qn(field)} = v.{qn(field)}"
+        for field in STATE_FIELDS
+    )
+    columns = ', '.join(qn(field) for field in STATE_FIELDS)
+    sql = (
+        f"UPDATE {qn(ServiceCheck._meta.db_table)} AS s "
+        f"SET {assignments} "
+        f"FROM (VALUES {values_sql}) AS v(id, {columns}) "
+        f"WHERE s.id = v.id"
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+
+
+class ResultSink:
+    """
+    Per-process buffer of check outcomes.
+
+    Results are inserted with ``bulk_create`` (or, with BATMON_SAMPLE_STORAGE
+    'blocks', appended to their SampleBlocks, keeping rows only for failures
+    and state changes) and status changes written with
+    write_status_updates once the buffer holds ``max_size`` entries or its
+    oldest entry is ``max_age`` seconds old. Failures and recoveries also open,
+    extend and close Incidents. Callbacks registered with
+    ``on_flush`` run after each flush, once the rows are in the database.
+
+    Each flush is one transaction. If the database is unreachable, the
+    results stay buffered (up to BATMON_RESULT_BUFFER_LIMIT) for the next
+    flush; results that can never be written, such as those of a service
+    deleted meanwhile, are dropped instead.
+
+    The sink also keeps each service's failure streak (consecutive_failures
+    and alerted_failures) up to date as results arrive, so alert triggers
+    never have to re-read the result history, along with the flap score and
+    backoff level behind adaptive scheduling and, for adaptively scheduled
+    checks, the next run they imply.
+    """
+
+    def __init__(self, max_size=None, max_age=None):
+        self._max_size = max_size
+        self._max_age = max_age
+        self._lock = threading.RLock()
+        self._results = []
+        self._status_updates = {}
+        self._pending_state = {}
+        self._oldest = None
+        self._flush_callbacks = []
+        self._flusher = None
+
+    @property
+    def max_size(self):
+        if self._max_size is not None:
+            return self._max_size
+        return getattr(settings, 'BATMON_RESULT_BUFFER_SIZE', DEFAULT_RESULT_BUFFER_SIZE)
+
+    @property
+    def max_age(self):
+        if self._max_age is not None:
+            return self._max_age
+        return getattr(settings, 'BATMON_RESULT_BUFFER_MAX_AGE', DEFAULT_RESULT_BUFFER_MAX_AGE)
+
+    def on_flush(self, callback):
+        self._flush_callbacks.append(callback)
+        return callback
+
+    def __len__(self):
+        with self._lock:
+            return len(self._results)
+
+    def _load_state(self, service_check):
+        # Writes still sitting in the buffer are newer than what the instance was loaded with.
+        with self._lock:
+            state = self._pending_state.get(service_check.id)
+            if state is not None:
+                for field, value in zip(STATE_FIELDS, state):
+                    if value is not None:
+                        setattr(service_check, field, value)
+
+    def previous_status(self, service_check):
+        """Status of ``service_check`` including writes still sitting in the buffer."""
+        with self._lock:
+            state = self._pending_state.get(service_check.id)
+            return state[0] if state is not None else service_check.status_atual
+
+    def failure_streak(self, service_check):
+        """``(consecutive_failures, alerted_failures)`` of ``service_check``, including buffered writes."""
+        with self._lock:
+            state = self._pending_state.get(service_check.id)
+            if state is not None:
+                return state[2], state[3]
+            return service_check.consecutive_failures, service_check.alerted_failures
+
+    def add(self, service_check, result, timestamp=None):
+        """Buffer a probe result and the status and failure streak it implies for ``service_check``."""
+        timestamp = timestamp or timezone.now()
+        success = result.get('success', False)
+        check_result = CheckResult(
+            service=service_check,
+            timestamp=timestamp,
+            success=success,
+            response_time=result.get('response_time'),
+            dns_time=result.get('dns_time'),
+            connect_time=result.get('connect_time'),
+            tls_time=result.get('tls_time'),
+            ttfb=result.get('ttfb'),
+            status_code=result.get('status_code'),
+            message=result.get('message')
+        )
+        with self._lock:
+            self._load_state(service_check)
+            previous_status = service_check.status_atual
+            service_check.status_atual = 'ok' if success else 'fail'
+            service_check.last_check = timestamp
+            if success:
+                service_check.consecutive_failures = 0
+                service_check.alerted_failures = 0
+            else:
+                service_check.consecutive_failures += 1
+            self._reschedule(service_check, previous_status, timestamp)
+            self._results.append(PendingResult(service_check, check_result, previous_status, result))
+            self._queue_status(service_check)
+        self._maybe_flush()
+        return previous_status
+
+    def update_status(self, service_check, status_atual, timestamp=None, not_after=None):
+        """
+        Buffer a status-only write (e.g. entering maintenance); the failure streak is left as it is.
+
+        ``not_after`` bounds the next run of an adaptively scheduled check,
+        e.g. to the end of its maintenance window.
+        """
+        with self._lock:
+            self._load_state(service_check)
+            previous_status = service_check.status_atual
+            service_check.status_atual = status_atual
+            service_check.last_check = timestamp or timezone.now()
+            self._reschedule(service_check, previous_status, service_check.last_check, not_after)
+            self._queue_status(service_check)
+        self._maybe_flush()
+        return previous_status
+
+    def mark_alerted(self, service_check, failures):
+        """
+        Record that the streak's 'fails X times' alerts up to ``failures`` have been sent.
+
+        Ignored if the service has recovered (or started a new, shorter
+        streak) since the result that triggered them.
+        """
+        with self._lock:
+            self._load_state(service_check)
+            if service_check.consecutive_failures < failures or service_check.alerted_failures >= failures:
+                return
+            service_check.alerted_failures = failures
+            self._queue_status(service_check)
+
+    def _reschedule(self, service_check, previous_status, timestamp, not_after=None):
+        scheduling.record_outcome(service_check, service_check.status_atual, previous_status)
+        if service_check.adaptive_schedule:
+            service_check.next_run_at = scheduling.adaptive_next_run(service_check, timestamp, not_after)
+
+    def _queue_status(self, service_check):
+        state = tuple(
+            None if field == 'next_run_at' and not service_check.adaptive_schedule else getattr(service_check, field)
+            for field in STATE_FIELDS
+        )
+        self._status_updates[service_check.id] = state
+        self._pending_state[service_check.id] = state
+        if self._oldest is None:
+            self._oldest = time.monotonic()
+        self._ensure_flusher()
+
+    def _maybe_flush(self):
+        with self._lock:
+            full = len(self._results) >= self.max_size
+            stale = self._oldest is not None and time.monotonic() - self._oldest >= self.max_age
+        if full or stale:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._results = self._results, []
+            status_updates, self._status_updates = self._status_updates, {}
+            self._oldest = None
+            if not pending and not status_updates:
+                return []
+            # Failures and the successes that end them: the rows block storage keeps, and what moves incidents.
+            transitions = [p for p in pending if samples.keeps_row(p.check_result.success, p.previous_status)]
+            block_storage = samples.block_storage_enabled()
+            try:
+                # One transaction, so a retry after an error cannot write rows, samples or failed probes twice.
+                with transaction.atomic():
+                    if block_storage:
+                        samples.append_samples([p.check_result for p in pending])
+                        CheckResult.objects.bulk_create([p.check_result for p in transitions], batch_size=1000)
+                    else:
+                        CheckResult.objects.bulk_create([p.check_result for p in pending], batch_size=1000)
+                    incidents.record(transitions)
+                    write_status_updates(status_updates)
+            except (OperationalError, InterfaceError):
+                # Put everything back so a transient DB error does not lose results.
+                self._requeue(pending, status_updates)
+                raise
+            except IntegrityError as e:
+                # Retrying cannot help; typically a service was deleted while its results sat in the buffer.
+                kept, kept_updates = self._without_deleted_checks(pending, status_updates)
+                if len(kept) == len(pending) and len(kept_updates) == len(status_updates):
+                    logger.error(f"Discarding {len(pending)} check results that cannot be written: {e}")
+                    self._forget_state(status_updates)
+                    return []
+                logger.warning(f"Dropping {len(pending) - len(kept)} check results of deleted services.")
+                self._forget_state(status_updates.keys() - kept_updates.keys())
+                self._requeue(kept, kept_updates)
+                return self.flush()
+            except Exception as e:
+                logger.error(f"Discarding {len(pending)} check results that cannot be written: {e}", exc_info=True)
+                self._forget_state(status_updates)
+                raise
+        logger.info(f"Flushed {len(pending)} check results and {len(status_updates)} status updates.")
+
+        try:
+            for callback in self._flush_callbacks:
+                try:
+                    callback(pending)
+                except Exception as e:
+                    logger.error(f"Result sink flush callback {callback!r} failed: {e}", exc_info=True)
+        finally:
+            # Kept until the callbacks are done so they see each service's latest state.
+            self._forget_state(status_updates)
+        return pending
+
+    def _requeue(self, pending, status_updates):
+        self._results = pending + self._results
+        self._status_updates = {**status_updates, **self._status_updates}
+        self._oldest = time.monotonic()
+        limit = getattr(settings, 'BATMON_RESULT_BUFFER_LIMIT', DEFAULT_RESULT_BUFFER_LIMIT)
+        if len(self._results) > limit:
+            logger.error(f"Result buffer over {limit} entries; dropping the {len(self._results) - limit} oldest.")
+            del self._results[:len(self._results) - limit]
+
+    def _forget_state(self, service_check_ids):
+        with self._lock:
+            for service_check_id in service_check_ids:
+                if service_check_id not in self._status_updates:
+                    self._pending_state.pop(service_check_id, None)
+
+    def _without_deleted_checks(self, pending, status_updates):
+        existing = set(ServiceCheck.objects.filter(
+            pk__in={p.service_check.id for p in pending} | status_updates.keys()
+        ).values_list('pk', flat=True))
+        return (
+            [p for p in pending if p.service_check.id in existing],
+            {service_check_id: state for service_check_id, state in status_updates.items() if service_check_id in existing},
+        )
+
+    def _ensure_flusher(self):
+        # Started lazily so it lives in the (forked) worker process that owns the buffer.
+        if self._flusher is None or not self._flusher.is_alive():
+            self._flusher = threading.Thread(target=self._flush_periodically, name='batmon-result-sink', daemon=True)
+            self._flusher.start()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(max(self.max_age / 2, 0.1))
+            try:
+                self._maybe_flush()
+            except Exception as e:
+                logger.error(f"Periodic result sink flush failed: {e}", exc_info=True)
+            finally:
+                # This thread never ends, so honour CONN_MAX_AGE like a request or task would.
+                close_old_connections()
+
+
+result_sink = ResultSink()
+metrics.RESULT_BUFFER_DEPTH.set_function(lambda: len(result_sink))
+
+
+def flush_result_sink(**kwargs):
+    try:
+        result_sink.flush()
+    except Exception as e:
+        logger.error(f"Could not flush buffered check results on shutdown: {e}", exc_info=True)
+
+
+worker_process_shutdown.connect(flush_result_sink, weak=False)
+worker_shutdown.connect(flush_result_sink, weak=False)
+atexit.register(flush_result_sink)
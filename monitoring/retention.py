@@ -0,0 +1,74 @@
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Max, Min
+
+from . import partitions, samples
+from .models import CheckResult, CheckResultRollup, AlertLog, SampleBlock
+
+logger = logging.getLogger(__name__)
+
+# Days to keep each tier; None keeps it forever.
+DEFAULT_RETENTION = {
+    'raw': 7,
+    '1m': 90,
+    '1h': None,
+    '1d': None,
+    'alertlog': 90,
+}
+DEFAULT_PURGE_CHUNK_SIZE = 10000
+DEFAULT_PARTITION_DAYS_AHEAD = 3
+
+
+def retention_days(tier):
+    retention = {**DEFAULT_RETENTION, **getattr(settings, 'BATMON_RETENTION', {})}
+    return retention.get(tier)
+
+
+def purge_in_chunks(queryset, chunk_size):
+    """
+    Delete ``queryset`` in primary-key ranges of ``chunk_size``.
+
+    Each range is its own short DELETE (and transaction in autocommit mode),
+    so a large purge never holds locks on the whole table for long.
+    """
+    bounds = queryset.aggregate(low=Min('pk'), high=Max('pk'))
+    if bounds['low'] is None:
+        return 0
+    deleted = 0
+    low = bounds['low']
+    while low <= bounds['high']:
+        count, _ = queryset.filter(pk__gte=low, pk__lt=low + chunk_size).delete()
+        deleted += count
+        low += chunk_size
+    return deleted
+
+
+def purge_expired(now):
+    """Apply BATMON_RETENTION to raw results, rollups and alert logs. Returns deleted counts per tier."""
+    chunk_size = getattr(settings, 'BATMON_PURGE_CHUNK_SIZE', DEFAULT_PURGE_CHUNK_SIZE)
+    deleted = {}
+
+    days = retention_days('raw')
+    if days is not None:
+        cutoff = now - timedelta(days=days)
+        # Whole expired days go away as partition drops; the chunked DELETE handles the rest.
+        dropped = partitions.drop_partitions_before(cutoff)
+        deleted['raw_partitions'] = len(dropped)
+        deleted['raw'] = purge_in_chunks(CheckResult.objects.filter(timestamp__lt=cutoff), chunk_size)
+        # Blocks go once their whole hour has expired.
+        deleted['raw_blocks'] = purge_in_chunks(SampleBlock.objects.filter(start__lte=cutoff - samples.BLOCK_SPAN), chunk_size)
+    partitions.ensure_partitions(now, getattr(settings, 'BATMON_PARTITION_DAYS_AHEAD', DEFAULT_PARTITION_DAYS_AHEAD))
+
+    for resolution, _ in CheckResultRollup.RESOLUTION_CHOICES:
+        days = retention_days(resolution)
+        if days is not None:
+            rollups = CheckResultRollup.objects.filter(resolution=resolution, bucket_start__lt=now - timedelta(days=days))
+            deleted[resolution] = purge_in_chunks(rollups, chunk_size)
+
+    days = retention_days('alertlog')
+    if days is not None:
+        deleted['alertlog'] = purge_in_chunks(AlertLog.objects.filter(timestamp__lt=now - timedelta(days=days)), chunk_size)
+
+    return deleted
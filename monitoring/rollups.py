@@ -0,0 +1,178 @@
+import math
+from collections import defaultdict
+from datetime import timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db.models import Max
+
+from . import samples
+from .models import CheckResult, CheckResultRollup
+
+RESOLUTIONS = {
+    '1m': timedelta(minutes=1),
+    '1h': timedelta(hours=1),
+    '1d': timedelta(days=1),
+}
+
+# Each resolution is compacted from the next finer one; '1m' is built from the raw samples.
+PARENT_RESOLUTION = {
+    '1h': '1m',
+    '1d': '1h',
+}
+
+DEFAULT_ROLLUP_LOOKBACK = 300
+
+ROLLUP_UPDATE_FIELDS = [
+    'count', 'successes', 'response_time_count', 'response_time_sum',
+    'response_time_min', 'response_time_max', 'response_time_p95',
+]
+
+
+def bucket_start(dt, resolution):
+    """Start (UTC) of the ``resolution`` bucket containing ``dt``."""
+    dt = dt.astimezone(dt_timezone.utc)
+    if resolution == '1m':
+        return dt.replace(second=0, microsecond=0)
+    if resolution == '1h':
+        return dt.replace(minute=0, second=0, microsecond=0)
+    if resolution == '1d':
+        return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    raise ValueError(f"Unknown rollup resolution: {resolution}")
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = max(math.ceil(q * len(sorted_values)) - 1, 0)
+    return sorted_values[index]
+
+
+def weighted_percentile(weighted_values, q):
+    """
+    Percentile of ``(value, weight)`` pairs.
+
+    Used to merge child p95s into a parent bucket. This is an approximation:
+    exact percentiles cannot be recombined from per-bucket percentiles.
+    """
+    weighted_values = sorted(pair for pair in weighted_values if pair[0] is not None and pair[1])
+    total = sum(weight for _, weight in weighted_values)
+    if not total:
+        return None
+    threshold = q * total
+    cumulative = 0
+    for value, weight in weighted_values:
+        cumulative += weight
+        if cumulative >= threshold:
+            return value
+    return weighted_values[-1][0]
+
+
+def _upsert(rollups):
+    CheckResultRollup.objects.bulk_create(
+        rollups,
+        batch_size=1000,
+        update_conflicts=True,
+        unique_fields=['service', 'resolution', 'bucket_start'],
+        update_fields=ROLLUP_UPDATE_FIELDS,
+    )
+
+
+def rollup_raw_results(start, end):
+    """(Re)build the '1m' buckets in ``[start, end)`` from raw CheckResult rows or SampleBlocks."""
+    start = bucket_start(start, '1m')
+    if samples.block_storage_enabled():
+        rows = samples.sample_rows(start, end)
+    else:
+        rows = CheckResult.objects.filter(timestamp__gte=start, timestamp__lt=end).values_list(
+            'service_id', 'timestamp', 'success', 'response_time'
+        ).order_by().iterator(chunk_size=5000)
+
+    buckets = defaultdict(lambda: {'count': 0, 'successes': 0, 'response_times': []})
+    for service_id, timestamp, success, response_time in rows:
+        bucket = buckets[(service_id, bucket_start(timestamp, '1m'))]
+        bucket['count'] += 1
+        if success:
+            bucket['successes'] += 1
+        if response_time is not None:
+            bucket['response_times'].append(response_time)
+
+    rollups = []
+    for (service_id, start_of_bucket), bucket in buckets.items():
+        response_times = sorted(bucket['response_times'])
+        rollups.append(CheckResultRollup(
+            service_id=service_id,
+            resolution='1m',
+            bucket_start=start_of_bucket,
+            count=bucket['count'],
+            successes=bucket['successes'],
+            response_time_count=len(response_times),
+            response_time_sum=sum(response_times),
+            response_time_min=response_times[0] if response_times else None,
+            response_time_max=response_times[-1] if response_times else None,
+            response_time_p95=percentile(response_times, 0.95),
+        ))
+    _upsert(rollups)
+    return len(rollups)
+
+
+def rollup_buckets(resolution, start, end):
+    """(Re)build ``resolution`` buckets in ``[start, end)`` from the next finer resolution."""
+    child_resolution = PARENT_RESOLUTION[resolution]
+    start = bucket_start(start, resolution)
+    children = CheckResultRollup.objects.filter(
+        resolution=child_resolution, bucket_start__gte=start, bucket_start__lt=end
+    ).order_by()
+
+    buckets = defaultdict(list)
+    for child in children.iterator(chunk_size=5000):
+        buckets[(child.service_id, bucket_start(child.bucket_start, resolution))].append(child)
+
+    rollups = []
+    for (service_id, start_of_bucket), group in buckets.items():
+        minimums = [child.response_time_min for child in group if child.response_time_min is not None]
+        maximums = [child.response_time_max for child in group if child.response_time_max is not None]
+        rollups.append(CheckResultRollup(
+            service_id=service_id,
+            resolution=resolution,
+            bucket_start=start_of_bucket,
+            count=sum(child.count for child in group),
+            successes=sum(child.successes for child in group),
+            response_time_count=sum(child.response_time_count for child in group),
+            response_time_sum=sum(child.response_time_sum for child in group),
+            response_time_min=min(minimums) if minimums else None,
+            response_time_max=max(maximums) if maximums else None,
+            response_time_p95=weighted_percentile(
+                [(child.response_time_p95, child.response_time_count) for child in group], 0.95
+            ),
+        ))
+    _upsert(rollups)
+    return len(rollups)
+
+
+def rebuild(start, end):
+    """(Re)build every resolution's buckets from ``start`` to ``end``, finest first."""
+    counts = {'1m': rollup_raw_results(start, end)}
+    for resolution in ('1h', '1d'):
+        counts[resolution] = rollup_buckets(resolution, start, end)
+    return counts
+
+
+def compact(now):
+    """
+    Bring every rollup resolution up to date as of ``now``.
+
+    Raw results are re-aggregated from the newest stored '1m' bucket, so a
+    run after compaction was stopped for a while catches up on the gap, and
+    at least the last BATMON_ROLLUP_LOOKBACK seconds (so late, buffered
+    writes are picked up). Then the current and previous hour and day are
+    rebuilt from the finer buckets. Every step is an idempotent upsert.
+    """
+    lookback = getattr(settings, 'BATMON_ROLLUP_LOOKBACK', DEFAULT_ROLLUP_LOOKBACK)
+    start = now - timedelta(seconds=lookback)
+    newest = CheckResultRollup.objects.filter(resolution='1m').aggregate(newest=Max('bucket_start'))['newest']
+    if newest is not None:
+        start = min(start, newest)
+    counts = {'1m': rollup_raw_results(start, now)}
+    for resolution in ('1h', '1d'):
+        counts[resolution] = rollup_buckets(resolution, min(start, now - RESOLUTIONS[resolution]), now)
+    return counts
@@ -0,0 +1,196 @@
+"""
+Compact storage of raw probe samples (BATMON_SAMPLE_STORAGE = 'blocks').
+
+Instead of one CheckResult row per probe, each service gets one SampleBlock
+per hour holding three packed columns: int32 millisecond deltas between
+samples, float32 response times and a success bitmap, about 8 bytes per
+probe against a few hundred for a row and its index entries. CheckResult
+rows are then only written for failures and state changes, which keep their
+message, status code and phase timings; a success following a success is
+nothing but its sample.
+
+The result sink appends to the blocks on every flush, under a row lock, in
+the same transaction as the rows it writes. Decoded samples feed the 1m
+rollups, the service detail history and the samples API.
+"""
+import array
+import itertools
+import math
+import sys
+from collections import defaultdict, namedtuple
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import CheckResult, SampleBlock
+
+SAMPLE_STORAGE_ROWS = 'rows'
+SAMPLE_STORAGE_BLOCKS = 'blocks'
+
+BLOCK_SPAN = timedelta(hours=1)
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+Sample = namedtuple('Sample', ['timestamp', 'success', 'response_time'])
+
+
+def block_storage_enabled():
+    """True when raw samples go to SampleBlocks instead of one CheckResult row each."""
+    return getattr(settings, 'BATMON_SAMPLE_STORAGE', SAMPLE_STORAGE_ROWS) == SAMPLE_STORAGE_BLOCKS
+
+
+def block_start(dt):
+    """Start (UTC) of the block holding ``dt``."""
+    return dt.astimezone(dt_timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+
+def _milliseconds(dt):
+    # Truncated with integer arithmetic: rounding float timestamps could put a sample and its row 1 ms apart.
+    return (dt - EPOCH) // timedelta(milliseconds=1)
+
+
+def keeps_row(success, previous_status):
+    """Whether a result also gets a CheckResult row: failures, and successes that end another status."""
+    return not success or previous_status != 'ok'
+
+
+def _packed(typecode, values):
+    packed = array.array(typecode, values)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def _unpacked(typecode, data):
+    values = array.array(typecode)
+    values.frombytes(bytes(data))
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def append(block, samples):
+    """Append ``samples`` (in any order) to ``block``; they must fall within its hour."""
+    deltas, response_times = [], []
+    bitmap = bytearray(block.success_bitmap)
+    index = block.count
+    last_offset = block.last_offset
+    for sample in samples:
+        offset = _milliseconds(sample.timestamp) - _milliseconds(block.start)
+        deltas.append(offset - last_offset) # last_offset is 0 in an empty block
+        last_offset = offset
+        response_times.append(math.nan if sample.response_time is None else sample.response_time)
+        if index % 8 == 0:
+            bitmap.append(0)
+        if sample.success:
+            bitmap[index // 8] |= 1 << (index % 8)
+            block.successes += 1
+        index += 1
+    block.timestamps = bytes(block.timestamps) + _packed('i', deltas)
+    block.response_times = bytes(block.response_times) + _packed('f', response_times)
+    block.success_bitmap = bytes(bitmap)
+    block.count = index
+    block.last_offset = last_offset
+
+
+def decode(block):
+    """The samples of ``block``, oldest first."""
+    offsets = itertools.accumulate(_unpacked('i', block.timestamps))
+    response_times = _unpacked('f', block.response_times)
+    bitmap = bytes(block.success_bitmap)
+    samples = [
+        Sample(
+            block.start + timedelta(milliseconds=offset),
+            bool(bitmap[i // 8] >> (i % 8) & 1),
+            # float32 keeps about 7 significant digits; do not show more.
+            None if math.isnan(response_times[i]) else round(response_times[i], 6),
+        )
+        for i, offset in enumerate(offsets)
+    ]
+    # Samples flushed by different workers may have been appended out of order.
+    samples.sort(key=lambda sample: sample.timestamp)
+    return samples
+
+
+def append_samples(check_results):
+    """
+    Add unsaved CheckResults to their services' blocks.
+
+    Missing blocks are created, then the affected ones are locked, appended
+    to and written back with one bulk UPDATE.
+    """
+    grouped = defaultdict(list)
+    for check_result in check_results:
+        grouped[(check_result.service_id, block_start(check_result.timestamp))].append(
+            Sample(check_result.timestamp, check_result.success, check_result.response_time)
+        )
+    if not grouped:
+        return
+    with transaction.atomic():
+        SampleBlock.objects.bulk_create(
+            [SampleBlock(service_id=service_id, start=start) for service_id, start in grouped],
+            ignore_conflicts=True,
+        )
+        # Locked in a fixed order, so concurrent flushes cannot deadlock.
+        blocks = (
+            SampleBlock.objects.select_for_update()
+            .filter(service_id__in={service_id for service_id, _ in grouped}, start__in={start for _, start in grouped})
+            .order_by('service_id', 'start')
+        )
+        changed = []
+        for block in blocks:
+            samples = grouped.get((block.service_id, block.start))
+            if samples:
+                append(block, samples)
+                changed.append(block)
+        SampleBlock.objects.bulk_update(
+            changed, ['count', 'successes', 'last_offset', 'timestamps', 'response_times', 'success_bitmap'],
+            batch_size=500,
+        )
+
+
+def sample_rows(start, end, service_id=None):
+    """``(service_id, timestamp, success, response_time)`` of every sample in ``[start, end)``."""
+    blocks = SampleBlock.objects.filter(start__gte=block_start(start), start__lt=end).order_by()
+    if service_id is not None:
+        blocks = blocks.filter(service_id=service_id)
+    for block in blocks.iterator(chunk_size=500):
+        for sample in decode(block):
+            if start <= sample.timestamp < end:
+                yield block.service_id, *sample
+
+
+def service_samples(service_id, start, end):
+    """``[Sample]`` of one service in ``[start, end)``, oldest first, whichever storage is in use."""
+    if block_storage_enabled():
+        return [Sample(*row[1:]) for row in sample_rows(start, end, service_id)]
+    rows = CheckResult.objects.filter(service_id=service_id, timestamp__gte=start, timestamp__lt=end)
+    return [Sample(*row) for row in rows.order_by('timestamp').values_list('timestamp', 'success', 'response_time')]
+
+
+def recent_results(service, limit):
+    """
+    The latest ``limit`` samples of ``service``, newest first, as unsaved CheckResults.
+
+    Samples that also have a row (failures and state changes) are replaced
+    by it, so the message and status code show where there is one.
+    """
+    # Enough hours to hold ``limit`` probes at the service's interval, plus the current partial hour.
+    hours = math.ceil(limit * service.interval / BLOCK_SPAN.total_seconds()) + 1
+    blocks = list(service.sample_blocks.order_by('-start')[:hours])
+    samples = sorted((sample for block in blocks for sample in decode(block)),
+                     key=lambda sample: sample.timestamp, reverse=True)[:limit]
+    if not samples:
+        return []
+    # Samples are stored to the millisecond, rows to the microsecond.
+    oldest, newest = samples[-1].timestamp, samples[0].timestamp + timedelta(milliseconds=1)
+    rows = {
+        _milliseconds(row.timestamp): row
+        for row in service.results.filter(timestamp__gte=oldest - timedelta(milliseconds=1), timestamp__lt=newest)
+    }
+    return [
+        rows.get(_milliseconds(sample.timestamp)) or CheckResult(
+            service=service, timestamp=sample.timestamp, success=sample.success, response_time=sample.response_time,
+        )
+        for sample in samples
+    ]
@@ -0,0 +1,112 @@
+import random
+from datetime import timedelta
+
+from django.conf import settings
+
+SCHEDULER_MODE_PERIODIC_TASK = 'periodic_task'
+SCHEDULER_MODE_BATCHED = 'batched'
+
+DEFAULT_DISPATCH_BATCH_SIZE = 100
+DEFAULT_DISPATCH_MAX_PER_TICK = 10000
+DEFAULT_DISPATCH_JITTER = 0.1
+DEFAULT_ADAPTIVE_RECHECK_INTERVAL = 10
+DEFAULT_ADAPTIVE_RECHECKS = 2
+DEFAULT_ADAPTIVE_BACKOFF_FACTOR = 2.0
+DEFAULT_ADAPTIVE_MAX_BACKOFF = 10
+DEFAULT_ADAPTIVE_FLAP_THRESHOLD = 0.25
+# Weight of the latest result in the flap score (an exponential moving average of state changes).
+FLAP_WEIGHT = 0.1
+
+
+def batched_scheduling_enabled():
+    """True when checks are driven by the dispatch_due_checks tick instead of one PeriodicTask each."""
+    return getattr(settings, 'BATMON_SCHEDULER_MODE', SCHEDULER_MODE_PERIODIC_TASK) == SCHEDULER_MODE_BATCHED
+
+
+def initial_next_run(now, interval):
+    """
+    First run of a new check, at a random phase within its interval.
+
+    Spreading the phase means checks created together (or sharing an
+    interval) do not all land on the same dispatcher tick.
+    """
+    return now + timedelta(seconds=random.uniform(0, interval))
+
+
+def next_run_after(now, interval):
+    """Next run one interval from ``now``, with a small symmetric jitter."""
+    jitter = interval * getattr(settings, 'BATMON_DISPATCH_JITTER', DEFAULT_DISPATCH_JITTER)
+    return now + timedelta(seconds=interval + random.uniform(-jitter / 2, jitter / 2))
+
+
+def chunked(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _setting(service_check, field, name, default):
+    value = getattr(service_check, field)
+    return value if value is not None else getattr(settings, name, default)
+
+
+def record_outcome(service_check, status, previous_status):
+    """
+    Update the flap score and backoff level of ``service_check`` for a new status.
+
+    Called by the result sink after it has updated the failure streak, for
+    probe results ('ok'/'fail') and maintenance skips alike.
+    """
+    if status == 'maintenance':
+        service_check.backoff_level += 1
+        return
+    changed = previous_status in ('ok', 'fail') and status != previous_status
+    service_check.flap_score = service_check.flap_score * (1 - FLAP_WEIGHT) + (FLAP_WEIGHT if changed else 0)
+    rechecks = getattr(settings, 'BATMON_ADAPTIVE_RECHECKS', DEFAULT_ADAPTIVE_RECHECKS)
+    if status == 'ok' or previous_status == 'maintenance':
+        service_check.backoff_level = 0
+    elif service_check.consecutive_failures > rechecks:
+        service_check.backoff_level += 1
+
+
+def is_flapping(service_check):
+    return service_check.flap_score >= _setting(
+        service_check, 'flap_threshold', 'BATMON_ADAPTIVE_FLAP_THRESHOLD', DEFAULT_ADAPTIVE_FLAP_THRESHOLD)
+
+
+def adaptive_delay(service_check):
+    """
+    Seconds until the next probe of an adaptively scheduled check, in its current state.
+
+    - the first BATMON_ADAPTIVE_RECHECKS failures of a streak are confirmed
+      after the short recheck_interval;
+    - longer streaks and maintenance back off geometrically, up to
+      max_interval;
+    - a flapping check (flap_score at or above its threshold) keeps its
+      plain interval, with neither fast re-checks nor backoff.
+    """
+    interval = service_check.interval
+    if is_flapping(service_check):
+        return interval
+    if service_check.backoff_level:
+        factor = getattr(settings, 'BATMON_ADAPTIVE_BACKOFF_FACTOR', DEFAULT_ADAPTIVE_BACKOFF_FACTOR)
+        max_interval = service_check.max_interval or interval * getattr(
+            settings, 'BATMON_ADAPTIVE_MAX_BACKOFF', DEFAULT_ADAPTIVE_MAX_BACKOFF)
+        # Capping the exponent keeps factor ** level finite for checks that have been down for ages.
+        return max(interval, min(interval * factor ** min(service_check.backoff_level, 64), max_interval))
+    if service_check.status_atual == 'fail':
+        return min(interval, _setting(
+            service_check, 'recheck_interval', 'BATMON_ADAPTIVE_RECHECK_INTERVAL', DEFAULT_ADAPTIVE_RECHECK_INTERVAL))
+    return interval
+
+
+def adaptive_next_run(service_check, now, not_after=None):
+    """
+    Next run of an adaptively scheduled check, from adaptive_delay with the usual jitter.
+
+    ``not_after`` (e.g. the end of the maintenance window the check is in)
+    brings the run forward so backoff never outlasts the reason for it.
+    """
+    next_run = next_run_after(now, adaptive_delay(service_check))
+    if not_after is not None and not_after < next_run:
+        next_run = max(not_after, now)
+    return next_run
@@ -1,11 +1,12 @@
 from rest_framework import serializers
-from .models import ServiceCheck, CheckResult, Alert, AlertLog, MaintenanceWindow
+from .models import ServiceCheck, CheckResult, Alert, AlertLog, Incident, MaintenanceWindow
 
 class ServiceCheckSerializer(serializers.ModelSerializer):
     class Meta:
         model = ServiceCheck
         fields = '__all__'
-        read_only_fields = ('status_atual', 'last_check', 'periodic_task')
+        read_only_fields = ('status_atual', 'last_check', 'next_run_at', 'periodic_task', 'consecutive_failures', 'alerted_failures',
+                            'flap_score', 'backoff_level')
 
 class CheckResultSerializer(serializers.ModelSerializer):
     service_name = serializers.CharField(source='service.name', read_only=True)
@@ -29,6 +30,17 @@ class AlertLogSerializer(serializers.ModelSerializer):
         fields = '__all__'
         read_only_fields = ('alert', 'timestamp')
 
+class IncidentSerializer(serializers.ModelSerializer):
+    service_name = serializers.CharField(source='service.name', read_only=True)
+    duration = serializers.SerializerMethodField()
+    class Meta:
+        model = Incident
+        fields = '__all__'
+
+    def get_duration(self, obj):
+        """Seconds; null while the incident is open."""
+        return None if obj.duration is None else obj.duration.total_seconds()
+
 class MaintenanceWindowSerializer(serializers.ModelSerializer):
     service_name = serializers.CharField(source='service.name', read_only=True)
     class Meta:
@@ -0,0 +1,171 @@
+"""
+Consistent-hash sharding of checks across probe nodes, for the batched scheduler.
+
+With BATMON_SHARDING, a worker started with a shard name (BATMON_SHARD)
+also consumes that shard's own queue and keeps the shard alive with a
+heartbeat in Redis. dispatch_due_checks places the live shards on a hash
+ring, BATMON_SHARD_VNODES points each, and publishes every due check to the
+queue of the shard owning its ID. A check thus keeps running on the same
+node, with that node's warm connection pools and DNS cache; when a shard
+joins or leaves, only the checks between it and its ring neighbours move
+(about 1/N of them). Several workers may serve one shard.
+"""
+import bisect
+import hashlib
+import logging
+import os
+import socket
+import threading
+import time
+
+import redis
+from celery.signals import celeryd_after_setup, worker_ready, worker_shutting_down
+from django.conf import settings
+
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+SHARDS_KEY = 'batmon:shards'
+QUEUE_PREFIX = 'batmon.shard.'
+DEFAULT_SHARD_VNODES = 100
+DEFAULT_SHARD_HEARTBEAT_INTERVAL = 10
+DEFAULT_SHARD_TIMEOUT = 30
+
+
+def sharding_enabled():
+    return getattr(settings, 'BATMON_SHARDING', False)
+
+
+def current_shard():
+    """The shard this worker serves: BATMON_SHARD from the settings or the environment, or None."""
+    return getattr(settings, 'BATMON_SHARD', None) or os.environ.get('BATMON_SHARD') or None
+
+
+def shard_queue(shard):
+    return QUEUE_PREFIX + shard
+
+
+def _hash(key):
+    # Stable across processes and Python versions, unlike hash().
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """Shards placed on a ring at ``vnodes`` points each; an ID belongs to the next point clockwise."""
+
+    def __init__(self, shards, vnodes=None):
+        self.shards = frozenset(shards)
+        vnodes = vnodes or getattr(settings, 'BATMON_SHARD_VNODES', DEFAULT_SHARD_VNODES)
+        points = sorted((_hash(f"{shard}#{i}"), shard) for shard in self.shards for i in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._owners = [shard for _, shard in points]
+
+    def __bool__(self):
+        return bool(self.shards)
+
+    def owner(self, service_check_id):
+        index = bisect.bisect(self._hashes, _hash(str(service_check_id))) % len(self._hashes)
+        return self._owners[index]
+
+    def assign(self, items, key=lambda item: item):
+        """``{shard: [item, ...]}`` for ``items``, keeping their order within each shard."""
+        assigned = {}
+        for item in items:
+            assigned.setdefault(self.owner(key(item)), []).append(item)
+        return assigned
+
+
+def _timeout():
+    return getattr(settings, 'BATMON_SHARD_TIMEOUT', DEFAULT_SHARD_TIMEOUT)
+
+
+def live_shards(client=None, now=None):
+    """Names of the shards with a worker that sent a heartbeat within BATMON_SHARD_TIMEOUT seconds."""
+    client = client or get_redis()
+    now = time.time() if now is None else now
+    members = client.zrangebyscore(SHARDS_KEY, now - _timeout(), '+inf')
+    return {(member.decode() if isinstance(member, bytes) else member).rsplit('|', 1)[0] for member in members}
+
+
+def heartbeat(member, client=None, now=None):
+    """Mark ``member`` (``'<shard>|<worker>'``) alive and drop the members that stopped beating."""
+    client = client or get_redis()
+    now = time.time() if now is None else now
+    pipe = client.pipeline(transaction=False)
+    pipe.zadd(SHARDS_KEY, {member: now})
+    pipe.zremrangebyscore(SHARDS_KEY, '-inf', now - _timeout())
+    pipe.execute()
+
+
+_ring = None
+
+
+def current_ring():
+    """
+    The ring of the live shards, or None when there are none.
+
+    Rebuilt only when the set of live shards changed. If Redis cannot be
+    reached, the last known ring is kept.
+    """
+    global _ring
+    try:
+        shards = live_shards()
+    except (redis.RedisError, OSError) as e:
+        logger.warning(f"Could not read the live shards, keeping the last known ring: {e}")
+        return _ring
+    if _ring is None or _ring.shards != shards:
+        if _ring is not None:
+            logger.info(f"Shards changed from {sorted(_ring.shards)} to {sorted(shards)}; rebalancing checks.")
+        _ring = HashRing(shards)
+    return _ring or None
+
+
+_member = None
+_heartbeat_thread = None
+_leaving = threading.Event()
+
+
+@celeryd_after_setup.connect(weak=False)
+def consume_shard_queue(sender=None, instance=None, **kwargs):
+    global _member
+    shard = current_shard()
+    if not sharding_enabled() or shard is None:
+        return
+    instance.app.amqp.queues.select_add(shard_queue(shard))
+    _member = f"{shard}|{socket.gethostname()}:{os.getpid()}"
+    logger.info(f"Serving shard '{shard}' from queue {shard_queue(shard)}.")
+
+
+@worker_ready.connect(weak=False)
+def start_heartbeat(**kwargs):
+    # In the main worker process, once the pool has forked, so only one thread beats per worker.
+    global _heartbeat_thread
+    if _member is None or _heartbeat_thread is not None:
+        return
+    _heartbeat_thread = threading.Thread(target=_beat, name='batmon-shard-heartbeat', daemon=True)
+    _heartbeat_thread.start()
+
+
+def _beat():
+    while True:
+        try:
+            heartbeat(_member)
+        except (redis.RedisError, OSError) as e:
+            logger.warning(f"Could not send the shard heartbeat: {e}")
+        if _leaving.wait(getattr(settings, 'BATMON_SHARD_HEARTBEAT_INTERVAL', DEFAULT_SHARD_HEARTBEAT_INTERVAL)):
+            return
+
+
+@worker_shutting_down.connect(weak=False)
+def leave_shard(**kwargs):
+    # Leave as soon as shutdown starts instead of after BATMON_SHARD_TIMEOUT, so the checks move without a gap.
+    if _member is None:
+        return
+    _leaving.set()
+    if _heartbeat_thread is not None:
+        _heartbeat_thread.join(timeout=5) # A beat in flight must not re-add us after we left
+    try:
+        get_redis().zrem(SHARDS_KEY, _member)
+    except (redis.RedisError, OSError) as e:
+        logger.warning(f"Could not leave the shard: {e}")
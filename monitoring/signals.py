@@ -0,0 +1,24 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from . import status_cache
+from .maintenance_cache import publish_maintenance_change
+from .models import MaintenanceWindow, ServiceCheck
+
+
+@receiver(post_save, sender=MaintenanceWindow)
+@receiver(post_delete, sender=MaintenanceWindow)
+def maintenance_window_changed(sender, instance, **kwargs):
+    # Other processes must not reload the schedule before the change is visible to them.
+    transaction.on_commit(publish_maintenance_change)
+    status_cache.schedule_rebuild(None if instance.service_id is None else [instance.service_id])
+
+
+@receiver(post_save, sender=ServiceCheck)
+@receiver(post_delete, sender=ServiceCheck)
+def service_check_changed(sender, instance, update_fields=None, **kwargs):
+    # e.g. streak counters, next_run_at or ServiceCheck.save()'s own periodic_task write
+    if update_fields is not None and not update_fields & status_cache.RENDERED_FIELDS:
+        return
+    status_cache.schedule_rebuild([instance.pk])
@@ -0,0 +1,273 @@
+"""
+Availability, incidents and latency of services over an arbitrary time range.
+
+Everything is read from the rollups, never the raw results, and computed
+with NumPy over whole columns. The range is split at the edges of the
+maintenance windows that touch it, and each piece is covered by the fewest
+aligned buckets: whole days from '1d', whole hours from '1h', the minutes
+at the ends from '1m'. A 90-day range thus reads about 90 + 2 * 23 + 2 * 59
+buckets per service. Buckets inside a maintenance window of the service (or
+of every service) are left out, and so is that time.
+
+Incidents and downtime come from the Incident rows overlapping the range,
+clipped to it and without their time in maintenance; an incident entirely
+in maintenance does not count. MTTR is the mean downtime per incident, MTBF
+the mean monitored time between the incidents.
+
+Latency percentiles are approximate, like the ones merged into coarse
+rollups: p50 is the median of the bucket averages and p95 the percentile of
+the bucket p95s, both weighted by the number of response times.
+"""
+import math
+from datetime import datetime, timezone as dt_timezone
+
+import numpy as np
+from django.db.models import Q
+
+from .models import CheckResultRollup, Incident, MaintenanceWindow, ServiceCheck
+
+# Largest aligned bucket first.
+BUCKET_MINUTES = (('1d', 1440), ('1h', 60), ('1m', 1))
+IN_CHUNK_SIZE = 500
+
+# Read as one float64 array; the segment of a bucket is known from the query, so bucket_start is not fetched.
+SLA_FIELDS = (
+    'service_id', 'count', 'successes',
+    'response_time_count', 'response_time_sum', 'response_time_max', 'response_time_p95',
+)
+
+
+def _minute(dt, up=False):
+    seconds = dt.timestamp()
+    return math.ceil(seconds / 60) if up else math.floor(seconds / 60)
+
+
+def _datetime(minute):
+    return datetime.fromtimestamp(int(minute) * 60, dt_timezone.utc)
+
+
+def covering_buckets(start, end):
+    """``[(resolution, start minute)]``: the fewest aligned buckets exactly covering minutes ``[start, end)``."""
+    buckets = []
+    minute = start
+    while minute < end:
+        for resolution, size in BUCKET_MINUTES:
+            if minute % size == 0 and minute + size <= end:
+                buckets.append((resolution, minute))
+                minute += size
+                break
+    return buckets
+
+
+def grouped_percentile(groups, values, weights, q, size):
+    """
+    Weighted ``q`` percentile of ``values`` within each of ``size`` groups, NaN for empty groups.
+
+    Same definition as rollups.weighted_percentile: the first value, in
+    ascending order, at which the cumulative weight reaches ``q`` of the total.
+    """
+    result = np.full(size, np.nan)
+    kept = ~np.isnan(values) & (weights > 0)
+    groups, values, weights = groups[kept], values[kept], weights[kept]
+    if not len(values):
+        return result
+    order = np.lexsort((values, groups))
+    groups, values, weights = groups[order], values[order], weights[order]
+    cumulative = np.cumsum(weights)
+    totals = np.bincount(groups, weights=weights, minlength=size)
+    before = np.cumsum(totals) - totals
+    last = np.cumsum(np.bincount(groups, minlength=size)) - 1
+    index = np.minimum(np.searchsorted(cumulative, before + q * totals, side='left'), last)
+    present = totals > 0
+    result[present] = values[index[present]]
+    return result
+
+
+def _columns(rows, count):
+    return list(zip(*rows)) or [()] * count
+
+
+class Range:
+    """
+    The minutes ``[start, end)`` split into segments at the edges of the maintenance windows in them.
+
+    ``excluded[segment, service]`` is True where the service is in maintenance.
+    """
+
+    def __init__(self, start, end, service_ids, windows):
+        self.start, self.end = start, end
+        self.service_ids = service_ids
+        edges = {start, end}
+        clipped = []
+        for service_id, window_start, window_end in windows:
+            # Every minute a window touches is left out.
+            window_start = max(_minute(window_start), start)
+            window_end = min(_minute(window_end, up=True), end)
+            if window_start < window_end:
+                edges.update((window_start, window_end))
+                clipped.append((service_id, window_start, window_end))
+        self.edges = np.array(sorted(edges), dtype=np.int64)
+        self.excluded = np.zeros((len(self.edges) - 1, len(service_ids)), dtype=bool)
+        for service_id, window_start, window_end in clipped:
+            first, stop = np.searchsorted(self.edges, [window_start, window_end])
+            if service_id is None:
+                self.excluded[first:stop] = True
+            else:
+                column = self.service_index(np.array([service_id]))[0]
+                if column >= 0:
+                    self.excluded[first:stop, column] = True
+
+    def service_index(self, service_ids):
+        """Column of each service ID, -1 for services that are not part of the computation."""
+        index = np.searchsorted(self.service_ids, service_ids)
+        index = np.minimum(index, len(self.service_ids) - 1)
+        return np.where(self.service_ids[index] == service_ids, index, -1)
+
+    def segment(self, minutes):
+        return np.searchsorted(self.edges, minutes, side='right') - 1
+
+    def segments(self):
+        """``(segment, {resolution: [start minute]})`` of the segments some service is not in maintenance in."""
+        for segment in range(len(self.edges) - 1):
+            if not self.excluded[segment].all():
+                buckets = {}
+                for resolution, minute in covering_buckets(self.edges[segment], self.edges[segment + 1]):
+                    buckets.setdefault(resolution, []).append(minute)
+                yield segment, buckets
+
+    def monitored_minutes(self):
+        """Minutes of the range each service was not in maintenance."""
+        return (~self.excluded).T.astype(np.int64) @ np.diff(self.edges)
+
+    def included(self, columns, segments):
+        """Mask of the rows whose service is part of the computation and not in maintenance in their segment."""
+        keep = columns >= 0
+        keep[keep] = ~self.excluded[segments[keep], columns[keep]]
+        return keep
+
+
+def _filter_services(queryset, service_ids):
+    return queryset if service_ids is None else queryset.filter(service_id__in=service_ids)
+
+
+def _fetch_buckets(span, service_ids):
+    """The SLA_FIELDS of the buckets covering ``span`` as a float64 array (NULL is NaN), and the segment of each."""
+    arrays, segments = [np.empty((0, len(SLA_FIELDS)))], [np.empty(0, dtype=np.int64)]
+    for segment, buckets in span.segments():
+        for resolution, minutes in buckets.items():
+            for i in range(0, len(minutes), IN_CHUNK_SIZE):
+                queryset = CheckResultRollup.objects.filter(
+                    resolution=resolution, bucket_start__in=[_datetime(minute) for minute in minutes[i:i + IN_CHUNK_SIZE]]
+                ).order_by()
+                rows = np.array(list(_filter_services(queryset, service_ids).values_list(*SLA_FIELDS)), dtype=np.float64)
+                arrays.append(rows.reshape(-1, len(SLA_FIELDS)))
+                segments.append(np.full(len(arrays[-1]), segment, dtype=np.int64))
+    return np.concatenate(arrays), np.concatenate(segments)
+
+
+def _fetch_incidents(start, end, service_ids):
+    queryset = Incident.objects.filter(
+        Q(ended_at__isnull=True) | Q(ended_at__gt=_datetime(start)), started_at__lt=_datetime(end),
+    ).order_by()
+    return list(_filter_services(queryset, service_ids).values_list('service_id', 'started_at', 'ended_at'))
+
+
+def _incidents(span, rows):
+    """Per service: incidents with downtime outside maintenance, and that downtime in seconds."""
+    size = len(span.service_ids)
+    service_ids, starts, ends = _columns(rows, 3)
+    columns = span.service_index(np.array(service_ids, dtype=np.int64))
+    starts = np.array([started_at.timestamp() for started_at in starts], dtype=np.float64)
+    # An open incident lasts until the end of the range.
+    ends = np.array([np.inf if ended_at is None else ended_at.timestamp() for ended_at in ends], dtype=np.float64)
+    keep = columns >= 0
+    columns, starts, ends = columns[keep], starts[keep], ends[keep]
+
+    # Seconds of each incident (row) within each segment (column), then without the maintenance.
+    edges = span.edges * 60
+    overlap = np.clip(np.minimum(ends[:, None], edges[1:]) - np.maximum(starts[:, None], edges[:-1]), 0, None)
+    downtime = (overlap * ~span.excluded[:, columns].T).sum(axis=1)
+    counted = downtime > 0
+    return (
+        np.bincount(columns[counted], minlength=size),
+        np.bincount(columns, weights=downtime, minlength=size),
+    )
+
+
+def _optional(values, digits):
+    return [None if np.isnan(value) else round(float(value), digits) for value in values]
+
+
+def service_sla(since, until, service_ids=None, now=None):
+    """
+    Availability, incidents and latency of each service (or of ``service_ids``) in ``[since, until)``.
+
+    The range is widened to whole minutes and ends at ``now`` at the latest.
+    Returns one dict per service, in name order.
+    """
+    until = min(until, now or datetime.now(dt_timezone.utc))
+    start, end = _minute(since), max(_minute(until, up=True), _minute(since))
+
+    services = ServiceCheck.objects.order_by('id')
+    if service_ids is not None:
+        services = services.filter(id__in=service_ids)
+    services = list(services.values_list('id', 'name', 'interval'))
+    if not services:
+        return []
+    ids, names, intervals = (np.array(column) for column in zip(*services))
+    ids = ids.astype(np.int64)
+    size = len(ids)
+
+    windows = MaintenanceWindow.objects.filter(active=True, start_time__lt=_datetime(end), end_time__gt=_datetime(start))
+    if service_ids is not None:
+        windows = windows.filter(Q(service__isnull=True) | Q(service_id__in=ids.tolist()))
+    windows = windows.values_list('service_id', 'start_time', 'end_time')
+    span = Range(start, end, ids, windows)
+
+    rows, segments = _fetch_buckets(span, service_ids)
+    columns = span.service_index(rows[:, 0].astype(np.int64))
+    keep = span.included(columns, segments)
+    columns = columns[keep]
+    (_, counts, successes, response_time_counts, response_time_sums,
+     response_time_maxes, response_time_p95s) = rows[keep].T
+
+    probes = np.bincount(columns, weights=counts, minlength=size)
+    up = np.bincount(columns, weights=successes, minlength=size)
+    timed = np.bincount(columns, weights=response_time_counts, minlength=size)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        availability = np.where(probes > 0, up / probes * 100, np.nan)
+        average = np.where(timed > 0, np.bincount(columns, weights=response_time_sums, minlength=size) / timed, np.nan)
+        bucket_averages = np.where(response_time_counts > 0, response_time_sums / response_time_counts, np.nan)
+    p50 = grouped_percentile(columns, bucket_averages, response_time_counts, 0.5, size)
+    p95 = grouped_percentile(columns, response_time_p95s, response_time_counts, 0.95, size)
+    maximum = np.full(size, np.nan)
+    np.fmax.at(maximum, columns, response_time_maxes)
+
+    incidents, downtime = _incidents(span, _fetch_incidents(start, end, service_ids))
+    monitored = span.monitored_minutes() * 60
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mttr = np.where(incidents > 0, downtime / incidents, np.nan)
+        mtbf = np.where(incidents > 0, np.maximum(monitored - downtime, 0) / incidents, np.nan)
+
+    report = [
+        {
+            'service': int(service_id),
+            'name': str(name),
+            'probes': int(probe_count),
+            'availability': availability_pct,
+            'monitored_seconds': int(monitored_seconds),
+            'downtime_seconds': round(float(downtime_seconds)),
+            'incidents': int(incident_count),
+            'mttr_seconds': mttr_seconds,
+            'mtbf_seconds': mtbf_seconds,
+            'response_time': {'avg': avg, 'p50': median, 'p95': high, 'max': top},
+        }
+        for (service_id, name, probe_count, availability_pct, monitored_seconds, downtime_seconds, incident_count,
+             mttr_seconds, mtbf_seconds, avg, median, high, top) in zip(
+            ids, names, probes, _optional(availability, 4), monitored, downtime, incidents,
+            _optional(mttr, 1), _optional(mtbf, 1),
+            _optional(average, 6), _optional(p50, 6), _optional(p95, 6), _optional(maximum, 6),
+        )
+    ]
+    report.sort(key=lambda entry: entry['name'])
+    return report
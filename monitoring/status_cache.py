@@ -0,0 +1,201 @@
+"""
+Pre-rendered public status pages.
+
+The status page and the per-service detail pages are rendered to HTML and
+kept in the BATMON_STATUS_CACHE cache (Redis in production), so serving them
+costs no database queries. Pages are re-rendered in the background when a
+service's status changes, when a maintenance window is edited or starts or
+ends, and every BATMON_STATUS_CACHE_REFRESH seconds. Only a cold miss
+renders in the request. Charts are not part of the pages; they load their
+series from the chart API (see charts.py) as they scroll into view.
+"""
+import hashlib
+import logging
+import time
+import redis
+from django.conf import settings
+from kombu.exceptions import KombuError
+from django.core.cache import caches
+from django.db import transaction
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from . import samples
+from .maintenance_cache import maintenance_cache
+from .models import ServiceCheck
+
+logger = logging.getLogger(__name__)
+
+# charts.CHART_WINDOWS shown on the overview pages and on a service's detail page
+STATUS_CHART_WINDOW = '24h'
+DETAIL_CHART_WINDOW = '7d'
+
+DEFAULT_STATUS_CACHE = 'default'
+DEFAULT_STATUS_CACHE_REFRESH = 60
+# Without a refresh (beat down), a cached page is dropped after this many refresh periods.
+STALE_FACTOR = 5
+
+# ServiceCheck fields the pages show; saves that touch none of them need no re-render.
+RENDERED_FIELDS = frozenset({'name', 'url_or_host', 'check_type', 'interval', 'timeout', 'status_atual', 'last_check'})
+
+STATUS_PAGE_KEY = 'page'
+SERVICE_PAGE_KEY = 'service:{}'
+
+
+def _cache():
+    return caches[getattr(settings, 'BATMON_STATUS_CACHE', DEFAULT_STATUS_CACHE)]
+
+
+def _refresh_interval():
+    return getattr(settings, 'BATMON_STATUS_CACHE_REFRESH', DEFAULT_STATUS_CACHE_REFRESH)
+
+
+def status_page_context(now=None):
+    now = now or timezone.now()
+    services = list(ServiceCheck.objects.all())
+    for service in services:
+        # Check if service is under maintenance (global or service-specific)
+        service.in_maintenance = maintenance_cache.in_maintenance(service.id, now)
+        if service.in_maintenance:
+            service.display_status = 'maintenance'
+        else:
+            service.display_status = service.status_atual # Use actual status if not in maintenance
+
+    return {
+        'services': services,
+        'chart_window': STATUS_CHART_WINDOW,
+        'active_maintenance_windows': maintenance_cache.active_windows(now), # Ordered by start_time
+    }
+
+
+def service_detail_context(service, now=None):
+    # Check if service is under maintenance for detail page
+    service.in_maintenance = maintenance_cache.in_maintenance(service.id, now)
+    if service.in_maintenance:
+        service.display_status = 'maintenance'
+    else:
+        service.display_status = service.status_atual
+
+    # Fetch all historical results for the detail page
+    if samples.block_storage_enabled():
+        results = samples.recent_results(service, 100)
+    else:
+        results = service.results.all().order_by('-timestamp')[:100] # Limit to last 100 for performance
+
+    return {
+        'service': service,
+        'results': results,
+        # Open and closed on status changes, which re-render the page; an ongoing one shows no counts.
+        'incidents': service.incidents.all()[:10],
+        'chart_window': DETAIL_CHART_WINDOW,
+    }
+
+
+class CachedPage:
+    """A rendered page plus its validators and the moment it stops being current."""
+
+    def __init__(self, body, etag, last_modified, built_at, valid_until):
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified # Epoch seconds of the last change to body
+        self.built_at = built_at
+        self.valid_until = valid_until # Epoch seconds of the next maintenance start/end, or None
+
+    def is_stale(self, now):
+        return (
+            now - self.built_at >= _refresh_interval()
+            or (self.valid_until is not None and now > self.valid_until)
+        )
+
+
+def _build(key, template_name, context, previous, next_change):
+    body = render_to_string(template_name, context)
+    etag = f'"{hashlib.md5(body.encode()).hexdigest()}"'
+    now = time.time()
+    # An unchanged body keeps its Last-Modified, so clients keep getting 304s.
+    last_modified = previous.last_modified if previous and previous.etag == etag else now
+    page = CachedPage(body, etag, last_modified, now, next_change.timestamp() if next_change else None)
+    try:
+        _cache().set(key, page, timeout=_refresh_interval() * STALE_FACTOR)
+    except (redis.RedisError, OSError) as e:
+        logger.warning(f"Could not store rendered status page {key}: {e}")
+    return page
+
+
+def _get(key):
+    try:
+        return _cache().get(key)
+    except (redis.RedisError, OSError) as e:
+        logger.warning(f"Could not read rendered status page {key}: {e}")
+        return None
+
+
+def build_status_page(previous=None):
+    now = timezone.now()
+    return _build(STATUS_PAGE_KEY, 'monitoring/status.html', status_page_context(now), previous,
+                  maintenance_cache.next_change(now))
+
+
+def build_service_page(service, previous=None):
+    now = timezone.now()
+    return _build(SERVICE_PAGE_KEY.format(service.id), 'monitoring/service_detail.html',
+                  service_detail_context(service, now), previous, maintenance_cache.next_change(now, service.id))
+
+
+def get_status_page():
+    return _get(STATUS_PAGE_KEY) or build_status_page()
+
+
+def get_service_page(service_id):
+    """The cached detail page of ``service_id``; raises ServiceCheck.DoesNotExist for unknown ids."""
+    return _get(SERVICE_PAGE_KEY.format(service_id)) or build_service_page(ServiceCheck.objects.get(pk=service_id))
+
+
+def rebuild(service_ids=None, stale_only=False):
+    """
+    Re-render the status page and the cached detail pages of ``service_ids``.
+
+    ``service_ids=None`` means every service. Detail pages are only
+    re-rendered if they are cached, i.e. someone has asked for them;
+    ``stale_only`` also skips pages that are still current.
+    """
+    now = time.time()
+    page = _get(STATUS_PAGE_KEY)
+    if not (stale_only and page and not page.is_stale(now)):
+        build_status_page(page)
+
+    if service_ids is None:
+        service_ids = list(ServiceCheck.objects.values_list('id', flat=True))
+    keys = {SERVICE_PAGE_KEY.format(service_id): service_id for service_id in service_ids}
+    try:
+        cached = _cache().get_many(keys)
+    except (redis.RedisError, OSError) as e:
+        logger.warning(f"Could not read rendered service pages: {e}")
+        return
+    due = {keys[key]: page for key, page in cached.items() if not (stale_only and not page.is_stale(now))}
+    services = ServiceCheck.objects.in_bulk(due)
+    for service_id, page in due.items():
+        if service_id in services:
+            build_service_page(services[service_id], page)
+        else:
+            _cache().delete(SERVICE_PAGE_KEY.format(service_id))
+
+
+def schedule_rebuild(service_ids=None):
+    """
+    Re-render the affected pages in the background once the current transaction commits.
+
+    Without a broker the pages are left stale until the next periodic
+    refresh rather than failing the caller's save.
+    """
+    service_ids = sorted(service_ids) if service_ids is not None else None
+    transaction.on_commit(lambda: _queue_rebuild(service_ids))
+
+
+def _queue_rebuild(service_ids):
+    from .tasks import rebuild_status_pages
+
+    try:
+        rebuild_status_pages.delay(service_ids)
+    except (KombuError, redis.RedisError, OSError) as e:
+        logger.warning(f"Could not queue a status page rebuild for {service_ids or 'all services'}: {e}")
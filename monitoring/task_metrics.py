@@ -0,0 +1,80 @@
+"""
+Celery signal receivers feeding the task metrics.
+
+Every published task is stamped with the time it was sent; the worker
+records how long it waited in the queue (from the later of that time and
+its ETA), how long it ran and how much of that was spent in database
+queries. Connected from MonitoringConfig.ready, so beat and every worker
+stamp and measure alike.
+"""
+import time
+from datetime import datetime
+
+from celery.signals import before_task_publish, task_failure, task_postrun, task_prerun
+from django.db import connection
+
+from . import metrics
+
+SENT_AT_HEADER = 'batmon_sent_at'
+
+
+class QueryTimer:
+    """Database execute wrapper adding up the time spent in queries."""
+
+    def __init__(self):
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - started
+
+
+# task_id -> (perf_counter at start, QueryTimer), for the tasks running in this process.
+_running = {}
+
+
+def _due_at(request):
+    sent_at = getattr(request, SENT_AT_HEADER, None)
+    if sent_at is None:
+        return None # Published by something that does not stamp its messages
+    eta = request.eta
+    if eta:
+        if isinstance(eta, str):
+            eta = datetime.fromisoformat(eta)
+        sent_at = max(sent_at, eta.timestamp())
+    return sent_at
+
+
+@before_task_publish.connect(weak=False)
+def stamp_sent_at(headers=None, **kwargs):
+    if headers is not None:
+        headers.setdefault(SENT_AT_HEADER, time.time())
+
+
+@task_prerun.connect(weak=False)
+def start_task_timers(task_id=None, task=None, **kwargs):
+    due_at = _due_at(task.request)
+    if due_at is not None:
+        metrics.TASK_QUEUE_LAG.observe(max(time.time() - due_at, 0), task=task.name)
+    timer = QueryTimer()
+    connection.execute_wrappers.append(timer)
+    _running[task_id] = (time.perf_counter(), timer)
+
+
+@task_postrun.connect(weak=False)
+def stop_task_timers(task_id=None, task=None, **kwargs):
+    started, timer = _running.pop(task_id, (None, None))
+    if started is None:
+        return
+    if timer in connection.execute_wrappers:
+        connection.execute_wrappers.remove(timer)
+    metrics.TASK_DURATION.observe(time.perf_counter() - started, task=task.name)
+    metrics.TASK_DB_TIME.observe(timer.seconds, task=task.name)
+
+
+@task_failure.connect(weak=False)
+def count_task_failure(sender=None, **kwargs):
+    metrics.TASK_FAILURES.inc(task=sender.name)
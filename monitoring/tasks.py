@@ -1,12 +1,21 @@
 from celery import shared_task
-from .models import ServiceCheck, CheckResult, MaintenanceWindow
-from .alert_tasks import send_alert
+from .models import ServiceCheck
+from .alert_tasks import queue_alert
+from .http_client import get_http_client, timed_get
+from .probe_engine import ProbeEngine
+from .result_sink import result_sink
+from .maintenance_cache import maintenance_cache
+from . import dns_cache, icmp, live_feed, metrics, retention, rollups, sharding, status_cache
+from .scheduling import (
+    DEFAULT_DISPATCH_BATCH_SIZE, DEFAULT_DISPATCH_MAX_PER_TICK, chunked, next_run_after,
+)
 import subprocess
-import requests
+import httpx
 import socket
 import time
+from django.conf import settings
 from django.utils import timezone
-from django.db.models import Q
+from django.db import transaction
 import logging
 import json
 
@@ -39,22 +48,14 @@ def run_service_check(service_check_arg): # Use a generic name to inspect the ra
         service_check = ServiceCheck.objects.get(id=service_check_id)
         logger.info(f"ServiceCheck '{service_check.name}' found. Type: {service_check.check_type}")
         
-        # Check for active maintenance windows
-        active_maintenance = MaintenanceWindow.objects.filter(
-            active=True,
-            start_time__lte=timezone.now(),
-            end_time__gte=timezone.now()
-        ).filter(Q(service=service_check) | Q(service__isnull=True)).exists()
-
-        if active_maintenance:
+        if is_in_maintenance(service_check):
             logger.info(f"Service '{service_check.name}' is in maintenance. Skipping check and alerts.")
-            service_check.status_atual = 'maintenance'
-            service_check.last_check = timezone.now()
-            service_check.save()
+            mark_in_maintenance(service_check)
             return # Do not proceed with checks or alerts if in maintenance
         
         result = {} # Initialize result
 
+        started = time.perf_counter()
         if service_check.check_type == 'ping':
             result = check_ping(service_check)
         elif service_check.check_type == 'http':
@@ -66,77 +67,267 @@ def run_service_check(service_check_arg): # Use a generic name to inspect the ra
                 'success': False,
                 'message': f"Unknown check type: {service_check.check_type}"
             }
+        metrics.CHECK_DURATION.observe(time.perf_counter() - started, check_type=service_check.check_type)
         
-        logger.info(f"Check for '{service_check.name}' completed. Success: {result.get('success')}, Message: {result.get('message')}")
-
-        CheckResult.objects.create(
-            service=service_check,
-            success=result.get('success', False),
-            response_time=result.get('response_time'),
-            status_code=result.get('status_code'),
-            message=result.get('message')
-        )
-        logger.info(f"CheckResult created for '{service_check.name}'.")
-
-        # Determine previous status for alert triggering
-        previous_status = service_check.status_atual
-        
-        # Update service status
-        service_check.last_check = timezone.now()
-        if result.get('success'):
-            service_check.status_atual = 'ok'
-        else:
-            service_check.status_atual = 'fail'
-        service_check.save()
-        logger.info(f"ServiceCheck '{service_check.name}' status updated to '{service_check.status_atual}'. Last check: {service_check.last_check}")
-
-        # Alert triggering logic (only if not in maintenance)
-        if not active_maintenance:
-            if service_check.status_atual == 'fail' and previous_status != 'fail':
-                # Service just failed, trigger 'on_fail' alerts
-                for alert in service_check.alerts.filter(active=True, trigger='on_fail'):
-                    send_alert.delay(alert.id, f"Service '{service_check.name}' just went DOWN! Message: {result.get('message')}")
-            
-            if service_check.status_atual == 'ok' and previous_status == 'fail':
-                # Service just recovered, trigger 'on_recovery' alerts
-                for alert in service_check.alerts.filter(active=True, trigger='on_recovery'):
-                    send_alert.delay(alert.id, f"Service '{service_check.name}' has recovered! Message: {result.get('message')}")
-
-            if service_check.status_atual == 'fail':
-                # Check for 'on_fail_x_times' alerts
-                for alert in service_check.alerts.filter(active=True, trigger='on_fail_x_times', trigger_value__isnull=False):
-                    recent_failures = service_check.results.filter(success=False).order_by('-timestamp')[:alert.trigger_value]
-                    if len(recent_failures) == alert.trigger_value and all(not r.success for r in recent_failures):
-                        # Ensure we only send the alert once per failure streak
-                        last_alert_log = alert.logs.filter(success=True).order_by('-timestamp').first()
-                        if not last_alert_log or last_alert_log.timestamp < recent_failures.last().timestamp:
-                            send_alert.delay(alert.id, f"Service '{service_check.name}' has failed {alert.trigger_value} times in a row! Message: {result.get('message')}")
+        record_check_result(service_check, result)
 
     except ServiceCheck.DoesNotExist:
         logger.error(f"ServiceCheck with id {service_check_id} not found.")
     except Exception as e:
         logger.error(f"Error in run_service_check for service {service_check_id}: {e}", exc_info=True)
 
+def is_in_maintenance(service_check):
+    return maintenance_cache.in_maintenance(service_check.id)
+
+def record_check_result(service_check, result):
+    """
+    Buffer a probe result and the status it implies in the worker's result sink.
+
+    Shared by the per-check task and the batched asyncio engine so both feed
+    the same CheckResult/status/alert pipeline. Rows are written in bulk by
+    the sink; alerts are evaluated by trigger_flushed_alerts once they are.
+    """
+    logger.info(f"Check for '{service_check.name}' completed. Success: {result.get('success')}, Message: {result.get('message')}")
+    metrics.CHECKS.inc(check_type=service_check.check_type, outcome='success' if result.get('success') else 'failure')
+    result_sink.add(service_check, result)
+
+def trigger_alerts(service_check, previous_status, result, consecutive_failures, alerted_failures):
+    """
+    Queue the alerts a buffered result triggers.
+
+    ``consecutive_failures`` and ``alerted_failures`` are the service's
+    failure streak right after the result, as kept by the result sink, so
+    'on_fail_x_times' is decided without reading the result history.
+    """
+    status = 'ok' if result.get('success') else 'fail'
+    went_down = status == 'fail' and previous_status != 'fail'
+    recovered = status == 'ok' and previous_status == 'fail'
+    if status == 'ok' and not recovered:
+        return
+
+    # Alert triggering logic (callers skip services in maintenance)
+    alerts = list(service_check.alerts.filter(active=True))
+
+    if went_down:
+        # Service just failed, trigger 'on_fail' alerts
+        for alert in alerts:
+            if alert.trigger == 'on_fail':
+                queue_alert(alert.id, f"Service '{service_check.name}' just went DOWN! Message: {result.get('message')}")
+
+    if recovered:
+        # Service just recovered, trigger 'on_recovery' alerts
+        for alert in alerts:
+            if alert.trigger == 'on_recovery':
+                queue_alert(alert.id, f"Service '{service_check.name}' has recovered! Message: {result.get('message')}")
+
+    if status == 'fail':
+        # 'on_fail_x_times' alerts fire once per streak, when it first reaches their threshold.
+        # An earlier result of this flush may already have alerted the streak.
+        live_failures, live_alerted = result_sink.failure_streak(service_check)
+        if live_failures >= consecutive_failures:
+            alerted_failures = max(alerted_failures, live_alerted)
+        fired = [
+            alert for alert in alerts
+            if alert.trigger == 'on_fail_x_times' and alert.trigger_value is not None
+            and alerted_failures < alert.trigger_value <= consecutive_failures
+        ]
+        for alert in fired:
+            queue_alert(alert.id, f"Service '{service_check.name}' has failed {alert.trigger_value} times in a row! Message: {result.get('message')}")
+        if fired:
+            result_sink.mark_alerted(service_check, consecutive_failures)
+
+@result_sink.on_flush
+def trigger_flushed_alerts(pending_results):
+    for pending in pending_results:
+        try:
+            trigger_alerts(pending.service_check, pending.previous_status, pending.result,
+                           pending.consecutive_failures, pending.alerted_failures)
+        except Exception as e:
+            logger.error(f"Error triggering alerts for service {pending.service_check.id}: {e}", exc_info=True)
+
+@result_sink.on_flush
+def rebuild_changed_status_pages(pending_results):
+    changed = {
+        pending.service_check.id
+        for pending in pending_results
+        if pending.previous_status != pending.service_check.status_atual
+    }
+    if changed:
+        status_cache.schedule_rebuild(changed)
+
+@result_sink.on_flush
+def publish_live_events(pending_results):
+    events = []
+    for pending in pending_results:
+        service_check, check_result = pending.service_check, pending.check_result
+        status = 'ok' if check_result.success else 'fail'
+        if pending.previous_status != status:
+            events.append(live_feed.status_event(service_check, status, pending.previous_status, check_result.timestamp))
+        events.append(live_feed.result_event(service_check, check_result))
+    live_feed.publish(events)
+
+def mark_in_maintenance(service_check):
+    now = timezone.now()
+    # An adaptively scheduled check backs off during maintenance, but is back on time when the window ends.
+    not_after = maintenance_cache.next_change(now, service_check.id) if service_check.adaptive_schedule else None
+    previous_status = result_sink.update_status(service_check, 'maintenance', now, not_after)
+    if previous_status != 'maintenance':
+        live_feed.publish([live_feed.status_event(service_check, 'maintenance', previous_status, service_check.last_check)])
+
+@shared_task
+def run_service_check_batch(service_check_ids):
+    """
+    Probe many ServiceCheck rows concurrently with the asyncio ProbeEngine.
+
+    Checks in maintenance are marked as such and skipped, exactly like
+    run_service_check. Probing happens in one event loop; results are then
+    buffered through record_check_result.
+    """
+    service_checks = list(ServiceCheck.objects.filter(id__in=service_check_ids))
+    missing = set(service_check_ids) - {service_check.id for service_check in service_checks}
+    if missing:
+        logger.error(f"ServiceCheck ids {sorted(missing)} not found.")
+
+    to_probe = []
+    for service_check in service_checks:
+        if is_in_maintenance(service_check):
+            logger.info(f"Service '{service_check.name}' is in maintenance. Skipping check and alerts.")
+            mark_in_maintenance(service_check)
+        else:
+            to_probe.append(service_check)
+
+    for service_check, result in ProbeEngine().run(to_probe):
+        try:
+            record_check_result(service_check, result)
+        except Exception as e:
+            # A flush failing inside add() keeps the result buffered; carry on with the rest of the batch.
+            logger.error(f"Error recording result for service {service_check.id}: {e}", exc_info=True)
+
+@shared_task(ignore_result=True)
+def dispatch_due_checks():
+    """
+    Beat tick for the batched scheduler (BATMON_SCHEDULER_MODE = 'batched').
+
+    Claims every active check whose next_run_at has passed, pushes its
+    next_run_at forward and publishes the IDs to run_service_check_batch in
+    messages of BATMON_DISPATCH_BATCH_SIZE. Rows are claimed with
+    SKIP LOCKED so overlapping ticks never dispatch the same check twice.
+    Checks still holding a PeriodicTask from the periodic_task mode are left
+    to beat until ``manage.py sync_check_schedules`` removes it, so they are
+    never probed twice. With BATMON_SHARDING, each check goes to the queue
+    of the live shard owning it.
+    """
+    batch_size = getattr(settings, 'BATMON_DISPATCH_BATCH_SIZE', DEFAULT_DISPATCH_BATCH_SIZE)
+    max_per_tick = getattr(settings, 'BATMON_DISPATCH_MAX_PER_TICK', DEFAULT_DISPATCH_MAX_PER_TICK)
+    now = timezone.now()
+
+    with transaction.atomic():
+        due = list(
+            ServiceCheck.objects.select_for_update(skip_locked=True)
+            .filter(active=True, next_run_at__lte=now, periodic_task__isnull=True)
+            .order_by('next_run_at')
+            .only('id', 'interval', 'next_run_at')[:max_per_tick]
+        )
+        for service_check in due:
+            service_check.next_run_at = next_run_after(now, service_check.interval)
+        ServiceCheck.objects.bulk_update(due, ['next_run_at'], batch_size=1000)
+
+    ring = sharding.current_ring() if sharding.sharding_enabled() else None
+    if ring is None:
+        if sharding.sharding_enabled() and due:
+            logger.warning("No live shards; dispatching due checks to the default queue.")
+        shards = {None: due}
+    else:
+        shards = ring.assign(due, key=lambda service_check: service_check.id)
+
+    batches = 0
+    for shard, service_checks in shards.items():
+        for batch in chunked(service_checks, batch_size):
+            batch_ids = [service_check.id for service_check in batch]
+            if shard is None:
+                run_service_check_batch.delay(batch_ids)
+            else:
+                # Stranded in the queue of a shard that left, a batch is superseded by its checks' next run.
+                run_service_check_batch.apply_async((batch_ids,), queue=sharding.shard_queue(shard),
+                                                    expires=min(service_check.interval for service_check in batch))
+            batches += 1
+
+    if due:
+        logger.info(f"Dispatched {len(due)} due checks in {batches} batches.")
+    return len(due)
+
+@shared_task(ignore_result=True)
+def compact_rollups():
+    """Keep the 1m/1h/1d CheckResultRollup buckets up to date for the chart views."""
+    counts = rollups.compact(timezone.now())
+    logger.info(f"Compacted rollups: {counts}")
+
+@shared_task(ignore_result=True)
+def rebuild_status_pages(service_ids=None):
+    """Re-render the cached status page and the affected detail pages after a change."""
+    # The change may not have reached this process's maintenance cache yet.
+    maintenance_cache.refresh()
+    status_cache.rebuild(service_ids)
+
+@shared_task(ignore_result=True)
+def refresh_status_pages():
+    """Re-render cached status pages that are due for a refresh or crossed a maintenance start/end."""
+    status_cache.rebuild(stale_only=True)
+
+@shared_task(ignore_result=True)
+def purge_expired_data():
+    """Delete results, rollups and alert logs older than their BATMON_RETENTION tier."""
+    deleted = retention.purge_expired(timezone.now())
+    logger.info(f"Purged expired data: {deleted}")
+
 def check_ping(service_check):
+    try:
+        response_time = icmp.ping(service_check.url_or_host, service_check.timeout)
+        return {
+            'success': True,
+            'response_time': response_time,
+            'message': f"Echo reply in {response_time * 1000:.2f} ms"
+        }
+    except TimeoutError:
+        return {
+            'success': False,
+            'message': f"Ping timed out after {service_check.timeout} seconds."
+        }
+    except icmp.ICMPUnavailable:
+        return check_ping_command(service_check)
+    except icmp.NoIPv4Address:
+        return check_ping_command(service_check) # The ICMP engine is IPv4 only
+    except icmp.PingError as e:
+        return {
+            'success': False,
+            'message': str(e)
+        }
+    except OSError as e:
+        return {
+            'success': False,
+            'message': str(e)
+        }
+
+def check_ping_command(service_check):
+    """check_ping through the system ping binary, for hosts or workers the ICMP engine cannot serve."""
     start_time = time.time()
     try:
         # The '-c 1' option sends only one packet.
         # The '-W' option sets the timeout in seconds.
         command = ['ping', '-c', '1', '-W', str(service_check.timeout), service_check.url_or_host]
         result = subprocess.run(command, capture_output=True, text=True, timeout=service_check.timeout)
-        response_time = (time.time() - start_time)
+        rtt, summary = icmp.parse_ping_output(result.stdout)
         
         if result.returncode == 0:
             return {
                 'success': True,
-                'response_time': response_time,
-                'message': result.stdout
+                'response_time': rtt if rtt is not None else time.time() - start_time,
+                'message': summary
             }
         else:
             return {
                 'success': False,
-                'response_time': response_time,
-                'message': result.stderr
+                'message': result.stderr.strip() or summary
             }
     except subprocess.TimeoutExpired:
         return {
@@ -150,15 +341,14 @@ def check_ping(service_check):
         }
 
 def check_http(service_check):
-    start_time = time.time()
     try:
-        response = requests.get(service_check.url_or_host, timeout=service_check.timeout)
-        response_time = (time.time() - start_time)
+        response, response_time, timings = timed_get(get_http_client(), service_check.url_or_host, service_check.timeout)
         
         if 200 <= response.status_code < 300:
             return {
                 'success': True,
                 'response_time': response_time,
+                **timings.as_result(),
                 'status_code': response.status_code,
                 'message': f"Status code: {response.status_code}"
             }
@@ -166,31 +356,49 @@ def check_http(service_check):
             return {
                 'success': False,
                 'response_time': response_time,
+                **timings.as_result(),
                 'status_code': response.status_code,
                 'message': f"Unexpected status code: {response.status_code}"
             }
-    except requests.exceptions.Timeout:
+    except httpx.TimeoutException:
         return {
             'success': False,
             'message': f"Request timed out after {service_check.timeout} seconds."
         }
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         return {
             'success': False,
             'message': str(e)
         }
 
+def connect_tcp(host, addresses, port, timeout):
+    """Connect to the first of ``host``'s ``addresses`` that accepts, like socket.create_connection does."""
+    if not addresses:
+        raise OSError(f"No addresses for {host}")
+    last_error = None
+    for address in addresses:
+        try:
+            return socket.create_connection((address, port), timeout=timeout)
+        except socket.timeout:
+            raise
+        except OSError as e:
+            last_error = e
+    raise last_error
+
 def check_tcp(service_check):
-    start_time = time.time()
     try:
         host, port = service_check.url_or_host.split(':')
         port = int(port)
-        
-        with socket.create_connection((host, port), timeout=service_check.timeout) as sock:
+
+        dns_started = time.time()
+        addresses = dns_cache.resolve(host, service_check.timeout)
+        start_time = time.time()
+        with connect_tcp(host, addresses, port, service_check.timeout) as sock:
             response_time = (time.time() - start_time)
             return {
                 'success': True,
                 'response_time': response_time,
+                'dns_time': start_time - dns_started,
                 'message': f"Successfully connected to {host}:{port}"
             }
     except socket.timeout:
@@ -1,3 +1,1842 @@
-from django.test import TestCase
+import asyncio
+import csv
+import http.server
+import io
+import json
+import socket
+import threading
+import time
+from datetime import timedelta, timezone as dt_timezone
+from itertools import islice
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import numpy as np
+import redis
+from asgiref.sync import async_to_sync
+from django_celery_beat.models import IntervalSchedule, PeriodicTask, PeriodicTasks
+from kombu.exceptions import OperationalError as KombuOperationalError
+
+from django.contrib.auth import get_user_model
+from django.db import OperationalError, close_old_connections, connection
+from django.db.models import Count, Sum
+from django.core import mail
+from django.core.cache import caches
+from django.core.handlers.asgi import ASGIHandler
+from django.core.signals import request_finished, request_started
+from django.core.management import CommandError, call_command
+from django.test import AsyncClient, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import ServiceCheck, CheckResult, CheckResultRollup, Alert, AlertLog, Incident, MaintenanceWindow, SampleBlock
+from . import (
+    alert_dispatch, benchmark, charts, dns_cache, icmp, incidents, live_feed, metrics, partitions, retention, rollups,
+    samples, sharding, sla, task_metrics,
+)
+from .alert_tasks import dispatch_pending_alerts, queue_alert
+from .failure_streaks import rebuild_failure_streaks
+from .maintenance_cache import maintenance_cache
+from .probe_engine import ProbeEngine
+from .result_sink import ResultSink, result_sink
+from . import status_cache
+from .tasks import check_http, check_ping, check_tcp, run_service_check, run_service_check_batch, dispatch_due_checks, rebuild_status_pages, refresh_status_pages
+
+
+def create_service(name='api', **kwargs):
+    kwargs.setdefault('url_or_host', 'http://example.invalid/')
+    kwargs.setdefault('check_type', 'http')
+    return ServiceCheck.objects.create(name=name, **kwargs)
+
+
+STATUS_TEST_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'status': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'batmon-tests'},
+}
+
+
+@override_settings(CACHES=STATUS_TEST_CACHES, BATMON_STATUS_CACHE='status')
+class HotPathQueryCountTests(TestCase):
+    """Query budgets for the per-probe task and the detail view."""
+
+    def setUp(self):
+        caches['status'].clear()
+        self.service = create_service()
+        now = timezone.now()
+        CheckResult.objects.bulk_create([
+            CheckResult(service=self.service, timestamp=now - timedelta(minutes=i), success=i % 5 != 0, response_time=0.1)
+            for i in range(50)
+        ])
+        maintenance_cache.refresh()
+
+    def tearDown(self):
+        result_sink.flush()
+
+    def test_run_service_check_success(self):
+        with mock.patch('monitoring.tasks.check_http', return_value={'success': True, 'response_time': 0.1}):
+            # get (maintenance comes from the cache), then one bulk INSERT and one status UPDATE on flush,
+            # in one transaction (a savepoint here)
+            with self.assertNumQueries(5):
+                run_service_check(self.service.id)
+                result_sink.flush()
+
+    def test_run_service_check_failure_evaluates_alerts(self):
+        Alert.objects.create(service=self.service, alert_type='command', trigger='on_fail_x_times', trigger_value=3,
+                             config={'command': 'true'}, active=False)
+        with mock.patch('monitoring.tasks.check_http', return_value={'success': False, 'message': 'down'}):
+            # as above, plus the open incident (locked) and the new one inside the flush transaction, and one
+            # lookup of the service's active alerts; no result history is read
+            with self.assertNumQueries(8):
+                run_service_check(self.service.id)
+                result_sink.flush()
+
+    def test_service_detail(self):
+        # Cold cache: service, history, incidents (the charts are fetched separately)
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('monitoring:service_detail', args=[self.service.id]))
+        self.assertEqual(response.status_code, 200)
+
+    def test_dispatch_due_checks(self):
+        # As after sync_check_schedules: no PeriodicTask left for beat to run
+        ServiceCheck.objects.update(next_run_at=timezone.now() - timedelta(seconds=1), periodic_task=None)
+        with mock.patch('monitoring.tasks.run_service_check_batch.delay') as delay:
+            # claim (SELECT ... FOR UPDATE) and one bulk UPDATE of next_run_at, wrapped in a savepoint here
+            with self.assertNumQueries(4):
+                dispatched = dispatch_due_checks()
+        self.assertEqual(dispatched, 1)
+        delay.assert_called_once_with([self.service.id])
+
+
+@override_settings(CACHES=STATUS_TEST_CACHES, BATMON_STATUS_CACHE='status')
+class OverviewQueryCountTests(TestCase):
+    """The status page and dashboard must not issue per-service queries."""
+
+    def setUp(self):
+        caches['status'].clear()
+        self.user = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'pw')
+        maintenance_cache.refresh()
+
+    def add_services(self, count):
+        now = timezone.now()
+        for _ in range(count):
+            service = create_service(name=f'svc-{ServiceCheck.objects.count()}')
+            result = CheckResult.objects.create(service=service, success=False, response_time=0.2)
+            alert = Alert.objects.create(service=service, alert_type='command', trigger='on_fail',
+                                         config={'command': 'true'})
+            AlertLog.objects.create(alert=alert, success=True, message_sent='sent')
+            MaintenanceWindow.objects.create(service=service, title='mw', start_time=now + timedelta(hours=1),
+                                             end_time=now + timedelta(hours=2))
+            CheckResultRollup.objects.create(service=service, resolution='1h', count=1, successes=0,
+                                             bucket_start=result.timestamp.replace(minute=0, second=0, microsecond=0),
+                                             response_time_count=1, response_time_sum=0.2)
+        maintenance_cache.refresh()
+
+    def test_status_page(self):
+        self.add_services(2)
+        # Rendering: services (the charts are fetched separately)
+        with self.assertNumQueries(1):
+            status_cache.build_status_page()
+        self.add_services(10)
+        with self.assertNumQueries(1):
+            page = status_cache.build_status_page()
+        self.assertEqual(page.body.count('Details</a>'), 12)
+
+    def test_dashboard(self):
+        self.client.force_login(self.user)
+        self.add_services(2)
+        # session, user, status counts, recent results, recent alerts, recent incidents, upcoming maintenance, services
+        with self.assertNumQueries(8):
+            self.client.get(reverse('monitoring:dashboard'))
+        self.add_services(10)
+        with self.assertNumQueries(8):
+            response = self.client.get(reverse('monitoring:dashboard'))
+        self.assertEqual(response.context['total_services'], 12)
+
+
+@override_settings(CACHES=STATUS_TEST_CACHES, BATMON_STATUS_CACHE='status')
+class ChartDataTests(TestCase):
+
+    def setUp(self):
+        caches['status'].clear()
+        self.service = create_service()
+
+    def test_lttb_keeps_extremes(self):
+        points = [(x, 1.0) for x in range(1000)]
+        points[500] = (500, 50.0)
+        sampled = charts.lttb(points, 20)
+        self.assertEqual(len(sampled), 20)
+        self.assertEqual(sampled[0], points[0])
+        self.assertEqual(sampled[-1], points[-1])
+        self.assertIn((500, 50.0), sampled)
+        self.assertEqual(charts.lttb(points[:10], 20), points[:10])
+
+    @override_settings(BATMON_CHART_MAX_POINTS=50)
+    def test_endpoint(self):
+        start = charts.bucket_start(timezone.now(), '1m')
+        CheckResultRollup.objects.bulk_create([
+            CheckResultRollup(service=self.service, resolution='1m', bucket_start=start - timedelta(minutes=i),
+                              count=2, successes=1 if i == 7 else 2, response_time_count=2, response_time_sum=0.4)
+            for i in range(200)
+        ])
+        url = reverse('monitoring:servicecheck-chart', args=[self.service.id])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('max-age=60', response['Cache-Control'])
+        data = response.json()
+        self.assertEqual((data['window'], data['resolution']), ('24h', '1m'))
+        self.assertEqual(len(data['response_time']['t']), 50)
+        self.assertEqual(set(data['response_time']['v']), {0.2})
+        self.assertIn(0.5, data['uptime']['v'])
+        # Served from the cache, without touching the database
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url).json(), data)
+
+        self.assertEqual(self.client.get(url, {'window': '1y'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('monitoring:servicecheck-chart', args=[0])).status_code, 404)
+
+    def test_pages_do_not_embed_series(self):
+        chart_url = reverse('monitoring:servicecheck-chart', args=[self.service.id])
+        status = self.client.get(reverse('monitoring:status_page')).content.decode()
+        detail = self.client.get(reverse('monitoring:service_detail', args=[self.service.id])).content.decode()
+        self.assertIn(f'{chart_url}?window=24h', status)
+        self.assertIn(f'{chart_url}?window=7d', detail)
+        self.assertNotIn('data-labels', status + detail)
+
+
+class RollupCompactionTests(TestCase):
+
+    def setUp(self):
+        self.service = create_service()
+        # A minute back, so rebuild_rollups (which runs up to the real now) sees every result
+        self.now = rollups.bucket_start(timezone.now(), '1m') - timedelta(minutes=1)
+
+    def add_results(self, minutes):
+        CheckResult.objects.bulk_create([
+            CheckResult(service=self.service, timestamp=self.now - timedelta(minutes=i, seconds=-10), success=True,
+                        response_time=0.1)
+            for i in range(minutes)
+        ])
+
+    def minute_buckets(self):
+        return CheckResultRollup.objects.filter(resolution='1m').count()
+
+    @override_settings(BATMON_ROLLUP_LOOKBACK=300)
+    def test_compact_resumes_from_newest_bucket(self):
+        self.add_results(180)
+        # Compaction last ran two hours ago
+        rollups.rollup_raw_results(self.now - timedelta(hours=2), self.now - timedelta(hours=2, seconds=-60))
+        self.assertEqual(self.minute_buckets(), 1)
+
+        counts = rollups.compact(self.now + timedelta(seconds=30))
+        self.assertEqual(counts['1m'], 121)
+        self.assertEqual(self.minute_buckets(), 121)
+        hours = CheckResultRollup.objects.filter(resolution='1h').aggregate(total=Sum('count'))['total']
+        self.assertEqual(hours, 121)
+
+    @override_settings(BATMON_ROLLUP_LOOKBACK=300)
+    def test_compact_without_rollups_uses_lookback(self):
+        self.add_results(60)
+        rollups.compact(self.now + timedelta(seconds=30))
+        self.assertEqual(self.minute_buckets(), 6)
+
+    def test_rebuild_rollups_command(self):
+        self.add_results(180)
+        since = self.now - timedelta(hours=2)
+        out = io.StringIO()
+        call_command('rebuild_rollups', since=since.isoformat(), stdout=out)
+        self.assertIn('Rebuilt rollups since', out.getvalue())
+        self.assertEqual(self.minute_buckets(), 121)
+        days = CheckResultRollup.objects.filter(resolution='1d').aggregate(total=Sum('count'))['total']
+        self.assertEqual(days, 121)
+        with self.assertRaises(CommandError):
+            call_command('rebuild_rollups', since='yesterday')
+
+
+class FailureStreakTests(TestCase):
+    """'on_fail_x_times' is decided from the counters the result sink keeps."""
+
+    def setUp(self):
+        self.service = create_service()
+        self.alert = Alert.objects.create(service=self.service, alert_type='command', trigger='on_fail_x_times',
+                                          trigger_value=3, config={'command': 'true'})
+
+    def tearDown(self):
+        result_sink.flush()
+
+    def run_checks(self, outcomes, flush_each=True):
+        with mock.patch('monitoring.tasks.queue_alert') as queue:
+            for success in outcomes:
+                with mock.patch('monitoring.tasks.check_http', return_value={'success': success, 'message': 'x'}):
+                    run_service_check(self.service.id)
+                if flush_each:
+                    result_sink.flush()
+            result_sink.flush()
+        return [args[0] for args, _ in queue.call_args_list]
+
+    def test_alerts_once_per_streak(self):
+        self.assertEqual(self.run_checks([False, False, False, False, False]), [self.alert.id])
+        self.service.refresh_from_db()
+        self.assertEqual((self.service.consecutive_failures, self.service.alerted_failures), (5, 3))
+        self.assertEqual(self.run_checks([True, False, False, False]), [self.alert.id])
+        self.service.refresh_from_db()
+        self.assertEqual((self.service.consecutive_failures, self.service.alerted_failures), (3, 3))
+
+    def test_streak_within_one_flush(self):
+        self.assertEqual(self.run_checks([False] * 6, flush_each=False), [self.alert.id])
+
+    def test_threshold_lowered_mid_streak(self):
+        self.alert.trigger_value = 10
+        self.alert.save()
+        self.assertEqual(self.run_checks([False] * 4), [])
+        self.alert.trigger_value = 2
+        self.alert.save()
+        self.assertEqual(self.run_checks([False]), [self.alert.id])
+
+    def test_maintenance_keeps_streak(self):
+        self.run_checks([False, False])
+        self.service.refresh_from_db()
+        result_sink.update_status(self.service, 'maintenance')
+        result_sink.flush()
+        self.service.refresh_from_db()
+        self.assertEqual(self.service.consecutive_failures, 2)
+
+    def test_rebuild_from_history(self):
+        now = timezone.now()
+        CheckResult.objects.bulk_create([
+            CheckResult(service=self.service, timestamp=now - timedelta(minutes=10 - i), success=success)
+            for i, success in enumerate([False, True, False, False, False, False])
+        ])
+        call_command('rebuild_failure_streaks', stdout=io.StringIO())
+        self.service.refresh_from_db()
+        self.assertEqual((self.service.consecutive_failures, self.service.alerted_failures), (4, 0))
+
+        AlertLog.objects.create(alert=self.alert, message_sent='down', success=True)
+        self.assertEqual(rebuild_failure_streaks([self.service.id]), 1)
+        self.service.refresh_from_db()
+        self.assertEqual((self.service.consecutive_failures, self.service.alerted_failures), (4, 4))
+
+
+class ResultSinkTests(TransactionTestCase):
+    """Flush errors: transient ones keep the buffer for a retry, permanent ones must not wedge it."""
+
+    def setUp(self):
+        # on_commit hooks run for real here; keep them off the broker and Redis.
+        for target in ('monitoring.status_cache.schedule_rebuild', 'monitoring.live_feed.publish'):
+            patcher = mock.patch(target)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.service = create_service()
+        self.sink = ResultSink(max_size=1000, max_age=1000)
+
+    def add(self, count, service=None):
+        for _ in range(count):
+            self.sink.add(service or self.service, {'success': False, 'message': 'down'})
+
+    def test_transient_error_keeps_results(self):
+        self.add(3)
+        with mock.patch('monitoring.result_sink.write_status_updates', side_effect=OperationalError('gone')):
+            with self.assertRaises(OperationalError):
+                self.sink.flush()
+        # Rolled back with the status update, so the retry does not insert them twice.
+        self.assertEqual((len(self.sink), CheckResult.objects.count()), (3, 0))
+        self.assertEqual(len(self.sink.flush()), 3)
+        self.assertEqual(CheckResult.objects.count(), 3)
+
+    @override_settings(BATMON_RESULT_BUFFER_LIMIT=4)
+    def test_buffer_is_capped(self):
+        self.add(3)
+        with mock.patch('monitoring.result_sink.write_status_updates', side_effect=OperationalError('gone')):
+            for _ in range(2):
+                with self.assertRaises(OperationalError):
+                    self.sink.flush()
+                self.add(3)
+        self.assertEqual(len(self.sink), 7)
+        with mock.patch('monitoring.result_sink.write_status_updates', side_effect=OperationalError('gone')):
+            with self.assertRaises(OperationalError):
+                self.sink.flush()
+        self.assertEqual(len(self.sink), 4)
+
+    def test_results_of_deleted_services_are_dropped(self):
+        other = create_service(name='other')
+        self.add(2)
+        self.add(2, other)
+        ServiceCheck.objects.filter(pk=other.pk).delete()
+        self.assertEqual(len(self.sink.flush()), 2)
+        self.assertEqual(len(self.sink), 0)
+        self.assertEqual(set(CheckResult.objects.values_list('service_id', flat=True)), {self.service.id})
+
+    def test_batch_survives_a_failing_result(self):
+        other = create_service(name='other')
+        outcomes = [(self.service, {'success': True}), (other, {'success': True})]
+        with mock.patch('monitoring.tasks.ProbeEngine.run', return_value=outcomes), \
+                mock.patch('monitoring.tasks.record_check_result', side_effect=[OperationalError('gone'), None]) as record:
+            run_service_check_batch([self.service.id, other.id])
+        self.assertEqual([args[0].id for args, _ in record.call_args_list], [self.service.id, other.id])
+
+
+class PeriodicTaskSyncTests(TestCase):
+    """Only name, interval and active are mirrored into the check's PeriodicTask."""
+
+    def setUp(self):
+        self.service = ServiceCheck.objects.get(pk=create_service(interval=60).pk)
+
+    def beat_state(self):
+        task = PeriodicTask.objects.get(pk=self.service.periodic_task_id)
+        return task.date_changed, PeriodicTasks.last_change(), IntervalSchedule.objects.count()
+
+    def test_state_saves_leave_beat_tables_alone(self):
+        before = self.beat_state()
+        self.service.status_atual = 'fail'
+        self.service.consecutive_failures = 3
+        self.service.last_check = timezone.now()
+        # Only the check's own UPDATE
+        with self.assertNumQueries(1):
+            self.service.save(update_fields=['status_atual', 'consecutive_failures', 'last_check'])
+        with self.assertNumQueries(1):
+            self.service.save()
+        self.assertEqual(self.beat_state(), before)
+
+    def test_schedule_changes_update_periodic_task(self):
+        self.service.interval = 120
+        self.service.save(update_fields=['interval'])
+        self.service.name = 'renamed'
+        self.service.save()
+        self.service.active = False
+        self.service.save()
+        task = PeriodicTask.objects.select_related('interval').get(pk=self.service.periodic_task_id)
+        self.assertEqual((task.interval.every, task.name, task.enabled), (120, 'Service Check: renamed', False))
+
+
+@override_settings(BATMON_RETENTION={'raw': 7, '1m': 90, '1h': 365, '1d': None, 'alertlog': 30}, BATMON_PURGE_CHUNK_SIZE=3)
+class RetentionTests(TestCase):
+    """Each tier loses exactly its rows older than the tier's cutoff, in chunks."""
+
+    def setUp(self):
+        self.service = create_service()
+        self.now = timezone.now()
+        self.alert = Alert.objects.create(service=self.service, alert_type='command', trigger='on_fail',
+                                          config={'command': 'true'})
+
+    def add_results(self, cutoff, count=5):
+        """``count`` rows a minute either side of ``cutoff``; returns the IDs of the ones to keep."""
+        # Interleaved, so the ID ranges of the chunks hold rows of both kinds.
+        rows = CheckResult.objects.bulk_create([
+            CheckResult(service=self.service, timestamp=cutoff + timedelta(minutes=(1 + i // 2) * (1 if i % 2 else -1)),
+                        success=True)
+            for i in range(2 * count)
+        ])
+        return {row.pk for row in rows if row.timestamp > cutoff}
+
+    def test_purge_in_chunks(self):
+        kept = self.add_results(self.now)
+        with CaptureQueriesContext(connection) as queries:
+            deleted = retention.purge_in_chunks(CheckResult.objects.filter(timestamp__lt=self.now), chunk_size=3)
+        self.assertEqual(deleted, 5)
+        self.assertEqual(set(CheckResult.objects.values_list('pk', flat=True)), kept)
+        # Expired IDs span 9 values: one DELETE per range of 3 IDs
+        deletes = [query for query in queries if query['sql'].startswith('DELETE')]
+        self.assertEqual(len(deletes), 3)
+        self.assertEqual(retention.purge_in_chunks(CheckResult.objects.none(), chunk_size=3), 0)
+
+    def test_purge_expired_per_tier(self):
+        kept_results = self.add_results(self.now - timedelta(days=7))
+        raw_cutoff = self.now - timedelta(days=7)
+        SampleBlock.objects.bulk_create([
+            SampleBlock(service=self.service, start=samples.block_start(raw_cutoff) - timedelta(hours=hours))
+            for hours in range(4) # The first still holds samples newer than the cutoff
+        ])
+        for resolution, days in (('1m', 90), ('1h', 365), ('1d', 3650)):
+            CheckResultRollup.objects.bulk_create([
+                CheckResultRollup(service=self.service, resolution=resolution, count=1, successes=1,
+                                  bucket_start=self.now - timedelta(days=days) + timedelta(hours=offset))
+                for offset in (-2, -1, 1, 2)
+            ])
+        for days in (29, 31, 32):
+            log = AlertLog.objects.create(alert=self.alert, message_sent='down', success=True)
+            AlertLog.objects.filter(pk=log.pk).update(timestamp=self.now - timedelta(days=days))
+
+        deleted = retention.purge_expired(self.now)
+
+        self.assertEqual({tier: deleted[tier] for tier in ('raw', 'raw_blocks', '1m', '1h', 'alertlog')},
+                         {'raw': 5, 'raw_blocks': 3, '1m': 2, '1h': 2, 'alertlog': 2})
+        self.assertNotIn('1d', deleted) # Kept forever
+        self.assertEqual(set(CheckResult.objects.values_list('pk', flat=True)), kept_results)
+        self.assertEqual(list(SampleBlock.objects.values_list('start', flat=True)), [samples.block_start(raw_cutoff)])
+        self.assertEqual(dict(CheckResultRollup.objects.values_list('resolution').annotate(Count('id'))),
+                         {'1m': 2, '1h': 2, '1d': 4})
+        self.assertEqual(AlertLog.objects.count(), 1)
+
+    @skipUnless(connection.vendor == 'postgresql', "Partitioning needs PostgreSQL")
+    def test_expired_partitions_are_dropped(self):
+        today = self.now.astimezone(dt_timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+        # Whole days 10 to 8 days ago go as partitions (8 is empty); the day of the cutoff is trimmed row by row.
+        CheckResult.objects.bulk_create([
+            CheckResult(service=self.service, timestamp=today - timedelta(days=days, hours=-1), success=True)
+            for days in (10, 9)
+        ])
+        kept = self.add_results(self.now - timedelta(days=7))
+        with connection.cursor() as cursor:
+            # The inserts' deferred FK checks would otherwise block dropping the old table in this transaction.
+            cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+        partitions.convert_to_partitioned(self.now, days_ahead=1)
+        self.assertTrue(partitions.is_partitioned())
+
+        deleted = retention.purge_expired(self.now)
+
+        self.assertEqual(deleted['raw_partitions'], 3)
+        self.assertEqual(deleted['raw'], 5)
+        self.assertEqual(set(CheckResult.objects.values_list('pk', flat=True)), kept)
+        self.assertGreaterEqual(min(day for _, day in partitions.list_partitions()), today - timedelta(days=8))
+        # ensure_partitions kept a partition ready for tomorrow
+        self.assertIn(today + timedelta(days=1), [day for _, day in partitions.list_partitions()])
+
+
+class SchedulerModeTests(TestCase):
+    """Switching BATMON_SCHEDULER_MODE never leaves a check probed by both beat and the dispatcher."""
+
+    def test_switch_to_batched(self):
+        services = [create_service(f'svc-{i}') for i in range(2)]
+        self.assertTrue(all(service.periodic_task_id for service in services))
+        ServiceCheck.objects.update(next_run_at=timezone.now() - timedelta(seconds=1))
+        with override_settings(BATMON_SCHEDULER_MODE='batched'), \
+                mock.patch('monitoring.tasks.run_service_check_batch.delay') as delay:
+            # Still run by their PeriodicTasks
+            self.assertEqual(dispatch_due_checks(), 0)
+            out = io.StringIO()
+            call_command('sync_check_schedules', stdout=out)
+            self.assertIn('Deleted 2 per-check periodic tasks', out.getvalue())
+            self.assertFalse(PeriodicTask.objects.filter(task='monitoring.tasks.run_service_check').exists())
+            self.assertEqual(dispatch_due_checks(), 2)
+        delay.assert_called_once()
+
+        call_command('sync_check_schedules', stdout=io.StringIO())
+        self.assertEqual(ServiceCheck.objects.filter(periodic_task__enabled=True).count(), 2)
+
+
+@override_settings(BATMON_DISPATCH_JITTER=0, BATMON_ADAPTIVE_RECHECK_INTERVAL=10, BATMON_ADAPTIVE_RECHECKS=2,
+                   BATMON_ADAPTIVE_BACKOFF_FACTOR=2.0, BATMON_ADAPTIVE_MAX_BACKOFF=10, BATMON_ADAPTIVE_FLAP_THRESHOLD=0.25)
+class AdaptiveSchedulingTests(TestCase):
+    """next_run_at of adaptively scheduled checks follows their results."""
+
+    def setUp(self):
+        self.service = create_service(interval=60, adaptive_schedule=True)
+        maintenance_cache.refresh()
+
+    def tearDown(self):
+        result_sink.flush()
+
+    def delays(self, outcomes):
+        """Seconds from each result to the next run it schedules."""
+        delays = []
+        for success in outcomes:
+            with mock.patch('monitoring.tasks.check_http', return_value={'success': success, 'message': 'x'}):
+                run_service_check(self.service.id)
+            result_sink.flush()
+            self.service.refresh_from_db()
+            delays.append(round((self.service.next_run_at - self.service.last_check).total_seconds()))
+        return delays
+
+    def test_recheck_then_backoff(self):
+        # Two fast confirmations, then 120, 240, 480 s, capped at 10 intervals; a success resets it.
+        self.assertEqual(self.delays([False] * 7 + [True]), [10, 10, 120, 240, 480, 600, 600, 60])
+        self.assertEqual(self.service.backoff_level, 0)
+
+    def test_per_check_settings(self):
+        ServiceCheck.objects.filter(pk=self.service.pk).update(recheck_interval=5, max_interval=200)
+        self.assertEqual(self.delays([False] * 4), [5, 5, 120, 200])
+
+    def test_flapping_is_damped(self):
+        delays = self.delays([True, False, True, False, True, False])
+        self.assertEqual(delays[1], 10)
+        self.assertGreaterEqual(self.service.flap_score, 0.25)
+        self.assertEqual(delays[-1], 60) # No fast re-check while flapping
+
+    def test_maintenance_backs_off_until_window_end(self):
+        now = timezone.now()
+        MaintenanceWindow.objects.create(title='upgrade', service=self.service, start_time=now - timedelta(minutes=1),
+                                         end_time=now + timedelta(minutes=5))
+        maintenance_cache.refresh()
+        delays = self.delays([True, True, True])
+        self.assertEqual(self.service.status_atual, 'maintenance')
+        self.assertEqual(delays[:2], [120, 240])
+        # The third backoff (480 s) would outlast the window
+        self.assertLessEqual(self.service.next_run_at, now + timedelta(minutes=5))
+
+    def test_fixed_schedule_left_to_dispatcher(self):
+        fixed = create_service('fixed', interval=60)
+        next_run_at = fixed.next_run_at
+        with mock.patch('monitoring.tasks.check_http', return_value={'success': False, 'message': 'x'}):
+            run_service_check(fixed.id)
+        result_sink.flush()
+        fixed.refresh_from_db()
+        self.assertEqual(fixed.next_run_at, next_run_at)
+        self.assertEqual(fixed.consecutive_failures, 1)
+
+
+class SortedSetStore:
+    """The few Redis sorted set commands the shard heartbeats use, kept in a dict."""
+
+    def __init__(self):
+        self.members = {}
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def execute(self):
+        return []
+
+    def zadd(self, key, mapping):
+        self.members.update(mapping)
+
+    def zremrangebyscore(self, key, low, high):
+        self.members = {member: score for member, score in self.members.items() if not float(low) <= score <= float(high)}
+
+    def zrangebyscore(self, key, low, high):
+        return [member.encode() for member, score in self.members.items() if float(low) <= score <= float(high)]
+
+
+@override_settings(BATMON_SHARD_VNODES=100, BATMON_SHARD_TIMEOUT=30)
+class ShardingTests(TestCase):
+
+    def test_ring_balance_and_minimal_movement(self):
+        ids = range(10000)
+        before = sharding.HashRing(['a', 'b', 'c', 'd'])
+        counts = {shard: len(owned) for shard, owned in before.assign(ids).items()}
+        self.assertEqual(set(counts), {'a', 'b', 'c', 'd'})
+        self.assertLess(max(counts.values()) / min(counts.values()), 1.5)
+        # Independent of the order the shards were listed in
+        self.assertEqual(sharding.HashRing(['d', 'c', 'b', 'a']).assign(ids), before.assign(ids))
+
+        after = sharding.HashRing(['a', 'b', 'c', 'd', 'e'])
+        moved = [i for i in ids if before.owner(i) != after.owner(i)]
+        # Only the new shard takes checks over, about a fifth of them
+        self.assertTrue(all(after.owner(i) == 'e' for i in moved))
+        self.assertLess(abs(len(moved) - 2000), 500)
+
+    def test_live_shards_from_heartbeats(self):
+        store = SortedSetStore()
+        sharding.heartbeat('a|node-1:1', store, now=1000)
+        sharding.heartbeat('a|node-2:1', store, now=1000)
+        sharding.heartbeat('b|node-3:1', store, now=1010)
+        self.assertEqual(sharding.live_shards(store, now=1020), {'a', 'b'})
+        self.assertEqual(sharding.live_shards(store, now=1035), {'b'})
+        sharding.heartbeat('b|node-3:1', store, now=1035)
+        self.assertEqual(set(store.members), {'b|node-3:1'})
+
+    @override_settings(BATMON_SCHEDULER_MODE='batched', BATMON_SHARDING=True, BATMON_DISPATCH_BATCH_SIZE=100)
+    def test_dispatch_routes_checks_to_their_shard_queue(self):
+        services = [create_service(f'svc-{i}', interval=60) for i in range(20)]
+        ServiceCheck.objects.update(next_run_at=timezone.now() - timedelta(seconds=1))
+        ring = sharding.HashRing(['a', 'b'])
+        with mock.patch('monitoring.sharding.live_shards', return_value={'a', 'b'}), \
+                mock.patch('monitoring.tasks.run_service_check_batch.apply_async') as apply_async:
+            self.assertEqual(dispatch_due_checks(), 20)
+        routed = {call.kwargs['queue']: call.args[0][0] for call in apply_async.call_args_list}
+        self.assertEqual(set(routed), {'batmon.shard.a', 'batmon.shard.b'})
+        for queue, ids in routed.items():
+            self.assertTrue(all(sharding.shard_queue(ring.owner(i)) == queue for i in ids))
+        self.assertEqual(sorted(sum(routed.values(), [])), sorted(service.id for service in services))
+        self.assertTrue(all(call.kwargs['expires'] == 60 for call in apply_async.call_args_list))
+
+        # No live shard: the default queue, as without sharding
+        ServiceCheck.objects.update(next_run_at=timezone.now() - timedelta(seconds=1))
+        with mock.patch('monitoring.sharding.live_shards', return_value=set()), \
+                mock.patch('monitoring.tasks.run_service_check_batch.delay') as delay:
+            self.assertEqual(dispatch_due_checks(), 20)
+        delay.assert_called_once()
+
+
+async def idle_listener(hub):
+    await asyncio.Event().wait()
+
+
+@mock.patch.object(live_feed.LiveFeedHub, '_listen', idle_listener)
+class LiveFeedTests(TestCase):
+
+    async def test_stream_filters_by_service(self):
+        response = await self.async_client.get(reverse('monitoring:live_feed'), {'service': '1'})
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        chunks = asyncio.Queue()
+
+        async def consume():
+            async for chunk in response.streaming_content:
+                chunks.put_nowait(chunk)
+
+        client = asyncio.create_task(consume())
+        self.assertEqual(await chunks.get(), b'retry: 5000\n\n')
+        hub = live_feed.get_hub()
+        self.assertEqual(len(hub), 1)
+        hub.broadcast(live_feed.encode(json.dumps([
+            {'type': 'result', 'service': 2}, {'type': 'status', 'service': 1, 'status': 'fail'},
+        ])))
+        self.assertEqual(await chunks.get(), b'event: status\ndata: {"type": "status", "service": 1, "status": "fail"}\n\n')
+        # A disconnecting client cancels its stream, which drops its queue.
+        client.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await client
+        self.assertEqual(len(hub), 0)
+
+    async def test_slow_client_resyncs(self):
+        with override_settings(BATMON_LIVE_FEED_QUEUE_SIZE=2):
+            hub = live_feed.get_hub()
+            queue = hub.subscribe()
+            for _ in range(3):
+                hub.broadcast(live_feed.encode(json.dumps([{'type': 'result', 'service': 1}])))
+            self.assertEqual(queue.get_nowait(), live_feed.RESYNC)
+            self.assertTrue(queue.empty())
+            hub.unsubscribe(queue)
+
+    def test_needs_asgi(self):
+        self.assertEqual(self.client.get(reverse('monitoring:live_feed')).status_code, 204)
+
+    def test_flush_publishes_results_and_transitions(self):
+        service = create_service()
+        with mock.patch('monitoring.tasks.live_feed.publish') as publish:
+            for success in (True, False):
+                with mock.patch('monitoring.tasks.check_http', return_value={'success': success, 'response_time': 0.2}):
+                    run_service_check(service.id)
+            result_sink.flush()
+        events = publish.call_args.args[0]
+        self.assertEqual([event['type'] for event in events], ['result', 'status', 'result'])
+        self.assertEqual((events[1]['previous'], events[1]['status']), ('ok', 'fail'))
+        self.assertEqual(events[0]['response_time'], 0.2)
+
+
+class HashStore:
+    """The few Redis hash commands the metrics use, kept in a dict."""
+
+    def __init__(self):
+        self.hashes = {}
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def execute(self):
+        return self.__dict__.pop('_replies', [])
+
+    def _reply(self, value):
+        self.__dict__.setdefault('_replies', []).append(value)
+
+    def hincrbyfloat(self, key, field, amount):
+        values = self.hashes.setdefault(key, {})
+        values[field] = float(values.get(field, 0)) + amount
+        self._reply(values[field])
+
+    def hset(self, key, mapping):
+        self.hashes.setdefault(key, {}).update(mapping)
+        self._reply(len(mapping))
+
+    def expire(self, key, seconds):
+        self._reply(True)
+
+    def hgetall(self, key):
+        self._reply({field.encode(): str(value).encode() for field, value in self.hashes.get(key, {}).items()})
+
+    def scan_iter(self, match, count=None):
+        return [key for key in self.hashes if key.startswith(match.rstrip('*'))]
+
+
+@mock.patch('monitoring.metrics._ensure_pusher', lambda: None)
+class MetricsTests(TestCase):
+
+    def setUp(self):
+        # Retire a pusher thread started by other tests, so it cannot push what these tests record.
+        pusher = mock.patch('monitoring.metrics._pusher', None)
+        pusher.start()
+        self.addCleanup(pusher.stop)
+        for metric in metrics.REGISTRY:
+            metric.reset()
+        self.store = HashStore()
+
+    def test_processes_are_summed_and_rendered(self):
+        metrics.CHECK_DURATION.observe(0.02, check_type='http')
+        metrics.CHECKS.inc(check_type='http', outcome='success')
+        metrics.push(self.store)
+        # A second process pushing into the same totals
+        metrics.CHECK_DURATION.observe(3, check_type='http')
+        metrics.CHECKS.inc(check_type='http', outcome='success')
+        with mock.patch('monitoring.metrics.process_id', return_value='other:1'), \
+                mock.patch.object(metrics.RESULT_BUFFER_DEPTH, 'function', lambda: 7):
+            metrics.push(self.store)
+
+        text = metrics.render(metrics.read_totals(self.store))
+        self.assertIn('# TYPE batmon_check_duration_seconds histogram', text)
+        self.assertIn('batmon_check_duration_seconds_bucket{check_type="http",le="0.01"} 0\n', text)
+        self.assertIn('batmon_check_duration_seconds_bucket{check_type="http",le="0.025"} 1\n', text)
+        self.assertIn('batmon_check_duration_seconds_bucket{check_type="http",le="+Inf"} 2\n', text)
+        self.assertIn('batmon_check_duration_seconds_sum{check_type="http"} 3.02\n', text)
+        self.assertIn('batmon_check_duration_seconds_count{check_type="http"} 2\n', text)
+        self.assertIn('batmon_checks_total{check_type="http",outcome="success"} 2\n', text)
+        self.assertIn('batmon_result_buffer_depth 7\n', text)
+
+    def test_non_finite_observations_are_ignored(self):
+        for value in (float('nan'), float('inf'), float('-inf')):
+            metrics.CHECK_DURATION.observe(value, check_type='http')
+        metrics.CHECK_DURATION.observe(1e9, check_type='http')
+        metrics.push(self.store)
+        text = metrics.render(metrics.read_totals(self.store))
+        self.assertIn('batmon_check_duration_seconds_bucket{check_type="http",le="+Inf"} 1\n', text)
+        self.assertIn('batmon_check_duration_seconds_count{check_type="http"} 1\n', text)
+
+    def test_failed_push_keeps_the_counts(self):
+        metrics.CHECKS.inc(check_type='tcp', outcome='failure')
+        unreachable = HashStore()
+        unreachable.execute = mock.Mock(side_effect=redis.ConnectionError('down'))
+        with self.assertRaises(redis.ConnectionError):
+            metrics.push(unreachable)
+        metrics.push(self.store)
+        self.assertEqual(metrics.read_totals(self.store)['batmon_checks_total'], {'["tcp", "failure"]': 1.0})
+
+    def test_check_and_alert_instrumentation(self):
+        service = create_service()
+        alert = Alert.objects.create(service=service, alert_type='command', trigger='on_recovery', config={'command': 'true'})
+        maintenance_cache.refresh()
+        with mock.patch.object(metrics.CHECKS, 'inc') as checks, \
+                mock.patch.object(metrics.CHECK_DURATION, 'observe') as check_duration, \
+                mock.patch.object(metrics.ALERTS, 'inc') as alerts, \
+                mock.patch.object(metrics.ALERT_DELIVERY, 'observe') as alert_delivery:
+            with mock.patch('monitoring.tasks.check_http', return_value={'success': False, 'message': 'down'}):
+                run_service_check(service.id)
+            result_sink.flush()
+            alert_dispatch.dispatch([(alert.id, 'down')])
+
+        checks.assert_called_once_with(check_type='http', outcome='failure')
+        self.assertEqual(check_duration.call_args.kwargs, {'check_type': 'http'})
+        alerts.assert_called_once_with(channel='command', outcome='delivered')
+        self.assertEqual(alert_delivery.call_args.kwargs, {'channel': 'command'})
+
+    def test_task_queue_lag_and_db_time(self):
+        task = mock.Mock()
+        task.name = 'monitoring.tasks.run_service_check'
+        task.request = mock.Mock(eta=None, batmon_sent_at=time.time() - 2)
+        with mock.patch.object(metrics.TASK_QUEUE_LAG, 'observe') as queue_lag, \
+                mock.patch.object(metrics.TASK_DB_TIME, 'observe') as db_time, \
+                mock.patch.object(metrics.TASK_DURATION, 'observe') as duration:
+            task_metrics.start_task_timers(task_id='t1', task=task)
+            ServiceCheck.objects.count()
+            task_metrics.stop_task_timers(task_id='t1', task=task)
+
+        self.assertGreaterEqual(queue_lag.call_args.args[0], 2)
+        self.assertGreater(db_time.call_args.args[0], 0)
+        self.assertLessEqual(db_time.call_args.args[0], duration.call_args.args[0])
+        self.assertEqual(connection.execute_wrappers, [])
+
+    def test_endpoint(self):
+        metrics.TASK_FAILURES.inc(task='x')
+        metrics.push(self.store)
+        with mock.patch('monitoring.metrics.get_redis', return_value=self.store):
+            response = self.client.get(reverse('monitoring:metrics'))
+        self.assertEqual(response['Content-Type'], metrics.CONTENT_TYPE)
+        self.assertIn(b'batmon_task_failures_total{task="x"} 1\n', response.content)
+        with mock.patch('monitoring.metrics.read_totals', side_effect=redis.ConnectionError('down')):
+            self.assertEqual(self.client.get(reverse('monitoring:metrics')).status_code, 503)
+
+
+@override_settings(CACHES=STATUS_TEST_CACHES, BATMON_STATUS_CACHE='status')
+class BenchmarkTests(TestCase):
+
+    def test_small_run(self):
+        report = benchmark.run(sizes=[3, 5], results_per_service=4, checks=6, repeat=1, log=lambda message: None)
+        result_sink.flush()
+        pipeline = report['pipeline']['run_service_check']
+        self.assertEqual(pipeline['checks'], 6)
+        self.assertGreater(pipeline['checks_per_second'], 0)
+        self.assertEqual(set(report['views']), {'3', '5'})
+        self.assertEqual(report['views']['5']['status_page']['warm']['queries'], 0)
+        self.assertEqual(report['views']['5']['dashboard']['queries'], 8)
+        # Only the benchmark user's session and user; the series come from the cache
+        self.assertEqual(report['views']['5']['chart']['warm']['queries'], 2)
+        self.assertGreater(report['views']['5']['sla']['bytes'], 0)
+        # 5 services x 4 seeded results, plus the checks of both pipelines against the stand-in servers
+        self.assertEqual(CheckResult.objects.count(), 20 + 6 + 6)
+        # Only the seeded failure of the one 'down' service; every stand-in check succeeded
+        self.assertEqual(CheckResult.objects.filter(success=False).count(), 1)
+        json.dumps(report)
+
+
+class HistoryAPITests(TestCase):
+    """Cursor pagination, filters and streaming export of the result and alert log endpoints."""
+
+    def setUp(self):
+        self.service = create_service()
+        self.other = create_service(name='other')
+        self.now = timezone.now().replace(microsecond=0)
+        # Pairs of rows share a timestamp, so pages must break ties on id.
+        CheckResult.objects.bulk_create([
+            CheckResult(service=self.service if i % 3 else self.other, timestamp=self.now - timedelta(minutes=i // 2),
+                        success=bool(i % 4), response_time=0.1)
+            for i in range(25)
+        ])
+
+    def test_cursor_pages_cover_every_row_once(self):
+        seen = []
+        url = reverse('monitoring:checkresult-list') + '?page_size=4'
+        while url:
+            with self.assertNumQueries(1):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            seen += [row['id'] for row in response.json()['results']]
+            url = response.json()['next']
+        expected = list(CheckResult.objects.order_by('-timestamp', '-id').values_list('id', flat=True))
+        self.assertEqual(seen, expected)
+
+    def test_filters(self):
+        url = reverse('monitoring:checkresult-list')
+        since = (self.now - timedelta(minutes=5)).isoformat()
+        response = self.client.get(url, {'service': self.service.id, 'since': since})
+        rows = response.json()['results']
+        self.assertTrue(rows)
+        self.assertTrue(all(row['service'] == self.service.id for row in rows))
+        self.assertEqual(len(rows), self.service.results.filter(timestamp__gte=self.now - timedelta(minutes=5)).count())
+        self.assertEqual(self.client.get(url, {'since': 'yesterday'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'cursor': 'garbage'}).status_code, 404)
+
+    def test_alert_log_filters(self):
+        alert = Alert.objects.create(service=self.other, alert_type='command', trigger='on_fail', config={'command': 'true'})
+        AlertLog.objects.create(alert=alert, message_sent='down', success=True)
+        url = reverse('monitoring:alertlog-list')
+        self.assertEqual(len(self.client.get(url, {'service': self.other.id}).json()['results']), 1)
+        self.assertEqual(self.client.get(url, {'service': self.service.id}).json()['results'], [])
+
+    def test_export_ndjson(self):
+        response = self.client.get(reverse('monitoring:checkresult-export', args=['ndjson']), {'service': self.other.id})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([row['id'] for row in rows],
+                         list(self.other.results.order_by('timestamp', 'id').values_list('id', flat=True)))
+        self.assertEqual(rows[0]['service__name'], 'other')
+
+    def test_export_csv(self):
+        response = self.client.get(reverse('monitoring:checkresult-export', args=['csv']))
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        rows = list(csv.reader(b''.join(response.streaming_content).decode().splitlines()))
+        self.assertEqual(rows[0][:3], ['id', 'service_id', 'service__name'])
+        self.assertEqual(len(rows), 26)
+
+    def asgi_get(self, path, query_string=b''):
+        """Run a GET through Django's ASGI handler, noting how many chunks were fetched as each body part went out."""
+        sent = []
+        requests = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+
+        async def receive():
+            if requests:
+                return requests.pop()
+            await asyncio.Event().wait() # The client never disconnects
+        async def send(message):
+            sent.append((message, fetches.call_count))
+
+        scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+                 'path': path, 'raw_path': path.encode(), 'query_string': query_string, 'root_path': '',
+                 'headers': [(b'host', b'testserver')], 'server': ('testserver', 80), 'client': ('127.0.0.1', 1)}
+        # Like the test client, keep the test's connection (and transaction) open across the request.
+        request_started.disconnect(close_old_connections)
+        request_finished.disconnect(close_old_connections)
+        try:
+            with mock.patch('monitoring.api_views.islice', wraps=islice) as fetches:
+                async_to_sync(ASGIHandler())(scope, receive, send)
+        finally:
+            request_started.connect(close_old_connections)
+            request_finished.connect(close_old_connections)
+        return sent
+
+    def test_export_iterator_matches_the_server(self):
+        # Each handler type streams its own kind of iterator and reads the other into memory first.
+        url = reverse('monitoring:checkresult-export', args=['csv'])
+        self.assertFalse(self.client.get(url).is_async)
+        self.assertTrue(async_to_sync(AsyncClient().get)(url).is_async)
+
+    @mock.patch('monitoring.api_views.EXPORT_CHUNK_SIZE', 4)
+    def test_export_streams_under_asgi(self):
+        sent = self.asgi_get(reverse('monitoring:checkresult-export', args=['ndjson']))
+        self.assertEqual(sent[0][0]['status'], 200)
+        bodies = [(message.get('body', b''), fetches) for message, fetches in sent[1:]]
+        lines = b''.join(body for body, _ in bodies).decode().splitlines()
+        self.assertEqual([json.loads(line)['id'] for line in lines],
+                         list(CheckResult.objects.order_by('timestamp', 'id').values_list('id', flat=True)))
+        # The first rows went out after one chunk of 4 was fetched, not after all 25 were read
+        self.assertEqual(bodies[0][1], 1)
+        self.assertEqual(bodies[-1][1], 8)
+
+
+@override_settings(CACHES=STATUS_TEST_CACHES, BATMON_STATUS_CACHE='status', BATMON_SAMPLE_STORAGE='blocks')
+class SampleBlockTests(TestCase):
+    """Raw samples packed into hourly SampleBlocks, with rows kept only for failures and state changes."""
+
+    def setUp(self):
+        caches['status'].clear()
+        self.service = create_service(status_atual='ok')
+
+    def tearDown(self):
+        result_sink.flush()
+
+    def run_checks(self, outcomes):
+        for success, response_time in outcomes:
+            with mock.patch('monitoring.tasks.check_http',
+                            return_value={'success': success, 'message': 'x', 'response_time': response_time}):
+                run_service_check(self.service.id)
+        result_sink.flush()
+
+    def test_round_trip(self):
+        start = samples.block_start(timezone.now())
+        block = SampleBlock(service=self.service, start=start)
+        samples.append(block, [samples.Sample(start + timedelta(seconds=30), True, 0.25),
+                               samples.Sample(start + timedelta(seconds=10), False, None)])
+        samples.append(block, [samples.Sample(start + timedelta(seconds=20, milliseconds=5), True, 1.5)] * 9)
+        self.assertEqual((block.count, block.successes, len(block.success_bitmap)), (11, 10, 2))
+        decoded = samples.decode(block)
+        self.assertEqual(decoded[0], samples.Sample(start + timedelta(seconds=10), False, None))
+        self.assertEqual(decoded[1], samples.Sample(start + timedelta(seconds=20, milliseconds=5), True, 1.5))
+        self.assertEqual(decoded[-1], samples.Sample(start + timedelta(seconds=30), True, 0.25))
+
+    def test_flush_keeps_rows_for_failures_and_recoveries(self):
+        self.run_checks([(True, 0.1), (True, 0.2), (False, None), (False, None), (True, 0.3), (True, 0.4)])
+        blocks = list(SampleBlock.objects.filter(service=self.service))
+        self.assertEqual(sum(block.count for block in blocks), 6)
+        self.assertEqual(sum(block.successes for block in blocks), 4)
+        # The two failures and the success that ended them
+        self.assertEqual(list(self.service.results.order_by('timestamp').values_list('success', flat=True)),
+                         [False, False, True])
+        stored = samples.service_samples(self.service.id, timezone.now() - timedelta(hours=2), timezone.now())
+        self.assertEqual([sample.response_time for sample in stored], [0.1, 0.2, None, None, 0.3, 0.4])
+
+        detail = self.client.get(reverse('monitoring:service_detail', args=[self.service.id]))
+        self.assertEqual(detail.status_code, 200)
+        self.assertEqual(len(detail.context['results']), 6)
+        self.assertEqual(sum(result.pk is not None for result in detail.context['results']), 3)
+
+    def test_recent_results_match_rows_to_the_millisecond(self):
+        # Around half a millisecond, where rounding float timestamps could put a sample 1 ms away from its row.
+        start = samples.block_start(timezone.now())
+        rows = [
+            CheckResult.objects.create(service=self.service, timestamp=start + timedelta(seconds=seconds, microseconds=microseconds),
+                                       success=False, message=f'boom {seconds}')
+            for seconds, microseconds in ((17, 1499), (18, 1500), (19, 1501))
+        ]
+        samples.append_samples(rows)
+        recent = samples.recent_results(self.service, 10)
+        self.assertEqual([(result.pk, result.message) for result in recent],
+                         [(row.pk, row.message) for row in reversed(rows)])
+        # Stored truncated to the millisecond
+        self.assertEqual([sample.timestamp for sample in samples.service_samples(self.service.id, start, start + samples.BLOCK_SPAN)],
+                         [start + timedelta(seconds=seconds, milliseconds=1) for seconds in (17, 18, 19)])
+
+    def test_rollups_match_row_storage(self):
+        now = timezone.now()
+        results = [
+            CheckResult(service=self.service, timestamp=now - timedelta(seconds=50 * i), success=i % 7 != 0,
+                        response_time=None if i % 5 == 0 else 0.125 * (i % 4 + 1))
+            for i in range(200)
+        ]
+        with override_settings(BATMON_SAMPLE_STORAGE='rows'):
+            CheckResult.objects.bulk_create(results)
+            rollups.rollup_raw_results(now - timedelta(hours=3), now + timedelta(minutes=1))
+        fields = ('bucket_start', 'count', 'successes', 'response_time_count', 'response_time_sum', 'response_time_p95')
+        from_rows = list(CheckResultRollup.objects.order_by('bucket_start').values_list(*fields))
+        CheckResultRollup.objects.all().delete()
+        CheckResult.objects.all().delete()
+
+        samples.append_samples(results)
+        rollups.rollup_raw_results(now - timedelta(hours=3), now + timedelta(minutes=1))
+        from_blocks = list(CheckResultRollup.objects.order_by('bucket_start').values_list(*fields))
+        self.assertEqual([row[:4] for row in from_blocks], [row[:4] for row in from_rows])
+        for block_row, result_row in zip(from_blocks, from_rows):
+            self.assertAlmostEqual(block_row[4], result_row[4], places=5)
+
+    def test_samples_endpoint(self):
+        self.run_checks([(True, 0.1), (False, None)])
+        url = reverse('monitoring:servicecheck-samples', args=[self.service.id])
+        data = self.client.get(url).json()
+        self.assertEqual((data['success'], data['response_time']), ([True, False], [0.1, None]))
+        with override_settings(BATMON_SAMPLE_STORAGE='rows'):
+            self.assertEqual(self.client.get(url).json()['success'], [False]) # Only the failure has a row
+        since = (timezone.now() - timedelta(days=30)).isoformat()
+        self.assertEqual(self.client.get(url, {'since': since}).status_code, 400)
+
+
+class SLATests(TestCase):
+    """The SLA report, read from the rollups and incidents, agrees with the raw results they were built from."""
+
+    def setUp(self):
+        self.web = create_service(name='web', interval=300)
+        self.db = create_service(name='db', check_type='tcp', url_or_host='db:5432', interval=300)
+        day = rollups.bucket_start(timezone.now() - timedelta(days=3), '1d')
+        # Neither end on an hour, so the range takes '1m', '1h' and '1d' buckets.
+        self.since = day - timedelta(minutes=90)
+        self.until = day + timedelta(days=1, minutes=75)
+        self.maintenance = (day + timedelta(hours=5, seconds=20), day + timedelta(hours=6, seconds=10))
+        MaintenanceWindow.objects.create(title='all', start_time=self.maintenance[0], end_time=self.maintenance[1])
+        MaintenanceWindow.objects.create(service=self.db, title='db', start_time=day + timedelta(hours=10),
+                                         end_time=day + timedelta(hours=12))
+        # web fails the probes of minutes 100-110 and 1000 of the range, and one in the maintenance (not counted).
+        failing = {100, 105, 110, 1000, 400}
+        results = []
+        for minute in range(-60, int((self.until - self.since).total_seconds() // 60) + 60, 5):
+            timestamp = self.since + timedelta(minutes=minute, seconds=30)
+            results.append(CheckResult(service=self.web, timestamp=timestamp, success=minute not in failing,
+                                       response_time=0.1 if minute % 10 else 0.3))
+            results.append(CheckResult(service=self.db, timestamp=timestamp, success=True, response_time=0.05))
+        CheckResult.objects.bulk_create(results)
+        incidents.rebuild_incidents()
+        rollups.rollup_raw_results(self.since - timedelta(hours=2), self.until + timedelta(hours=2))
+        rollups.rollup_buckets('1h', self.since - timedelta(hours=2), self.until + timedelta(hours=2))
+        rollups.rollup_buckets('1d', self.since - timedelta(days=1), self.until + timedelta(days=1))
+
+    def expected(self, service, excluded):
+        rows = [
+            result for result in service.results.filter(timestamp__gte=self.since, timestamp__lt=self.until)
+            if not any(start <= result.timestamp < end for start, end in excluded)
+        ]
+        return len(rows), sum(row.success for row in rows)
+
+    def test_matches_raw_results(self):
+        report = {entry['name']: entry for entry in sla.service_sla(self.since, self.until)}
+        maintenance = (self.maintenance[0].replace(second=0), self.maintenance[1].replace(second=0) + timedelta(minutes=1))
+
+        web = report['web']
+        probes, successes = self.expected(self.web, [maintenance])
+        self.assertEqual(web['probes'], probes)
+        self.assertEqual(web['availability'], round(successes / probes * 100, 4))
+        # Incidents last until the next successful probe: 100-115 and 1000-1005.
+        self.assertEqual((web['incidents'], web['downtime_seconds'], web['mttr_seconds']), (2, 20 * 60, 600.0))
+        monitored = (self.until - self.since) - (maintenance[1] - maintenance[0])
+        self.assertEqual(web['monitored_seconds'], monitored.total_seconds())
+        self.assertEqual(web['mtbf_seconds'], (monitored.total_seconds() - 20 * 60) / 2)
+        self.assertAlmostEqual(web['response_time']['avg'], 0.2, places=4)
+        self.assertEqual((web['response_time']['p95'], web['response_time']['max']), (0.3, 0.3))
+
+        db = report['db']
+        db_window = (self.since + timedelta(minutes=90, hours=10), self.since + timedelta(minutes=90, hours=12))
+        self.assertEqual(db['probes'], self.expected(self.db, [maintenance, db_window])[0])
+        self.assertEqual((db['availability'], db['incidents'], db['mttr_seconds']), (100.0, 0, None))
+
+    def test_grouped_percentile_matches_rollups(self):
+        groups = np.array([0, 0, 0, 1, 1, 2, 0, 1])
+        values = np.array([0.5, 0.1, 0.9, 0.2, np.nan, 0.3, 0.4, 0.8])
+        weights = np.array([1, 3, 1, 2, 5, 0, 2, 1], dtype=float)
+        for q in (0.5, 0.95):
+            result = sla.grouped_percentile(groups, values, weights, q, 4)
+            for group in range(4):
+                pairs = [(v, w) for g, v, w in zip(groups, values, weights) if g == group and not np.isnan(v)]
+                expected = rollups.weighted_percentile(pairs, q)
+                self.assertEqual(None if np.isnan(result[group]) else result[group], expected)
+
+    def test_covering_buckets(self):
+        start = 1440 * 20000 - 61
+        buckets = sla.covering_buckets(start, start + 61 + 1440 + 62)
+        self.assertEqual([resolution for resolution, _ in buckets], ['1m'] + ['1h'] + ['1d'] + ['1h'] + ['1m'] * 2)
+
+    def test_endpoint(self):
+        url = reverse('monitoring:servicecheck-sla')
+        response = self.client.get(url, {'since': self.since.isoformat(), 'until': self.until.isoformat(),
+                                         'service': str(self.db.id)})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([entry['name'] for entry in response.json()['services']], ['db'])
+        self.assertEqual(self.client.get(url, {'service': 'db'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'since': self.until.isoformat(), 'until': self.since.isoformat()}).status_code, 400)
+        self.assertEqual(len(self.client.get(url).json()['services']), 2)
+
+
+class IncidentTests(TestCase):
+    """Incidents are opened and closed by the result sink on status changes, and rebuilt from the history."""
+
+    def setUp(self):
+        self.service = create_service()
+
+    def tearDown(self):
+        result_sink.flush()
+
+    def run_checks(self, outcomes, flush_each=True):
+        for success in outcomes:
+            with mock.patch('monitoring.tasks.check_http', return_value={'success': success, 'message': f'{success}'}):
+                run_service_check(self.service.id)
+            if flush_each:
+                result_sink.flush()
+        result_sink.flush()
+
+    def check_lifecycle(self):
+        self.run_checks([True, False, False])
+        incident = Incident.objects.get()
+        first_failure = self.service.results.filter(success=False).earliest('timestamp')
+        self.assertEqual((incident.started_at, incident.ended_at), (first_failure.timestamp, None))
+        self.assertEqual((incident.first_error, incident.failed_probes), ('False', 2))
+
+        self.run_checks([False, True, True], flush_each=False)
+        incident.refresh_from_db()
+        last_failure = self.service.results.filter(success=False).latest('timestamp')
+        recovery = self.service.results.filter(timestamp__gt=last_failure.timestamp).earliest('timestamp')
+        self.assertEqual((incident.ended_at, incident.failed_probes), (recovery.timestamp, 3))
+        # A success following a success does not touch the incidents.
+        with CaptureQueriesContext(connection) as queries:
+            self.run_checks([True])
+        self.assertFalse([query for query in queries if 'monitoring_incident' in query['sql']])
+
+        self.run_checks([False])
+        self.assertEqual(Incident.objects.count(), 2)
+        self.assertEqual(Incident.objects.filter(ended_at__isnull=True).get().failed_probes, 1)
+
+    def test_lifecycle(self):
+        self.check_lifecycle()
+
+    @override_settings(BATMON_SAMPLE_STORAGE='blocks')
+    def test_lifecycle_with_blocks(self):
+        self.check_lifecycle()
+
+    def test_rebuild_matches_recorded(self):
+        self.run_checks([False, False, True, True, False, True, False])
+        recorded = list(Incident.objects.order_by('started_at').values_list('started_at', 'ended_at', 'failed_probes', 'first_error'))
+        self.assertEqual(len(recorded), 3)
+        out = io.StringIO()
+        call_command('rebuild_incidents', stdout=out)
+        self.assertIn('Rebuilt 3 incidents', out.getvalue())
+        self.assertEqual(
+            list(Incident.objects.order_by('started_at').values_list('started_at', 'ended_at', 'failed_probes', 'first_error')),
+            recorded,
+        )
+
+    def test_api_and_alert_logs(self):
+        self.run_checks([False, True, False])
+        closed, ongoing = Incident.objects.order_by('started_at')
+        alert = Alert.objects.create(service=self.service, alert_type='command', trigger='on_fail', config={'command': 'true'})
+        log, = alert_dispatch.dispatch([(alert.id, 'down')])
+        self.assertEqual(log.incident_id, ongoing.id)
+
+        url = reverse('monitoring:incident-list')
+        rows = self.client.get(url).json()['results']
+        self.assertEqual([row['id'] for row in rows], [ongoing.id, closed.id])
+        self.assertEqual((rows[0]['duration'], rows[1]['failed_probes']), (None, 1))
+        self.assertEqual([row['id'] for row in self.client.get(url, {'open': 'true'}).json()['results']], [ongoing.id])
+        self.assertEqual(self.client.get(url, {'open': 'maybe'}).status_code, 400)
+        self.assertEqual([row['id'] for row in self.client.get(url, {'page_size': 1}).json()['results']], [ongoing.id])
+        self.assertEqual(self.client.get(url, {'since': ongoing.started_at.isoformat()}).json()['results'][0]['id'], ongoing.id)
+        logs = self.client.get(reverse('monitoring:alertlog-list'), {'incident': ongoing.id}).json()['results']
+        self.assertEqual([row['id'] for row in logs], [log.id])
+
+
+class LocalHTTPHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive
+
+    def setup(self):
+        super().setup()
+        self.server.connections.append(self.client_address)
+
+    def do_GET(self):
+        self.send_response(503 if self.path == '/unavailable' else 200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HTTPCheckTests(TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), LocalHTTPHandler)
+        self.server.connections = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = f'http://localhost:{self.server.server_port}/'
+
+    def test_phase_timings_and_keepalive(self):
+        service = ServiceCheck(name='local', check_type='http', url_or_host=self.url, timeout=5)
+        first = check_http(service)
+        self.assertTrue(first['success'])
+        for phase in ('dns_time', 'connect_time', 'ttfb'):
+            self.assertGreaterEqual(first[phase], 0)
+        self.assertIsNone(first['tls_time'])
+
+        second = check_http(service)
+        self.assertTrue(second['success'])
+        # Same pooled connection: no lookup or handshake this time
+        self.assertIsNone(second['connect_time'])
+        self.assertIsNone(second['dns_time'])
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_host_without_addresses(self):
+        service = ServiceCheck(name='nowhere', check_type='http', url_or_host='http://nowhere.example/', timeout=5)
+        with mock.patch('monitoring.http_client.dns_cache.resolve', return_value=[]):
+            result = check_http(service)
+        self.assertFalse(result['success'])
+        self.assertIn("No addresses for nowhere.example", result['message'])
+
+    @override_settings(BATMON_HTTP_MAX_CONNECTIONS_PER_HOST=2)
+    def test_probe_engine_bounds_connections_per_host(self):
+        services = [ServiceCheck(id=i, name=f'local-{i}', check_type='http', url_or_host=self.url, timeout=5)
+                    for i in range(10)]
+        outcomes = ProbeEngine().run(services)
+        self.assertTrue(all(result['success'] for _, result in outcomes))
+        self.assertLessEqual(len(self.server.connections), 2)
+
+
+class ProbeEngineTests(TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), LocalHTTPHandler)
+        self.server.connections = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = f'http://127.0.0.1:{self.server.server_port}/'
+        listener = socket.create_server(('127.0.0.1', 0))
+        self.addCleanup(listener.close)
+        self.open_port = listener.getsockname()[1]
+        with socket.create_server(('127.0.0.1', 0)) as closed:
+            self.closed_port = closed.getsockname()[1]
+
+    def test_mixed_batch(self):
+        services = [
+            ServiceCheck(id=1, name='http-up', check_type='http', url_or_host=self.url, timeout=5),
+            ServiceCheck(id=2, name='http-down', check_type='http', url_or_host=f'{self.url}unavailable', timeout=5),
+            ServiceCheck(id=3, name='tcp-up', check_type='tcp', url_or_host=f'127.0.0.1:{self.open_port}', timeout=5),
+            ServiceCheck(id=4, name='tcp-down', check_type='tcp', url_or_host=f'127.0.0.1:{self.closed_port}', timeout=5),
+            ServiceCheck(id=5, name='dns', check_type='dns', url_or_host='example.com', timeout=5),
+        ]
+        outcomes = ProbeEngine().run(services)
+        self.assertEqual([service for service, _ in outcomes], services)
+        results = {service.name: result for service, result in outcomes}
+
+        self.assertTrue(results['http-up']['success'])
+        self.assertEqual(results['http-up']['status_code'], 200)
+        self.assertEqual(results['http-up']['message'], "Status code: 200")
+        self.assertGreaterEqual(results['http-up']['response_time'], 0)
+        self.assertFalse(results['http-down']['success'])
+        self.assertEqual(results['http-down']['status_code'], 503)
+        self.assertEqual(results['http-down']['message'], "Unexpected status code: 503")
+
+        self.assertTrue(results['tcp-up']['success'])
+        self.assertEqual(results['tcp-up']['message'], f"Successfully connected to 127.0.0.1:{self.open_port}")
+        self.assertGreaterEqual(results['tcp-up']['response_time'], 0)
+        self.assertFalse(results['tcp-down']['success'])
+        self.assertNotIn('response_time', results['tcp-down'])
+
+        self.assertEqual(results['dns'], {'success': False, 'message': "Unknown check type: dns"})
+
+    def test_tcp_host_without_addresses(self):
+        service = ServiceCheck(id=1, name='tcp', check_type='tcp', url_or_host='gateway.example:443', timeout=5)
+        with mock.patch('monitoring.probe_engine.dns_cache.async_resolve', mock.AsyncMock(return_value=[])):
+            [(_, result)] = ProbeEngine().run([service])
+        self.assertEqual(result, {'success': False, 'message': "No addresses for gateway.example"})
+
+    def test_raising_probe_becomes_failure(self):
+        services = [
+            ServiceCheck(id=1, name='http-up', check_type='http', url_or_host=self.url, timeout=5),
+            ServiceCheck(id=2, name='tcp-broken', check_type='tcp', url_or_host=f'127.0.0.1:{self.open_port}', timeout=5),
+        ]
+        broken = mock.AsyncMock(side_effect=RuntimeError('probe crashed'))
+        with mock.patch('monitoring.probe_engine.async_check_tcp', broken), \
+                self.assertLogs('monitoring.probe_engine', 'ERROR') as logs:
+            outcomes = ProbeEngine().run(services)
+        results = {service.name: result for service, result in outcomes}
+        self.assertTrue(results['http-up']['success'])
+        self.assertEqual(results['tcp-broken'], {'success': False, 'message': 'probe crashed'})
+        self.assertIn("Probe for 'tcp-broken' raised", logs.output[0])
+
+
+def addrinfo(*addresses):
+    return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', (address, 0)) for address in addresses]
+
+
+@mock.patch('monitoring.dns_cache.dns', None) # The system resolver path, whether or not dnspython is installed
+class DNSCacheTests(TestCase):
+
+    def setUp(self):
+        self.cache = dns_cache.DNSCache()
+
+    @override_settings(BATMON_DNS_CACHE_TTL=60)
+    def test_caches_until_expiry(self):
+        with mock.patch('socket.getaddrinfo', return_value=addrinfo('10.0.0.1', '10.0.0.1', '10.0.0.2')) as lookup, \
+                mock.patch('monitoring.dns_cache.time.monotonic', return_value=1000):
+            self.assertEqual(self.cache.resolve('gateway.example'), ['10.0.0.1', '10.0.0.2'])
+            self.assertEqual(self.cache.resolve('gateway.example'), ['10.0.0.1', '10.0.0.2'])
+            self.assertEqual(self.cache.resolve('10.0.0.9'), ['10.0.0.9']) # Literals are never looked up
+        self.assertEqual(lookup.call_count, 1)
+        with mock.patch('socket.getaddrinfo', return_value=addrinfo('10.0.0.3')), \
+                mock.patch('monitoring.dns_cache.time.monotonic', return_value=1060):
+            self.assertEqual(self.cache.resolve('gateway.example'), ['10.0.0.3'])
+
+    def test_negative_caching(self):
+        missing = socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+        with mock.patch('socket.getaddrinfo', side_effect=missing) as lookup:
+            for _ in range(2):
+                with self.assertRaises(socket.gaierror):
+                    self.cache.resolve('missing.example')
+        self.assertEqual(lookup.call_count, 1)
+        # A resolver failure says nothing about the name, so the next probe asks again.
+        with mock.patch('socket.getaddrinfo', side_effect=socket.gaierror(socket.EAI_AGAIN, 'Try again')) as lookup:
+            for _ in range(2):
+                with self.assertRaises(socket.gaierror):
+                    self.cache.resolve('flaky.example')
+        self.assertEqual(lookup.call_count, 2)
+
+    def test_concurrent_async_lookups_share_one_query(self):
+        async def resolve_many():
+            return await asyncio.gather(*(self.cache.async_resolve('gateway.example') for _ in range(20)))
+
+        with mock.patch('socket.getaddrinfo', return_value=addrinfo('10.0.0.1')) as lookup:
+            results = asyncio.run(resolve_many())
+        self.assertEqual(results, [['10.0.0.1']] * 20)
+        self.assertEqual(lookup.call_count, 1)
+
+    def test_tcp_check_reports_dns_time_separately(self):
+        server = socket.create_server(('127.0.0.1', 0))
+        self.addCleanup(server.close)
+        port = server.getsockname()[1]
+        service = ServiceCheck(name='tcp', check_type='tcp', url_or_host=f'gateway.example:{port}', timeout=2)
+        self.cache._store('gateway.example', ['127.0.0.1'], 60)
+        with mock.patch('monitoring.dns_cache.get_dns_cache', return_value=self.cache):
+            result = check_tcp(service)
+            outcomes = ProbeEngine().run([service])
+        self.assertTrue(result['success'])
+        self.assertGreaterEqual(result['dns_time'], 0)
+        self.assertTrue(outcomes[0][1]['success'])
+        self.assertGreaterEqual(outcomes[0][1]['dns_time'], 0)
+
+    def test_tcp_check_without_addresses(self):
+        service = ServiceCheck(name='tcp', check_type='tcp', url_or_host='gateway.example:443', timeout=2)
+        with mock.patch('monitoring.tasks.dns_cache.resolve', return_value=[]):
+            result = check_tcp(service)
+        self.assertEqual(result, {'success': False, 'message': "No addresses for gateway.example"})
+
+
+def dns_answer(ttl, *addresses):
+    answer = mock.Mock()
+    answer.rrset.ttl = ttl
+    answer.__iter__ = lambda self: iter([mock.Mock(address=address) for address in addresses])
+    return answer
+
+
+@override_settings(BATMON_DNS_CACHE_TTL=60, BATMON_DNS_CACHE_MAX_TTL=300)
+class DNSPythonResolverTests(TestCase):
+    """With dnspython, cache entries live as long as the records' TTL."""
+
+    def setUp(self):
+        self.cache = dns_cache.DNSCache()
+
+    def answers(self, ttl):
+        def resolve(host, rdtype, **kwargs):
+            if rdtype == 'AAAA':
+                raise dns_cache.dns.resolver.NoAnswer()
+            return dns_answer(ttl, '10.0.0.1')
+        return resolve
+
+    def test_entry_expires_at_record_ttl(self):
+        resolver = mock.Mock(resolve=mock.Mock(side_effect=self.answers(120)))
+        with mock.patch('dns.resolver.get_default_resolver', return_value=resolver), \
+                mock.patch('socket.getaddrinfo') as getaddrinfo:
+            for now in (1000, 1119):
+                with mock.patch('monitoring.dns_cache.time.monotonic', return_value=now):
+                    self.assertEqual(self.cache.resolve('gateway.example'), ['10.0.0.1'])
+            self.assertEqual(resolver.resolve.call_count, 2) # A and AAAA, once
+            with mock.patch('monitoring.dns_cache.time.monotonic', return_value=1120):
+                self.cache.resolve('gateway.example')
+            self.assertEqual(resolver.resolve.call_count, 4)
+        getaddrinfo.assert_not_called()
+
+    def test_async_entry_expires_at_record_ttl_capped(self):
+        resolver = mock.Mock(resolve=mock.AsyncMock(side_effect=self.answers(3600)))
+        with mock.patch('dns.asyncresolver.get_default_resolver', return_value=resolver), \
+                mock.patch('monitoring.dns_cache.time.monotonic', return_value=1000):
+            self.assertEqual(asyncio.run(self.cache.async_resolve('gateway.example')), ['10.0.0.1'])
+        # Kept for BATMON_DNS_CACHE_MAX_TTL, not the record's hour
+        self.assertEqual(self.cache._entries['gateway.example'][0], 1300)
+
+
+class ListStore:
+    """The few Redis list and sorted set commands the alert queue uses."""
+
+    def __init__(self):
+        self.lists = {}
+        self.sorted_sets = {}
+
+    def pipeline(self, transaction=True):
+        store = self
+
+        class Pipeline:
+            def __init__(self):
+                self.commands = []
+
+            def __getattr__(self, name):
+                return lambda *args: self.commands.append((getattr(store, name), args))
+
+            def execute(self):
+                return [command(*args) for command, args in self.commands]
+
+        return Pipeline()
+
+    def rpush(self, key, *values):
+        items = self.lists.setdefault(key, [])
+        items.extend(value.encode() for value in values)
+        return len(items)
+
+    def llen(self, key):
+        return len(self.lists.get(key, []))
+
+    def lmove(self, source, destination, wherefrom, whereto):
+        if not self.lists.get(source):
+            return None
+        value = self.lists[source].pop(0 if wherefrom == 'LEFT' else -1)
+        if not self.lists[source]:
+            del self.lists[source]
+        target = self.lists.setdefault(destination, [])
+        target.insert(0 if whereto == 'LEFT' else len(target), value)
+        return value
+
+    def delete(self, key):
+        return int(self.lists.pop(key, None) is not None)
+
+    def zadd(self, key, mapping):
+        self.sorted_sets.setdefault(key, {}).update(mapping)
+
+    def zrem(self, key, member):
+        return int(self.sorted_sets.get(key, {}).pop(member, None) is not None)
+
+    def zrangebyscore(self, key, low, high):
+        return [member for member, score in self.sorted_sets.get(key, {}).items() if score <= high]
+
+
+class AlertDispatchTests(TestCase):
+
+    def setUp(self):
+        self.services = [create_service(name=f'svc-{i}') for i in range(3)]
+
+    def add_alert(self, service, alert_type, **config):
+        return Alert.objects.create(service=service, alert_type=alert_type, config=config)
+
+    def test_emails_to_one_inbox_become_a_digest(self):
+        items = [(self.add_alert(service, 'email', email_address='ops@example.com').id, f'{service.name} down')
+                 for service in self.services]
+        items.append((self.add_alert(self.services[0], 'email', email_address='dev@example.com').id, 'svc-0 down'))
+        # alerts with their services, the services' latest incidents, then one bulk INSERT of the logs
+        with self.assertNumQueries(3):
+            logs = alert_dispatch.dispatch(items, digest=True)
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(mail.outbox[0].subject, 'BatMon: 3 alerts')
+        self.assertIn('svc-2 down', mail.outbox[0].body)
+        self.assertEqual(len(logs), 4)
+        self.assertTrue(all(log.success for log in logs))
+        self.assertEqual(AlertLog.objects.count(), 4)
+
+    def test_emails_without_digest_share_one_connection(self):
+        items = [(self.add_alert(service, 'email', email_address='ops@example.com').id, 'down')
+                 for service in self.services]
+        with mock.patch('monitoring.alert_dispatch.get_connection', wraps=alert_dispatch.get_connection) as connection:
+            alert_dispatch.dispatch(items, digest=False)
+        self.assertEqual(connection.call_count, 1)
+        self.assertEqual(len(mail.outbox), 3)
+
+    def test_http_channels_reuse_one_session(self):
+        items = [(self.add_alert(service, 'telegram', token='t', chat_id='42').id, f'{service.name} down')
+                 for service in self.services]
+        items += [(self.add_alert(service, 'webhook', webhook_url='https://hooks.example.com/').id, 'down')
+                  for service in self.services[:2]]
+        response = mock.Mock(status_code=200, text='ok')
+        with mock.patch('monitoring.alert_dispatch.requests.Session') as session_class:
+            session_class.return_value.post.return_value = response
+            logs = alert_dispatch.dispatch(items, digest=True)
+        session_class.assert_called_once_with()
+        posts = session_class.return_value.post.call_args_list
+        # one Telegram digest and one call per webhook alert
+        self.assertEqual(len(posts), 3)
+        self.assertEqual(posts[0].kwargs['data']['text'], 'svc-0 down\n\nsvc-1 down\n\nsvc-2 down')
+        self.assertTrue(all(log.success for log in logs))
+
+    def test_digest_chunks_respect_the_limit(self):
+        chunks = alert_dispatch.digest_chunks([('a' * 6, 1), ('b' * 6, 2), ('c' * 20, 3)], limit=14)
+        self.assertEqual(chunks, [('aaaaaa\n\nbbbbbb', [1, 2]), ('c' * 14, [3])])
+
+    def queue(self, store, count):
+        alert = self.add_alert(self.services[0], 'email', email_address='ops@example.com')
+        with mock.patch('monitoring.alert_dispatch.get_redis', return_value=store):
+            for i in range(count):
+                queue_alert(alert.id, f'down {i}')
+
+    @override_settings(BATMON_ALERT_BATCH_MAX=2)
+    def test_queued_alerts_are_acknowledged_after_delivery(self):
+        store = ListStore()
+        self.queue(store, 3)
+        with mock.patch('monitoring.alert_dispatch.get_redis', return_value=store):
+            dispatch_pending_alerts()
+        self.assertEqual(AlertLog.objects.count(), 3)
+        self.assertEqual(store.lists, {})
+        self.assertEqual(store.sorted_sets, {alert_dispatch.PROCESSING_ALERTS_KEY: {}})
+
+    def test_unacknowledged_batch_is_delivered_again(self):
+        store = ListStore()
+        self.queue(store, 3)
+        with mock.patch('monitoring.alert_dispatch.get_redis', return_value=store), \
+                mock.patch('monitoring.alert_dispatch.dispatch', side_effect=OperationalError('gone')), \
+                self.assertLogs('monitoring.alert_tasks', 'ERROR'):
+            dispatch_pending_alerts()
+        self.assertEqual(len(mail.outbox), 0)
+        # Claimed but not lost
+        [batch_key] = store.sorted_sets[alert_dispatch.PROCESSING_ALERTS_KEY]
+        self.assertEqual(len(store.lists[batch_key]), 3)
+        self.assertNotIn(alert_dispatch.PENDING_ALERTS_KEY, store.lists)
+
+        with mock.patch('monitoring.alert_dispatch.get_redis', return_value=store):
+            dispatch_pending_alerts() # Not stale yet
+            self.assertEqual(AlertLog.objects.count(), 0)
+            with override_settings(BATMON_ALERT_REDELIVERY_TIMEOUT=0):
+                dispatch_pending_alerts()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].body, 'down 0\n\ndown 1\n\ndown 2')
+        self.assertEqual(store.lists, {})
+
+    def test_queue_alert_without_redis_sends_directly(self):
+        with mock.patch('monitoring.alert_dispatch.enqueue', side_effect=redis.ConnectionError('down')), \
+                mock.patch('monitoring.alert_tasks.send_alerts.delay') as delay:
+            queue_alert(7, 'down')
+        delay.assert_called_once_with([[7, 'down']])
+
+
+def icmp_available():
+    try:
+        icmp.ICMPSocket().close()
+    except icmp.ICMPUnavailable:
+        return False
+    return True
+
+
+class ICMPTests(TestCase):
+
+    def test_echo_request_checksum(self):
+        packet = icmp.echo_request(0x1234, 7)
+        self.assertEqual(icmp.checksum(packet), 0)
+        self.assertEqual(packet[0], icmp.ICMP_ECHO_REQUEST)
+
+    def test_parse_ping_output(self):
+        stdout = (
+            "PING 127.0.0.1 (127.0.0.1): 56 data bytes\n"
+            "64 bytes from 127.0.0.1: seq=0 ttl=64 time=0.081 ms\n"
+            "\n--- 127.0.0.1 ping statistics ---\n"
+        )
+        rtt, summary = icmp.parse_ping_output(stdout)
+        self.assertAlmostEqual(rtt, 0.000081)
+        self.assertEqual(summary, "64 bytes from 127.0.0.1: seq=0 ttl=64 time=0.081 ms")
+
+    @skipUnless(icmp_available(), "Needs unprivileged ICMP sockets or CAP_NET_RAW")
+    def test_ping_localhost(self):
+        result = check_ping(ServiceCheck(name='lo', check_type='ping', url_or_host='127.0.0.1', timeout=2))
+        self.assertTrue(result['success'], result)
+        self.assertLess(result['response_time'], 1)
+
+    @skipUnless(icmp_available(), "Needs unprivileged ICMP sockets or CAP_NET_RAW")
+    def test_probe_engine_pings_many_hosts_over_one_socket(self):
+        services = [ServiceCheck(id=i, name=f'lo-{i}', check_type='ping', url_or_host=f'127.0.0.{i + 1}', timeout=2)
+                    for i in range(50)]
+        with mock.patch('monitoring.icmp.ICMPSocket', wraps=icmp.ICMPSocket) as icmp_socket:
+            outcomes = ProbeEngine().run(services)
+        self.assertTrue(all(result['success'] for _, result in outcomes), outcomes)
+        self.assertLessEqual(icmp_socket.call_count, 1)
+
+
+@override_settings(CACHES=STATUS_TEST_CACHES, BATMON_STATUS_CACHE='status')
+class StatusPageCacheTests(TestCase):
+
+    def setUp(self):
+        caches['status'].clear()
+        self.service = create_service()
+        maintenance_cache.refresh()
+
+    def tearDown(self):
+        result_sink.flush()
+
+    def test_cached_page_costs_no_queries(self):
+        url = reverse('monitoring:status_page')
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Last-Modified'])
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_unknown_service(self):
+        response = self.client.get(reverse('monitoring:service_detail', args=[self.service.id + 1]))
+        self.assertEqual(response.status_code, 404)
+
+    def test_status_change_rebuilds_pages(self):
+        self.client.get(reverse('monitoring:service_detail', args=[self.service.id]))
+        etag = self.client.get(reverse('monitoring:status_page'))['ETag']
+
+        with mock.patch('monitoring.tasks.check_http', return_value={'success': False, 'message': 'down'}), \
+                mock.patch('monitoring.tasks.rebuild_status_pages.delay', side_effect=rebuild_status_pages) as delay, \
+                self.captureOnCommitCallbacks(execute=True):
+            run_service_check(self.service.id)
+            result_sink.flush()
+        delay.assert_called_once_with([self.service.id])
+
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('monitoring:status_page'))
+            self.client.get(reverse('monitoring:service_detail', args=[self.service.id]))
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertContains(response, 'Falha')
+
+    def test_only_rendered_fields_rebuild_pages(self):
+        with mock.patch('monitoring.tasks.rebuild_status_pages.delay') as delay, \
+                self.captureOnCommitCallbacks(execute=True):
+            self.service.consecutive_failures = 3
+            self.service.save(update_fields=['consecutive_failures', 'next_run_at'])
+        delay.assert_not_called()
+        with mock.patch('monitoring.tasks.rebuild_status_pages.delay') as delay, \
+                self.captureOnCommitCallbacks(execute=True):
+            self.service.name = 'renamed'
+            self.service.save(update_fields=['name'])
+        delay.assert_called_once_with([self.service.id])
+
+    def test_save_survives_broker_outage(self):
+        down = KombuOperationalError('Error -2 connecting to redis:6379.')
+        with mock.patch('monitoring.tasks.rebuild_status_pages.delay', side_effect=down), \
+                self.assertLogs('monitoring.status_cache', 'WARNING'), \
+                self.captureOnCommitCallbacks(execute=True):
+            self.service.name = 'renamed'
+            self.service.save()
+        self.assertEqual(ServiceCheck.objects.get(pk=self.service.pk).name, 'renamed')
+
+    def test_maintenance_start_marks_page_stale(self):
+        start = timezone.now() + timedelta(seconds=30)
+        MaintenanceWindow.objects.create(service=self.service, title='mw', start_time=start,
+                                         end_time=start + timedelta(hours=1))
+        maintenance_cache.refresh()
+        page = status_cache.get_status_page()
+        self.assertEqual(page.valid_until, start.timestamp())
+        self.assertFalse(page.is_stale(page.built_at + 1))
+        self.assertTrue(page.is_stale(start.timestamp() + 1))
+
+        with mock.patch('monitoring.status_cache.time.time', return_value=start.timestamp() + 1), \
+                mock.patch('monitoring.maintenance_cache.timezone.now', return_value=start + timedelta(seconds=1)), \
+                mock.patch('monitoring.status_cache.timezone.now', return_value=start + timedelta(seconds=1)):
+            refresh_status_pages()
+        page = status_cache.get_status_page()
+        self.assertEqual(page.valid_until, (start + timedelta(hours=1)).timestamp())
+        self.assertIn('status-maintenance', page.body)
+
+
+class MaintenanceCacheTests(TestCase):
+
+    def setUp(self):
+        self.service = create_service()
+        self.other = create_service(name='other')
+        self.now = timezone.now()
+
+    def add_window(self, service, start, end, active=True):
+        return MaintenanceWindow.objects.create(service=service, title='mw', active=active,
+                                                start_time=self.now + timedelta(hours=start),
+                                                end_time=self.now + timedelta(hours=end))
+
+    def test_service_window(self):
+        self.add_window(self.service, -1, 1)
+        self.add_window(self.service, 2, 3)
+        maintenance_cache.refresh()
+        with self.assertNumQueries(0):
+            self.assertTrue(maintenance_cache.in_maintenance(self.service.id, self.now))
+            self.assertFalse(maintenance_cache.in_maintenance(self.other.id, self.now))
+            self.assertFalse(maintenance_cache.in_maintenance(self.service.id, self.now + timedelta(minutes=90)))
+            self.assertTrue(maintenance_cache.in_maintenance(self.service.id, self.now + timedelta(minutes=150)))
+
+    def test_overlapping_windows(self):
+        self.add_window(self.service, -5, 5)
+        self.add_window(self.service, -4, -3)
+        maintenance_cache.refresh()
+        self.assertTrue(maintenance_cache.in_maintenance(self.service.id, self.now))
+
+    def test_global_and_inactive_windows(self):
+        self.add_window(self.service, -1, 1, active=False)
+        maintenance_cache.refresh()
+        self.assertFalse(maintenance_cache.in_maintenance(self.service.id, self.now))
+        self.add_window(None, -1, 1)
+        maintenance_cache.refresh()
+        self.assertTrue(maintenance_cache.in_maintenance(self.other.id, self.now))
+        self.assertEqual(len(maintenance_cache.active_windows(self.now)), 1)
+
+
+@skipUnless(connection.vendor == 'postgresql', "EXPLAIN plan assertions need PostgreSQL")
+class HotPathPlanTests(TestCase):
+    """The hot queries must be answerable from their dedicated indexes."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.service = create_service()
+        cls.alert = Alert.objects.create(service=cls.service, alert_type='command', trigger='on_fail_x_times',
+                                         trigger_value=3, config={'command': 'true'})
+
+    def setUp(self):
+        # The test tables are tiny; make the planner show which index it *would* use.
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL enable_seqscan = off")
+            cursor.execute("SET LOCAL enable_bitmapscan = off")
+
+    def assertUsesIndex(self, queryset, index_name):
+        plan = queryset.explain()
+        self.assertIn(index_name, plan, f"Expected {index_name} in plan:\n{plan}")
+        self.assertNotIn('Sort', plan.split('\n')[0], f"Unexpected top-level sort in plan:\n{plan}")
+
+    def test_service_history(self):
+        self.assertUsesIndex(self.service.results.order_by('-timestamp')[:100], 'checkresult_service_ts_idx')
+
+    def test_recent_failures(self):
+        self.assertUsesIndex(
+            self.service.results.filter(success=False).order_by('-timestamp')[:3], 'checkresult_service_fail_idx'
+        )
+
+    def test_results_time_range(self):
+        now = timezone.now()
+        self.assertUsesIndex(
+            CheckResult.objects.filter(timestamp__gte=now - timedelta(minutes=5), timestamp__lt=now),
+            'checkresult_ts_idx',
+        )
+
+    def test_last_sent_alert(self):
+        self.assertUsesIndex(self.alert.logs.filter(success=True).order_by('-timestamp')[:1], 'alertlog_alert_sent_idx')
+
+    def test_active_maintenance(self):
+        now = timezone.now()
+        self.assertUsesIndex(
+            MaintenanceWindow.objects.filter(active=True, start_time__lte=now, end_time__gte=now).order_by(),
+            'maintenance_active_idx',
+        )
+
+    def test_due_checks(self):
+        self.assertUsesIndex(
+            ServiceCheck.objects.filter(active=True, next_run_at__lte=timezone.now()).order_by('next_run_at')[:10000],
+            'servicecheck_due_idx',
+        )
+
+    def test_result_cursor_page(self):
+        now = timezone.now()
+        self.assertUsesIndex(
+            CheckResult.objects.filter(timestamp__lte=now).exclude(timestamp=now, id__gte=10)
+            .order_by('-timestamp', '-id')[:101],
+            'checkresult_ts_idx',
+        )
+        self.assertUsesIndex(
+            self.service.results.filter(timestamp__lte=now).exclude(timestamp=now, id__gte=10)
+            .order_by('-timestamp', '-id')[:101],
+            'checkresult_service_ts_idx',
+        )
+
+    def test_chart_rollups(self):
+        # With many services in the window, the per-service lookup must not scan them all.
+        hour = timezone.now().replace(minute=0, second=0, microsecond=0)
+        services = [self.service] + [create_service(name=f'svc-{i}') for i in range(20)]
+        CheckResultRollup.objects.bulk_create([
+            CheckResultRollup(service=service, resolution='1h', bucket_start=hour - timedelta(hours=i), count=1, successes=1)
+            for service in services for i in range(100)
+        ])
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE monitoring_checkresultrollup")
+        self.assertUsesIndex(
+            CheckResultRollup.objects.filter(service=self.service, resolution='1h',
+                                             bucket_start__gte=timezone.now() - timedelta(days=7)).order_by('bucket_start'),
+            'unique_rollup_bucket',
+        )
+
+    def test_chart_window_rollups(self):
+        self.assertUsesIndex(
+            CheckResultRollup.objects.filter(resolution='1h', bucket_start__gte=timezone.now() - timedelta(days=1))
+            .order_by('bucket_start'),
+            'rollup_window_idx',
+        )
@@ -10,12 +10,15 @@ router.register(r'servicechecks', api_views.ServiceCheckViewSet)
 router.register(r'checkresults', api_views.CheckResultViewSet)
 router.register(r'alerts', api_views.AlertViewSet)
 router.register(r'alertlogs', api_views.AlertLogViewSet)
+router.register(r'incidents', api_views.IncidentViewSet)
 router.register(r'maintenancewindows', api_views.MaintenanceWindowViewSet)
 
 urlpatterns = [
     path('', views.status_page, name='status_page'),
     path('status/<int:service_id>/', views.service_detail, name='service_detail'),
+    path('live/', views.live_events, name='live_feed'),
     path('dashboard/', views.dashboard_view, name='dashboard'),
+    path('metrics', views.metrics_view, name='metrics'),
     # ServiceCheck CRUD URLs
     path('servicechecks/', views.ServiceCheckListView.as_view(), name='servicecheck_list'),
     path('servicechecks/new/', views.ServiceCheckCreateView.as_view(), name='servicecheck_create'),
@@ -1,123 +1,92 @@
-from django.shortcuts import render, get_object_or_404
-from .models import ServiceCheck, CheckResult, MaintenanceWindow, AlertLog, Alert
+import redis
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
+from django.shortcuts import render
+from .models import ServiceCheck, CheckResult, MaintenanceWindow, AlertLog, Alert, Incident
 from .forms import ServiceCheckForm, AlertForm, MaintenanceWindowForm
 from django.views.generic import ListView, CreateView, DetailView, UpdateView, DeleteView
+from django.contrib.auth.decorators import login_required
+from django.db.models import Count, Q
 from django.urls import reverse_lazy
-from datetime import timedelta
 from django.utils import timezone
-from django.utils.timezone import localtime
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+from . import live_feed, metrics, status_cache
+
+def _cached_page_response(request, page):
+    """Serve a pre-rendered status page, answering conditional requests with 304."""
+    response = get_conditional_response(request, etag=page.etag, last_modified=int(page.last_modified))
+    if response is None:
+        response = HttpResponse(page.body)
+    response['ETag'] = page.etag
+    response['Last-Modified'] = http_date(page.last_modified)
+    # Let browsers and proxies keep the page, but revalidate it on every use.
+    patch_cache_control(response, public=True, no_cache=True)
+    return response
 
 def status_page(request):
-    services = ServiceCheck.objects.all()
-    active_maintenance_windows = MaintenanceWindow.objects.filter(
-        active=True,
-        start_time__lte=timezone.now(),
-        end_time__gte=timezone.now()
-    ).order_by('start_time')
-
-    for service in services:
-        # Check if service is under maintenance
-        service.in_maintenance = False
-        for mw in active_maintenance_windows:
-            if mw.service == service or mw.service is None: # Global or service-specific maintenance
-                service.in_maintenance = True
-                service.display_status = 'maintenance'
-                break
-        
-        if not service.in_maintenance:
-            service.display_status = service.status_atual # Use actual status if not in maintenance
-
-        # Fetch last 24 hours of results for charting
-        time_threshold = timezone.now() - timedelta(hours=24)
-        results = service.results.filter(timestamp__gte=time_threshold).order_by('timestamp')
-        
-        service.chart_labels_json = json.dumps([localtime(result.timestamp).strftime('%H:%M') for result in results])
-        service.chart_response_time_data_json = json.dumps([result.response_time if result.success else 0 for result in results])
-        service.chart_uptime_data_json = json.dumps([1 if result.success else 0 for result in results]) # 1 for uptime, 0 for downtime
-
-    context = {
-        'services': services,
-        'active_maintenance_windows': active_maintenance_windows,
-    }
-    return render(request, 'monitoring/status.html', context)
+    return _cached_page_response(request, status_cache.get_status_page())
 
 def service_detail(request, service_id):
-    service = get_object_or_404(ServiceCheck, pk=service_id)
-    
-    # Check if service is under maintenance for detail page
-    active_maintenance_windows = MaintenanceWindow.objects.filter(
-        active=True,
-        start_time__lte=timezone.now(),
-        end_time__gte=timezone.now()
-    )
-    service.in_maintenance = False
-    for mw in active_maintenance_windows:
-        if mw.service == service or mw.service is None:
-            service.in_maintenance = True
-            service.display_status = 'maintenance'
-            break
-    
-    if not service.in_maintenance:
-        service.display_status = service.status_atual
-
-    # Fetch all historical results for the detail page
-    results = service.results.all().order_by('-timestamp')[:100] # Limit to last 100 for performance
-    
-    # Prepare data for charts (e.g., last 7 days)
-    time_threshold = timezone.now() - timedelta(days=7)
-    chart_results = service.results.filter(timestamp__gte=time_threshold).order_by('timestamp')
-
-    chart_labels_json = json.dumps([localtime(result.timestamp).strftime('%Y-%m-%d %H:%M') for result in chart_results])
-    chart_response_time_data_json = json.dumps([result.response_time if result.success else 0 for result in chart_results])
-    chart_uptime_data_json = json.dumps([1 if result.success else 0 for result in chart_results])
-
-    context = {
-        'service': service,
-        'results': results,
-        'chart_labels_json': chart_labels_json,
-        'chart_response_time_data_json': chart_response_time_data_json,
-        'chart_uptime_data_json': chart_uptime_data_json,
-    }
-    return render(request, 'monitoring/service_detail.html', context)
-
-from django.contrib.auth.decorators import login_required
-from django.db.models import Count
-import json
+    try:
+        page = status_cache.get_service_page(service_id)
+    except ServiceCheck.DoesNotExist:
+        raise Http404("No ServiceCheck matches the given query.")
+    return _cached_page_response(request, page)
+
+def metrics_view(request):
+    """Prometheus scrape endpoint for BatMon's own metrics, summed over every worker process."""
+    try:
+        totals = metrics.read_totals()
+    except (redis.RedisError, OSError) as e:
+        return HttpResponse(f"Metrics are unavailable: {e}\n", status=503, content_type='text/plain')
+    return HttpResponse(metrics.render(totals), content_type=metrics.CONTENT_TYPE)
+
+async def live_events(request):
+    """
+    Server-Sent Events stream of status transitions and new results (``?service=1,2`` to narrow it).
+
+    Needs the ASGI application; under WSGI the stream would pin a worker
+    thread per client, so it answers 204, which tells EventSource to stop retrying.
+    """
+    if not isinstance(request, ASGIRequest):
+        return HttpResponse(status=204)
+    service_ids = None
+    if request.GET.get('service'):
+        try:
+            service_ids = {int(service_id) for service_id in request.GET['service'].split(',')}
+        except ValueError:
+            return HttpResponseBadRequest("service must be a comma-separated list of ids.")
+    response = StreamingHttpResponse(live_feed.event_stream(service_ids), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no' # Do not let nginx buffer the stream
+    return response
 
 @login_required
 def dashboard_view(request):
-    total_services = ServiceCheck.objects.count()
-    services_up = ServiceCheck.objects.filter(status_atual='ok').count()
-    services_down = ServiceCheck.objects.filter(status_atual='fail').count()
-    services_alert = ServiceCheck.objects.filter(status_atual='alert').count()
-    services_maintenance = ServiceCheck.objects.filter(status_atual='maintenance').count()
-
-    recent_results = CheckResult.objects.all().order_by('-timestamp')[:10]
-    recent_alerts = AlertLog.objects.all().order_by('-timestamp')[:10]
+    counts = ServiceCheck.objects.aggregate(
+        total_services=Count('id'),
+        services_up=Count('id', filter=Q(status_atual='ok')),
+        services_down=Count('id', filter=Q(status_atual='fail')),
+        services_alert=Count('id', filter=Q(status_atual='alert')),
+        services_maintenance=Count('id', filter=Q(status_atual='maintenance')),
+    )
+
+    recent_results = CheckResult.objects.select_related('service').order_by('-timestamp')[:10]
+    recent_alerts = AlertLog.objects.select_related('alert__service').order_by('-timestamp')[:10]
+    recent_incidents = Incident.objects.select_related('service').order_by('-started_at')[:10]
     upcoming_maintenance = MaintenanceWindow.objects.filter(
         end_time__gte=timezone.now()
-    ).order_by('start_time')[:5]
-
-    services = ServiceCheck.objects.all()
-    time_threshold = timezone.now() - timedelta(hours=24)
-    for service in services:
-        results = service.results.filter(timestamp__gte=time_threshold).order_by('timestamp')
-        chart_labels = [localtime(result.timestamp).strftime('%H:%M') for result in results]
-        chart_response_time_data = [result.response_time if result.success else 0 for result in results]
-        chart_uptime_data = [1 if result.success else 0 for result in results]
-        
-        service.chart_labels_json = json.dumps(chart_labels)
-        service.chart_response_time_data_json = json.dumps(chart_response_time_data)
-        service.chart_uptime_data_json = json.dumps(chart_uptime_data)
+    ).select_related('service').order_by('start_time')[:5]
+
+    services = list(ServiceCheck.objects.all())
 
     context = {
-        'total_services': total_services,
-        'services_up': services_up,
-        'services_down': services_down,
-        'services_alert': services_alert,
-        'services_maintenance': services_maintenance,
+        **counts,
+        'chart_window': status_cache.STATUS_CHART_WINDOW,
         'recent_results': recent_results,
         'recent_alerts': recent_alerts,
+        'recent_incidents': recent_incidents,
         'upcoming_maintenance': upcoming_maintenance,
         'services': services,
     }